@@ -12,9 +12,17 @@
 
 from __future__ import absolute_import, division, print_function
 from scipy.spatial import distance
+from scipy.spatial import cKDTree
+import scipy.sparse as sp
 from . import definitions
 import numpy as np
 
+# above this number of nucleotides, close pairs are found using a KD-tree
+# instead of the full distance matrix
+kdtree_size = 400
+# approximate number of pairs (frames x nucleotides^2) processed at once in batched calculations
+block_size = 2**22
+
 
 def calc_lcs(coords):    
     """
@@ -26,34 +34,74 @@ def calc_lcs(coords):
     ----------
     coords : (3,n,3) numpy array 
         (3,n,3) numpy array with positions of C2,C4 and C6 atoms for pyrimidines (C,U,T) and C2,C6,C4 for purines (A,G) (axis 0) relative to n nucleobases (axis 1). xyz coordinates in axis 2.
+        A (m,3,n,3) array with m frames is also accepted.
 
     Returns
     -------
     lcs : (n,3,3) numpy array
-        x y z vectors defining a local coordinate system in the geometrical center of the nucleobase
+        x y z vectors defining a local coordinate system in the geometrical center of the nucleobase. (m,n,3,3) if multiple frames are given.
     origo : (n,3) numpy array 
-        origin  of local coordinate systems        
+        origin  of local coordinate systems. (m,n,3) if multiple frames are given.
     """
     
     # calculate center of mass
-    origo = np.sum(coords,axis=0)/3.0
+    origo = np.sum(coords,axis=-3)/3.0
     
     # CoM-C2 (x axis)
-    x = coords[0]-origo
-    x_norm = np.sqrt(np.sum(x*x,axis=1))
-    x = x/x_norm[:,np.newaxis]
+    x = coords[...,0,:,:]-origo
+    x_norm = np.sqrt(np.sum(x*x,axis=-1))
+    x = x/x_norm[...,np.newaxis]
     # CoM-C4/C6 
-    c = coords[1]-origo
+    c = coords[...,1,:,:]-origo
     # z/y axis
-    z = np.cross(x,c,axis=1)
-    z_norm = np.sqrt(np.sum(z*z,axis=1))
-    z = z/z_norm[:,np.newaxis]
+    z = np.cross(x,c,axis=-1)
+    z_norm = np.sqrt(np.sum(z*z,axis=-1))
+    z = z/z_norm[...,np.newaxis]
     
-    y = np.cross(z,x,axis=1)
-    lcs = np.array([x.T,y.T,z.T]).T
+    y = np.cross(z,x,axis=-1)
+    lcs = np.stack((x,y,z),axis=-1)
     return lcs, origo
 
 
+def calc_pairs(origo,max_r,min_r):
+    """
+    Find pairs of points with distance between min_r and max_r
+
+    Parameters
+    ----------
+    origo : (n,3) numpy array 
+        positions
+    max_r : float
+        maximum distance (excluded)
+    min_r : float
+        minimum distance (excluded)
+    
+    Returns
+    -------
+    m_idx : (x,2) numpy array 
+       indeces of the pairs, both (i,j) and (j,i). Pairs are sorted by first and second index.
+    """
+
+    ll = origo.shape[0]
+    if(ll<kdtree_size):
+        dmat = distance.squareform(distance.pdist(origo))
+        return np.array(np.where((dmat<max_r) & (dmat>min_r))).T
+
+    # the KD-tree search scales linearly with the number of nucleotides
+    origo = np.asarray(origo,dtype=float)
+    tree = cKDTree(origo)
+    pairs = tree.query_pairs(max_r,output_type='ndarray')
+    if(len(pairs)==0):
+        return np.zeros((0,2),dtype=int)
+    
+    # apply the same strict inequalities used on the distance matrix
+    dist = np.sqrt(np.sum((origo[pairs[:,1]]-origo[pairs[:,0]])**2,axis=1))
+    pairs = pairs[(dist<max_r) & (dist>min_r)]
+    m_idx = np.concatenate((pairs,pairs[:,::-1]))
+    m_idx = m_idx[np.lexsort((m_idx[:,1],m_idx[:,0]))]
+    return m_idx
+
+
 def calc_3dmat(coords,cutoff):
     """
     Calculate relative position of nucleobases within an ellipsoidal cutoff
@@ -78,14 +126,14 @@ def calc_3dmat(coords,cutoff):
     # prune search first
     lcs,origo= calc_lcs(coords)
     max_r  = np.max(definitions.f_factors)*cutoff
-    dmat = distance.squareform(distance.pdist(origo))
-    m_idx = np.array(np.where((dmat<max_r) & (dmat>0.01))).T
+    m_idx = calc_pairs(origo,max_r,0.01)
         
     # calculate scaled distances
     #diff = [origo[y]-origo[x] for x,y in m_idx]
     diff = origo[m_idx[:,1]]-origo[m_idx[:,0]]
     
-    dotp = np.array([np.dot(diff[i],lcs[j]) for i,j in zip(range(len(diff)),m_idx[:,0])])
+    # project on the local coordinate system of the first base
+    dotp = np.einsum('xk,xkl->xl',diff,lcs[m_idx[:,0]])
     return dotp,m_idx
 
 
@@ -151,8 +199,7 @@ def calc_mat_annotation(coords):
     cutoff_sq=2.89  # hardcoded cutoff squared  (1.7)
     # prune search first
     max_r  = np.max(definitions.f_factors)*np.sqrt(cutoff_sq)
-    dmat = distance.squareform(distance.pdist(origo))
-    m_idx = np.array(np.where((dmat<max_r) & (dmat>0.001))).T
+    m_idx = calc_pairs(origo,max_r,0.001)
     
     if(len(m_idx)==0):
         return [],[], []
@@ -160,7 +207,7 @@ def calc_mat_annotation(coords):
     # calculate scaled distances
     diff = origo[m_idx[:,1]]-origo[m_idx[:,0]]
         
-    dotp = np.array([np.dot(diff[i],lcs[j]) for i,j in zip(range(len(diff)),m_idx[:,0])])
+    dotp = np.einsum('xk,xkl->xl',diff,lcs[m_idx[:,0]])
     dotp_scale = dotp*np.array(definitions.scale)[np.newaxis,:]
     dotp_scale_norm_square = np.sum(dotp_scale**2,axis=1)
 
@@ -182,6 +229,59 @@ def calc_mat_annotation(coords):
 
     return np.array(pairs), np.array(vectors), np.array(angles)
     
+def calc_mat_annotation_traj(coords):
+
+    """
+    Calculate matrix for annotation purposes for multiple frames at once. 
+    Same as calc_mat_annotation, for all pairs in all frames.
+
+    Parameters
+    ----------
+    coords : (m,3,n,3) numpy array 
+        positions of C2,C4 and C6 atoms for pyrimidines (C,U,T) and C2,C6,C4 for purines (A,G) (axis 1) relative to n nucleobases (axis 2) in m frames (axis 0). xyz coordinates in axis 3.
+
+    Returns
+    -------
+    frames : (x) numpy array
+        frame index of each pair
+    pairs : (x,2) numpy array
+        indeces of pairs to be considered when performing the annotation. Sorted by frame and by first and second index.
+    vectors: (x,2,3) numpy array
+        position vector r_ij and r_ji 
+    angles: (x) numpy array
+       cosine of angle beween the normal vectors constructed on base i and base j
+    """
+
+    lcs,origo = calc_lcs(coords)
+    m, n = origo.shape[:2]
+
+    cutoff_sq=2.89  # hardcoded cutoff squared  (1.7)
+    # prune search first, pairs with i<j
+    max_r  = np.max(definitions.f_factors)*np.sqrt(cutoff_sq)
+    if(n<kdtree_size):
+        ii,jj = np.triu_indices(n,1)
+        dist = np.sqrt(np.sum((np.asarray(origo[:,jj],dtype=float)-origo[:,ii])**2,axis=2))
+        frames,idx = np.where((dist<max_r) & (dist>0.001))
+        pairs = np.stack((ii[idx],jj[idx]),axis=1)
+    else:
+        pairs = [calc_pairs(origo[k],max_r,0.001) for k in range(m)]
+        pairs = [pp[pp[:,0]<pp[:,1]] for pp in pairs]
+        frames = np.concatenate([np.zeros(len(pp),dtype=int)+k for k,pp in enumerate(pairs)])
+        pairs = np.concatenate(pairs).reshape(-1,2)
+
+    # scaled distances in both directions
+    diff = origo[frames,pairs[:,1]]-origo[frames,pairs[:,0]]
+    dotp_ij = np.einsum('xk,xkl->xl',diff,lcs[frames,pairs[:,0]])
+    dotp_ji = np.einsum('xk,xkl->xl',-diff,lcs[frames,pairs[:,1]])
+    scale = np.array(definitions.scale)[np.newaxis,:]
+    low = (np.sum((dotp_ij*scale)**2,axis=1)<cutoff_sq) & (np.sum((dotp_ji*scale)**2,axis=1)<cutoff_sq)
+
+    frames = frames[low]
+    pairs = pairs[low]
+    vectors = np.stack((dotp_ij[low],dotp_ji[low]),axis=1)
+    angles = np.einsum('xk,xk->x',lcs[frames,pairs[:,0],:,2],lcs[frames,pairs[:,1],:,2])
+    return frames, pairs, vectors, angles
+
 def calc_gmat(coords,cutoff):
     
     """
@@ -210,6 +310,29 @@ def calc_gmat(coords,cutoff):
     # return zero matrix when there are no contacts
     if(dotp.shape[0]==0): return mat
     
+    mat[m_idx[:,0],m_idx[:,1]] = calc_gvec(dotp,cutoff)
+    
+    return mat
+
+def calc_gvec(dotp,cutoff):
+
+    """
+    Transform relative positions into G-vectors
+
+    Parameters
+    ----------
+    dotp : (x,3) numpy array
+       xyz coordinates for each pair, as returned by calc_3dmat. The array is rescaled in place.
+
+    cutoff : float
+        ellipsoidal cutoff
+    
+    Returns
+    -------
+    gmat : (x,4) numpy array
+        G coordinates for each pair. For pairs outside the cutoff the coordinates are (0,0,0,0)
+    """
+
     dotp *= np.array(definitions.scale)[np.newaxis,:]
     dotp_norm = np.sqrt(np.sum(dotp**2,axis=1))
     
@@ -222,9 +345,279 @@ def calc_gmat(coords,cutoff):
     
     # set to zero when norm is larger than cutoff
     gmat[dotp_norm>cutoff] = 0.0
-            
-    mat[m_idx[:,0],m_idx[:,1]] = gmat
+    return gmat
+
+def calc_gmat_windows(coords,cutoff,windows):
+
+    """
+    Calculate G-vectors for many subsets of bases (windows) of the same structure.
+    G-vectors are calculated once for all pairs and the blocks of each window are gathered.
+    The result is the same as calling calc_gmat(coords[:,w],cutoff) for each window w.
+
+    Parameters
+    ----------
+    coords : (3,n,3) numpy array
+        (3,n,3) numpy array with positions of C2,C4 and C6 atoms for pyrimidines (C,U,T) and C2,C6,C4 for purines (A,G) (axis 0) relative to n nucleobases (axis 1). xyz coordinates in axis 2.
+
+    cutoff : float
+        ellipsoidal cutoff
+
+    windows : (w,l) numpy array
+        indeces of the *l* bases in each of the *w* windows
+
+    Returns
+    -------
+    gmat : (w,l*l*4) numpy array
+        flattened G-vectors of each window, equal to calc_gmat(coords[:,w],cutoff).reshape(-1)
+    """
+
+    keys,gvecs = calc_gmat_pairs(coords,cutoff)
+    return gather_gmat_windows(keys,gvecs,coords.shape[1],windows)
+
+def calc_gmat_pairs(coords,cutoff):
+
+    """
+    Calculate G-vectors for all pairs of bases within ellipsoidal cutoff distance, identified by a sorted key.
+
+    Parameters
+    ----------
+    coords : (3,n,3) numpy array
+        (3,n,3) numpy array with positions of C2,C4 and C6 atoms for pyrimidines (C,U,T) and C2,C6,C4 for purines (A,G) (axis 0) relative to n nucleobases (axis 1). xyz coordinates in axis 2.
+
+    cutoff : float
+        ellipsoidal cutoff
+
+    Returns
+    -------
+    keys : (x) numpy array
+        sorted keys i*n+j of the pairs
+    gvecs : (x,4) numpy array
+        G coordinates for each pair
+    """
+
+    ll = coords.shape[1]
+    dotp,m_idx = calc_3dmat(coords,cutoff)
+    if(dotp.shape[0]==0):
+        return np.zeros(0,dtype=int), np.zeros((0,4))
+    # pairs are sorted by first and second index, so that keys are sorted
+    return m_idx[:,0]*ll + m_idx[:,1], calc_gvec(dotp,cutoff)
+
+def gather_gmat_windows(keys,gvecs,ll,windows):
+
+    """
+    Gather the G-vectors of windows from the output of calc_gmat_pairs.
+
+    Parameters
+    ----------
+    keys : (x) numpy array
+        sorted keys of the pairs, as returned by calc_gmat_pairs
+    gvecs : (x,4) numpy array
+        G-vectors of the pairs, as returned by calc_gmat_pairs
+    ll : int
+        number of bases
+    windows : (w,l) numpy array
+        indeces of the *l* bases in each of the *w* windows
+
+    Returns
+    -------
+    gmat : (w,l*l*4) numpy array
+        flattened G-vectors of each window
+    """
+
+    windows = np.asarray(windows)
+    nw,lw = windows.shape
+    mat = np.zeros((nw,lw,lw,4))
+    if(len(keys)==0): return mat.reshape(nw,-1)
+
+    win_keys = windows[:,:,np.newaxis]*ll + windows[:,np.newaxis,:]
+    pos = np.searchsorted(keys,win_keys)
+    pos[pos==len(keys)] = 0
+    found = (keys[pos]==win_keys)
+    mat[found] = gvecs[pos[found]]
+    return mat.reshape(nw,-1)
+
+
+def calc_3dmat_traj(coords,cutoff):
+    """
+    Calculate relative position of nucleobases within an ellipsoidal cutoff for multiple frames at once
+
+    Parameters
+    ----------
+    coords : (m,3,n,3) numpy array 
+        positions of C2,C4 and C6 atoms for pyrimidines (C,U,T) and C2,C6,C4 for purines (A,G) (axis 1) relative to n nucleobases (axis 2) in m frames (axis 0). xyz coordinates in axis 3.
+
+    cutoff : float
+       ellipsoidal cutoff
     
+    Returns
+    -------
+    dotp : (x,3) numpy array
+       xyz coordinates for each pair
+
+    m_idx : (x,3) numpy array 
+       frame index and indeces of the pair
+    """
+
+    lcs,origo = calc_lcs(coords)
+    max_r  = np.max(definitions.f_factors)*cutoff
+
+    if(coords.shape[2]<kdtree_size):
+        # all pairwise differences in all frames: diff[k,i,j] = origo[k,j]-origo[k,i]
+        diff = origo[:,np.newaxis,:,:]-origo[:,:,np.newaxis,:]
+        dist_sq = np.sum(diff**2,axis=3)
+        m_idx = np.array(np.where((dist_sq<max_r**2) & (dist_sq>0.0001))).T
+    else:
+        # large structures: prune each frame with a KD-tree
+        m_idx = [calc_pairs(origo[k],max_r,0.01) for k in range(coords.shape[0])]
+        m_idx = [np.insert(m_idx[k],0,k,axis=1) for k in range(coords.shape[0])]
+        m_idx = np.concatenate(m_idx)
+        
+    # project on the local coordinate system of the first base
+    diff = origo[m_idx[:,0],m_idx[:,2]]-origo[m_idx[:,0],m_idx[:,1]]
+    dotp = np.einsum('xk,xkl->xl',diff,lcs[m_idx[:,0],m_idx[:,1]])
+    return dotp,m_idx
+
+
+def calc_gmat_traj(coords,cutoff):
+    
+    """
+    Calculate G-vectors for each pair of bases within ellipsoidal cutoff distance for multiple frames in a single vectorized pass.
+    This is equivalent, but much faster, than calling calc_gmat on each frame.
+
+    Parameters
+    ----------
+    coords : (m,3,n,3) numpy array 
+        positions of C2,C4 and C6 atoms for pyrimidines (C,U,T) and C2,C6,C4 for purines (A,G) (axis 1) relative to n nucleobases (axis 2) in m frames (axis 0). xyz coordinates in axis 3.
+
+    cutoff : float
+        ellipsoidal cutoff
+    
+    Returns
+    -------
+    dotp : (m,n,n,4) numpy array
+        G coordinates for each pair in each frame. For pairs outside the cutoff the coordinates are (0,0,0,0)
+    """
+
+    nf = coords.shape[0]
+    ll = coords.shape[2]
+    mat = np.zeros((nf,ll,ll,4))
+    
+    dotp,m_idx = calc_3dmat_traj(coords,cutoff)
+    if(dotp.shape[0]==0): return mat
+
+    mat[m_idx[:,0],m_idx[:,1],m_idx[:,2]] = calc_gvec(dotp,cutoff)
+    return mat
+
+
+def calc_gmat_sparse(coords,cutoff):
+    
+    """
+    Calculate G-vectors for multiple frames and store them in a sparse matrix.
+    Only pairs within the ellipsoidal cutoff are stored, i.e. for each frame the indeces of the pairs and their 4-vectors.
+
+    Parameters
+    ----------
+    coords : (m,3,n,3) numpy array 
+        positions of C2,C4 and C6 atoms for pyrimidines (C,U,T) and C2,C6,C4 for purines (A,G) (axis 1) relative to n nucleobases (axis 2) in m frames (axis 0). xyz coordinates in axis 3.
+
+    cutoff : float
+        ellipsoidal cutoff
+    
+    Returns
+    -------
+    gmat : (m,n*n*4) scipy.sparse.csr_matrix
+        G coordinates for each frame, flattened as in calc_gmat_traj(coords,cutoff).reshape(m,-1). 
+        The G-vector of pair (i,j) in frame k occupies columns 4*(n*i+j) to 4*(n*i+j)+3 of row k.
+    """
+
+    nf = coords.shape[0]
+    ll = coords.shape[2]
+
+    # work on blocks of frames, so that the dense intermediate arrays stay small
+    block = max(1,block_size//(ll*ll))
+    if(nf>block):
+        return sp.vstack([calc_gmat_sparse(coords[k:k+block],cutoff) for k in range(0,nf,block)],format='csr')
+    
+    dotp,m_idx = calc_3dmat_traj(coords,cutoff)
+    if(dotp.shape[0]==0):
+        return sp.csr_matrix((nf,ll*ll*4))
+    gvec = calc_gvec(dotp,cutoff).astype(float)
+
+    # remove pairs outside the ellipsoidal cutoff
+    nonzero = np.any(gvec!=0.0,axis=1)
+    gvec = gvec[nonzero]
+    m_idx = m_idx[nonzero]
+    
+    rows = np.repeat(m_idx[:,0],4)
+    cols = (4*(ll*m_idx[:,1] + m_idx[:,2])[:,np.newaxis] + np.arange(4)[np.newaxis,:]).reshape(-1)
+    return sp.csr_matrix((gvec.reshape(-1),(rows,cols)),shape=(nf,ll*ll*4))
+
+
+def calc_gdist(gvec1,gvec2):
+    """
+    Calculate Euclidean distances between flattened G-vectors. 
+    Divide by sqrt(n) to obtain the eRMSD.
+
+    Parameters
+    ----------
+    gvec1 : (m1,x) numpy array or scipy sparse matrix
+        flattened G-vectors, e.g. as returned by calc_gmat_sparse
+    gvec2 : (m2,x) numpy array or scipy sparse matrix
+        flattened G-vectors
+
+    Returns
+    -------
+    dist : (m1,m2) numpy array
+        distances between all pairs of G-vectors. 
+        For sparse matrices, only pairs that are nonzero in at least one of the two G-vectors contribute.
+    """
+
+    if(not sp.issparse(gvec1) and not sp.issparse(gvec2)):
+        return distance.cdist(gvec1,gvec2)
+
+    gvec1 = sp.csr_matrix(gvec1)
+    gvec2 = sp.csr_matrix(gvec2)
+    sq1 = np.asarray(gvec1.multiply(gvec1).sum(axis=1)).reshape(-1)
+    sq2 = np.asarray(gvec2.multiply(gvec2).sum(axis=1)).reshape(-1)
+    cross = (gvec1.dot(gvec2.T)).toarray()
+    dist_sq = sq1[:,np.newaxis] + sq2[np.newaxis,:] - 2.0*cross
+    # remove round-off errors
+    dist_sq[dist_sq<0.0] = 0.0
+    return np.sqrt(dist_sq)
+
+
+def calc_rmat_traj(coords,cutoff):
+    """
+    Calculate relative position of nucleobases for multiple frames in a single vectorized pass. 
+    This is equivalent, but much faster, than calling calc_rmat on each frame.
+
+    Parameters
+    ----------
+    coords : (m,3,n,3) numpy array 
+        positions of C2,C4 and C6 atoms for pyrimidines (C,U,T) and C2,C6,C4 for purines (A,G) (axis 1) relative to n nucleobases (axis 2) in m frames (axis 0). xyz coordinates in axis 3.
+
+    cutoff : float
+        ellipsoidal cutoff
+    
+    Returns
+    -------
+    dotp : (m,n,n,3) numpy array
+       xyz coordinates for each pair in each frame. For pairs outside the cutoff the coordinates are (0,0,0)
+    """
+
+    nf = coords.shape[0]
+    ll = coords.shape[2]
+    mat = np.zeros((nf,ll,ll,3))
+
+    dotp,m_idx = calc_3dmat_traj(coords,cutoff)
+    if(dotp.shape[0]==0): return mat
+
+    dotp_scale = dotp*np.array(definitions.scale)[np.newaxis,:]
+    dotp_norm = np.sqrt(np.sum(dotp_scale**2,axis=1))
+    dotp[dotp_norm>cutoff] = 0.0
+
+    mat[m_idx[:,0],m_idx[:,1],m_idx[:,2]] = dotp
+    # the matrix is not rescaled!
     return mat
 
 def calc_scoremat(coords,cutoff):
@@ -263,12 +656,12 @@ def dihedral(p1,p2,p3,p4):
     Parameters
     ----------
     p1,p2,p3,p4: (3) numpy array 
-        position vectors
+        position vectors. (x,3) arrays are also accepted, to calculate x angles at once.
 
     Returns
     -------
     dotp : float
-        angle in radians, range (-pi,pi)
+        angle in radians, range (-pi,pi). (x) numpy array if multiple angles are calculated.
     
     """
     
@@ -280,17 +673,139 @@ def dihedral(p1,p2,p3,p4):
     b1 = p2-p3
     b2 = p3-p4
     # norm
-    norm_sq = np.sum(b1**2)
+    norm_sq = np.sum(b1**2,axis=-1)[...,np.newaxis]
     norm_sq_inv = 1.0/norm_sq
 
     #print (np.sum(b0*b1,axis=1)*b1).shape
-    v0 = b0 - b1*((np.sum(b0*b1)*norm_sq_inv))
-    v2 = b2 - b1*((np.sum(b0*b2)*norm_sq_inv))
-    x = np.sum(v0*v2)
+    v0 = b0 - b1*((np.sum(b0*b1,axis=-1)[...,np.newaxis]*norm_sq_inv))
+    v2 = b2 - b1*((np.sum(b0*b2,axis=-1)[...,np.newaxis]*norm_sq_inv))
+    x = np.sum(v0*v2,axis=-1)
     m = np.cross(v0,b1)*np.sqrt(norm_sq_inv)
-    y = np.sum(m*v2)
+    y = np.sum(m*v2,axis=-1)
     return np.arctan2( y, x )
 
 
 
 
+
+def calc_kabsch(mobile,ref,mask=None):
+
+    """
+    Optimal rotations that superpose many structures onto reference structures (Kabsch algorithm).
+    All superpositions are calculated at once.
+
+    Parameters
+    ----------
+    mobile : (m,n,3) numpy array
+        coordinates of the n fitting atoms of m structures
+    ref : (m,n,3) or (n,3) numpy array
+        coordinates of the corresponding atoms in the reference
+    mask : (m,n) numpy array, optional
+        atoms used for each superposition. Padding atoms (False) are ignored.
+        By default all atoms are used.
+
+    Returns
+    -------
+    rot : (m,3,3) numpy array
+        rotation matrices
+    com_mobile : (m,3) numpy array
+        center of the fitting atoms of each structure
+    com_ref : (m,3) numpy array
+        center of the fitting atoms of the reference.
+        Superposed coordinates are obtained as np.dot(xyz-com_mobile,rot)+com_ref
+    """
+
+    mobile = np.asarray(mobile,dtype=float)
+    ref = np.broadcast_to(np.asarray(ref,dtype=float),mobile.shape)
+    if(mask is None):
+        weights = np.ones(mobile.shape[:2])
+    else:
+        weights = np.asarray(mask,dtype=float)
+    norm = np.sum(weights,axis=1)[:,np.newaxis]
+    com_mobile = np.einsum('mn,mnk->mk',weights,mobile)/norm
+    com_ref = np.einsum('mn,mnk->mk',weights,ref)/norm
+
+    # covariance matrix and its singular value decomposition
+    xx = (mobile-com_mobile[:,np.newaxis,:])*weights[:,:,np.newaxis]
+    yy = ref-com_ref[:,np.newaxis,:]
+    cov = np.einsum('mni,mnj->mij',xx,yy)
+    uu,ss,vt = np.linalg.svd(cov)
+
+    # avoid reflections
+    sign = np.sign(np.linalg.det(np.matmul(uu,vt)))
+    uu[:,:,2] *= sign[:,np.newaxis]
+    rot = np.matmul(uu,vt)
+    return rot, com_mobile, com_ref
+
+
+def calc_rmsd_qcp(xyz1,xyz2,tol=1.0e-10,max_iter=50):
+
+    """
+    Minimum RMSD after optimal superposition between all pairs of structures,
+    using the quaternion characteristic polynomial (QCP) method. 
+    The largest eigenvalue of the 4x4 key matrix of all pairs is found at once with Newton iterations.
+
+    Parameters
+    ----------
+    xyz1 : (m1,n,3) numpy array
+        coordinates of n atoms in m1 structures
+    xyz2 : (m2,n,3) numpy array
+        coordinates of the corresponding atoms in m2 structures
+
+    Returns
+    -------
+    rmsd : (m1,m2) numpy array
+        RMSD between all pairs of structures
+    """
+
+    xyz1 = np.asarray(xyz1,dtype=float)
+    xyz2 = np.asarray(xyz2,dtype=float)
+    m1, nn = xyz1.shape[:2]
+    m2 = xyz2.shape[0]
+    xyz1 = xyz1-np.mean(xyz1,axis=1)[:,np.newaxis,:]
+    xyz2 = xyz2-np.mean(xyz2,axis=1)[:,np.newaxis,:]
+    g1 = np.sum(xyz1**2,axis=(1,2))
+    g2 = np.sum(xyz2**2,axis=(1,2))
+    e0 = 0.5*(g1[:,np.newaxis]+g2[np.newaxis,:])
+
+    # inner product matrices of all pairs with a single matrix product, (m1,m2,3,3)
+    ss = np.dot(xyz1.transpose(0,2,1).reshape(m1*3,nn),xyz2.transpose(1,0,2).reshape(nn,m2*3))
+    ss = ss.reshape(m1,3,m2,3).transpose(0,2,1,3)
+    sxx, sxy, sxz = ss[:,:,0,0], ss[:,:,0,1], ss[:,:,0,2]
+    syx, syy, syz = ss[:,:,1,0], ss[:,:,1,1], ss[:,:,1,2]
+    szx, szy, szz = ss[:,:,2,0], ss[:,:,2,1], ss[:,:,2,2]
+
+    # traceless symmetric key matrix
+    kk = np.empty((m1,m2,4,4))
+    kk[:,:,0,0] = sxx+syy+szz
+    kk[:,:,1,1] = sxx-syy-szz
+    kk[:,:,2,2] = -sxx+syy-szz
+    kk[:,:,3,3] = -sxx-syy+szz
+    kk[:,:,0,1] = kk[:,:,1,0] = syz-szy
+    kk[:,:,0,2] = kk[:,:,2,0] = szx-sxz
+    kk[:,:,0,3] = kk[:,:,3,0] = sxy-syx
+    kk[:,:,1,2] = kk[:,:,2,1] = sxy+syx
+    kk[:,:,1,3] = kk[:,:,3,1] = szx+sxz
+    kk[:,:,2,3] = kk[:,:,3,2] = syz+szy
+
+    # characteristic polynomial x^4 + c2 x^2 + c1 x + c0
+    c2 = -0.5*np.sum(kk*kk,axis=(2,3))
+    c1 = -np.sum(np.matmul(kk,kk)*kk,axis=(2,3))/3.
+    c0 = np.linalg.det(kk)
+
+    # Newton iterations starting from the upper bound e0
+    lmax = e0.copy()
+    for it in range(max_iter):
+        l2 = lmax*lmax
+        ff = (l2 + c2)*l2 + c1*lmax + c0
+        df = 4.*l2*lmax + 2.*c2*lmax + c1
+        with np.errstate(divide='ignore',invalid='ignore'):
+            step = np.where(df!=0.0,ff/df,0.0)
+        lmax -= step
+        if(np.all(np.abs(step)<=tol*np.abs(lmax))):
+            break
+
+    rmsd_sq = 2.0*(e0-lmax)/nn
+    # remove round-off errors
+    rmsd_sq[rmsd_sq<0.0] = 0.0
+    return np.sqrt(rmsd_sq)
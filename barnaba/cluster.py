@@ -16,9 +16,26 @@ import numpy as np
 from sklearn.cluster import DBSCAN
 from sklearn import metrics
 from scipy.spatial.distance import squareform,pdist
+import scipy.sparse as sp
+
+def nonzero_columns(gvecs):
+
+    """ 
+    Return a dense copy of a sparse G-vector matrix, restricted to the columns that are nonzero in at least one frame.
+    Euclidean distances between rows are unchanged. Dense arrays are returned unchanged.
+    """
+    
+    if(not sp.issparse(gvecs)):
+        return gvecs
+    gvecs = sp.csc_matrix(gvecs)
+    cols = np.where(np.diff(gvecs.indptr)>0)[0]
+    return gvecs[:,cols].toarray()
 
 def pca(gvecs,nevecs=6,sample_weight=None):
 
+    if(sp.issparse(gvecs)):
+        return _pca_sparse(gvecs,nevecs=nevecs,sample_weight=sample_weight)
+    
     # subtract average
     data = gvecs-np.average(gvecs,axis=0,weights=sample_weight)[np.newaxis,:]       
 
@@ -38,11 +55,47 @@ def pca(gvecs,nevecs=6,sample_weight=None):
     w = np.array(w).T
     return v,w
 
+def _pca_sparse(gvecs,nevecs=6,sample_weight=None):
+
+    # the covariance is calculated only on the columns (pairs) that are nonzero
+    # in at least one frame. All other eigenvalues are zero.
+    gvecs = sp.csc_matrix(gvecs)
+    cols = np.where(np.diff(gvecs.indptr)>0)[0]
+    data = sp.csr_matrix(gvecs[:,cols])
+    
+    nf = data.shape[0]
+    if(sample_weight is None):
+        weights = np.ones(nf)
+        fact = nf - 1.0
+    else:
+        weights = np.asarray(sample_weight,dtype=float)
+        fact = np.sum(weights) - np.sum(weights**2)/np.sum(weights)
+    avg = np.asarray(data.T.dot(weights)).reshape(-1)/np.sum(weights)
+
+    # calculate covariance without building the dense data matrix
+    cov = (data.T.dot(sp.diags(weights).dot(data))).toarray()
+    cov -= np.sum(weights)*np.outer(avg,avg)
+    cov /= fact
+    
+    # diagonalize
+    vv, ww = np.linalg.eigh(cov)
+    idx2 = (np.abs(vv)).argsort()[::-1]
+    evals = vv[idx2]
+    evecs = ww[:,idx2]
+    sum_evals = np.sum(evals)
+    v = [np.sum(evals[:jj])/sum_evals for jj in range(1,len(evals)+1)]
+    v += [1.0]*(gvecs.shape[1]-len(v))
+    
+    w = data.dot(evecs[:,:nevecs]) - np.dot(avg,evecs[:,:nevecs])[np.newaxis,:]
+    return v,np.asarray(w)
+
 
 def dbscan(gvecs,labels,eps,min_samples,sample_weight=None):
 
     
     slen = np.sqrt(gvecs.shape[1]/4.)
+    if(sp.issparse(gvecs)):
+        gvecs = sp.csr_matrix(gvecs)
     #eps *=np.sqrt(slen)
     db = DBSCAN(eps=eps, min_samples=min_samples).fit(gvecs,sample_weight=sample_weight)
 
@@ -72,7 +125,7 @@ def dbscan(gvecs,labels,eps,min_samples,sample_weight=None):
     center_idx = []
     for o,ii1 in enumerate(scenters):
         
-        gvec_tmp = gvecs[cluster_members[ii1]]
+        gvec_tmp = nonzero_columns(gvecs[cluster_members[ii1]])
         dists = squareform(pdist(gvec_tmp))/np.sqrt(float(slen))
         labels_tmp = [labels[k] for k in cluster_members[ii1]]               
         dd = np.sum(dists,axis=1)
@@ -12,9 +12,9 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import absolute_import, division, print_function
-import re
 import itertools as its
 import collections
+import numpy as np
 
 tol=1.0e-06 
 purines = ["A","G"]
@@ -101,6 +101,8 @@ td_pi = 2.094395
 bb_angles = ["alpha","beta","gamma","delta","eps","zeta","chi"]
 sugar_angles = ["nu1","nu2","nu3","nu4","nu5"]
 pucker = ["phi","amp"]
+# pseudorotation phase range [start,end) in radians of sugar pucker states (Altona and Sundaralingam, JACS 1972)
+pucker_states = collections.OrderedDict([("C3'-endo",(0.0,0.2*np.pi)),("C2'-endo",(0.8*np.pi,np.pi))])
 # this mapping serves to get the correct index 
 couplings_idx = collections.OrderedDict([("H1H2",0),("H2H3",1),("H3H4",2),\
                              ("1H5P",3),("2H5P",3),("C4Pb",3),\
@@ -159,6 +161,19 @@ couplings_karplus = {\
 # Nomenclature Committee of the International Union of Biochemistry (NC-IUB).
 # Nomenclature for Incompletely Specified Bases in Nucleic Acid Sequences.
 # Recommendations 1984. Biochem. J. 143001985, 229, 281-286.
+iupac = {"A":"A","C":"C","G":"G","U":"U","T":"T",\
+         "N":"AUCGT", # aNy
+         "Y":"UCT",   # pYrimidine
+         "R":"AG",    # puRine
+         "S":"GC",    # Strong
+         "W":"AUT",   # Weak
+         "K":"GUT",   # Keto
+         "M":"AC",    # aMino
+         "B":"UCGT",  # not adenine
+         "D":"AUGT",  # not cytosine
+         "H":"AUCT",  # not guanine
+         "V":"ACG"}   # not uracil
+
 def get_pattern(query):
     # build pattern for regular expression
     pattern = "^"
@@ -166,54 +181,112 @@ def get_pattern(query):
         assert res in known_abbrev, "# Fatal error: character %s not known. Use AUCG/NYRSWKMBDHV" % (res)
         if(res in rna):
             pattern += res
-        else:
-            if(res == "N"): # aNy
-                pattern += "[AUCGT]"
-            if(res == "Y"): # pYrimidine
-                pattern += "[UCT]"
-            if(res == "R"): # puRine
-                pattern += "[AG]"
-            if(res == "S"): # Strong
-                pattern += "[GC]"
-            if(res == "W"): # Weak
-                pattern += "[AUT]"
-            if(res == "K"): # Keto
-                pattern += "[GUT]"
-            if(res == "M"): # aMino
-                pattern += "[AC]"
-            if(res == "B"): # not adenine
-                pattern += "[UCGT]"
-            if(res == "D"): # not cytosine
-                pattern += "[AUGT]"
-            if(res == "H"): # not guanine
-                pattern += "[AUCT]"
-            if(res == "V"): # not uracil
-                pattern += "[ACG]"
+        elif(res in iupac):
+            pattern += "[%s]" % iupac[res]
 
     pattern += "$"
     return pattern
 
-def get_idx(sequence,query,bulges=0):
+def get_match(sequence,query):
+
+    """
+    Match each nucleotide of *sequence* with each position of *query*.
+
+    Parameters
+    ----------
+    sequence : list
+        nucleotide types (e.g. rna_seq_id of Nucleic). DNA nucleotides (dA, dC, dG, dT) match as A, C, G, T.
+    query : string
+        sequence to search. Abbreviations (R/Y/N...) are accepted.
+
+    Returns
+    -------
+    match : (len(query),len(sequence)) numpy array
+        match[j,p] is True if nucleotide p matches position j of query
+    """
+
+    # check query
+    get_pattern(query)
+    bases = "ACGUT"
+    # integer-encoded sequence. Unknown nucleotides are encoded as len(bases) and never match
+    code = dict([(b,i) for i,b in enumerate(bases)])
+    seq = np.array([code.get(res[-1] if(len(res)==2 and res[0]=="d") else res,len(bases)) for res in sequence],dtype=int)
+    allowed = np.zeros((len(query),len(bases)+1),dtype=bool)
+    for j,res in enumerate(query):
+        allowed[j,[code[b] for b in iupac[res]]] = True
+    return allowed[:,seq]
+
+def match_windows(sequence,query,windows):
+
+    """
+    Find which windows of *sequence* match *query*
+
+    Parameters
+    ----------
+    sequence : list
+        nucleotide types
+    query : string
+        sequence to search. Abbreviations (R/Y/N...) are accepted.
+    windows : (n_windows,len(query)) numpy array
+        indeces of the nucleotides in each window, as returned by get_idx
+
+    Returns
+    -------
+    mask : (n_windows) numpy array
+        True for windows matching query
+    """
+
+    windows = np.asarray(windows,dtype=int).reshape(-1,len(query))
+    match = get_match(sequence,query)
+    return np.all(match[np.arange(len(query))[np.newaxis,:],windows],axis=1)
+
+def get_idx(sequence,query,bulges=0,chains=None,breaks=None):
+
+    """
+    Find all windows of *sequence* that match *query*, allowing for up to *bulges* inserted nucleotides.
+    Windows are ordered by number of bulges, position of the insertions and first nucleotide.
+
+    Parameters
+    ----------
+    sequence : list
+        nucleotide types (e.g. rna_seq_id of Nucleic). DNA nucleotides (dA, dC, dG, dT) match as A, C, G, T.
+    query : string
+        sequence to search. Abbreviations (R/Y/N...) are accepted.
+    bulges : int, optional
+        maximum number of inserted nucleotides
+    chains : list, optional
+        chain index of each nucleotide. If given, windows across different chains are discarded.
+    breaks : list, optional
+        True at position i if nucleotide i+1 does not follow nucleotide i (e.g. as returned by Nucleic.get_breaks).
+        If given, windows across breaks are discarded.
+
+    Returns
+    -------
+    indeces : (n_windows,len(query)) numpy array
+        indeces of the nucleotides in each window
+    """
 
     ll = len(query)
-    seq_str  = "".join(sequence)
-    pattern = get_pattern(query)
+    nn = len(sequence)
+    match = get_match(sequence,query)
 
-    # generate first all possible indeces
-    indeces = []
+    if(breaks is not None):
+        # number of breaks before each nucleotide
+        n_breaks = np.concatenate(([0],np.cumsum(breaks)))
+    indeces = [np.zeros((0,ll),dtype=int)]
     for b in range(bulges+1):
+        starts = np.arange(nn-ll-b+1)
+        if(len(starts)==0): break
+        if(chains is not None):
+            chains = np.asarray(chains)
+            starts = starts[chains[starts]==chains[starts+ll+b-1]]
+        if(breaks is not None):
+            starts = starts[n_breaks[starts+ll+b-1]==n_breaks[starts]]
 
         # create position of insertions
-        comb= its.combinations(range(1,ll+b-1),b)
-        for it1 in comb:
-            idx1 = list(range(ll+b))
-            # remove them from list
-            for it2 in it1:
-                idx1.remove(it2)
-            for start in range(len(sequence)-ll-b+1):
-                # get sequence
-                idx2 =  [idx1[i] + start for i in range(ll)]
-                substr = "".join([sequence[i] for i in idx2])
-                if(re.match(pattern,substr) != None):
-                    indeces.append(idx2)
-    return indeces
+        for it1 in its.combinations(range(1,ll+b-1),b):
+            offsets = np.array([i for i in range(ll+b) if i not in it1])
+            windows = starts[:,np.newaxis] + offsets[np.newaxis,:]
+            ok = np.all(match[np.arange(ll)[np.newaxis,:],windows],axis=1)
+            indeces.append(windows[ok])
+    return np.concatenate(indeces)
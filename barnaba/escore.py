@@ -23,6 +23,8 @@ import sys
 from . import kde
 from . import calc_mats as ff
 from . import nucleic
+from . import functions
+from . import parallel
 
 class Escore:
 
@@ -46,20 +48,25 @@ class Escore:
         warn += " using %d base-pairs" % mats.shape[1]
         sys.stderr.write(warn)
         
-    def score(self,sample,topology=None):
+    def score(self,sample,topology=None,chunk=None,n_jobs=1):
         
         """ Score """
-        if(topology==None):
-            traj = md.load(sample)
-        else:
-            traj = md.load(sample,top=topology)
+        traj = functions.load(sample,topology=topology,chunk=chunk)
         warn = "# Loaded sample %s \n" % sample
         sys.stderr.write(warn)
         
-        nn = nucleic.Nucleic(traj.topology,modified=False)
+        top, chunks = functions._chunks(traj)
+        nn = nucleic.Nucleic(top,modified=False)
         scores = []
-        for j in range(traj.n_frames):
-            coords = traj.xyz[j,nn.indeces_lcs]
-            mat = ff.calc_scoremat(coords,self.cutoff+0.2)
-            scores.append(np.sum(self.kernel(10.0*mat)))
+        for start,chunk,first,sc in parallel.map_frames(_score_block,chunks,n_jobs=n_jobs,\
+                                                       select=nn.indeces_lcs,args=(self.kernel,self.cutoff+0.2)):
+            scores.extend(sc)
         return scores
+
+def _score_block(coords,kernel,cutoff):
+
+    scores = []
+    for j in range(coords.shape[0]):
+        mat = ff.calc_scoremat(coords[j],cutoff)
+        scores.append(np.sum(kernel(10.0*mat)))
+    return scores
@@ -18,22 +18,96 @@ from builtins import range
 import sys
 import mdtraj as md
 from scipy.spatial import distance
+from scipy.spatial import cKDTree
 import itertools
+import heapq
 import numpy as np
+import scipy.sparse as sp
 import os
 from . import definitions
 from . import nucleic
 from . import calc_mats as ff
+from . import parallel
+from mdtraj.utils import in_units_of
+
+def load(filename,topology=None,chunk=None):
+
+    """
+    Load a structure or trajectory file.
+
+    Parameters
+    ----------
+    filename : string 
+         Filename of structure or trajectory, any format accepted by MDtraj can be used.
+    topology : string, optional
+         Topology filename. Must be specified if filename is a trajectory.
+    chunk : int, optional
+         If specified, the file is not loaded in memory. An iterator over trajectory chunks with *chunk* frames is returned instead (md.iterload).
+         All *_traj functions accept such an iterator in place of a trajectory, so that memory usage does not depend on trajectory length.
+    Returns
+    -------
+    traj :
+        MDtraj trajectory, or an iterator over trajectory chunks.
+    """
+
+    if(chunk!=None):
+        return md.iterload(filename,top=topology,chunk=chunk)
+    if(topology==None):
+        return md.load(filename)
+    return md.load(filename,top=topology)
+
+def _chunks(traj):
+
+    # accept either a trajectory or an iterable over trajectory chunks.
+    # return topology and an iterator over (index of first frame, chunk)
+    if(isinstance(traj,md.Trajectory)):
+        return traj.topology, iter([(0,traj)])
+
+    it = iter(traj)
+    first = next(it)
+    def gen():
+        start = 0
+        for chunk in itertools.chain([first],it):
+            yield start, chunk
+            start += chunk.n_frames
+    return first.topology, gen()
+
+def _write_frames(fh,chunk,start,n_frames=None):
+
+    # append all frames in chunk to a trajectory file opened with md.open.
+    # unit cell and time are written as in md.Trajectory.save
+    xyz = in_units_of(chunk.xyz,'nanometers',fh.distance_unit)
+    lengths = chunk.unitcell_lengths
+    if(lengths is not None):
+        lengths = in_units_of(lengths,'nanometers',fh.distance_unit)
+    if(isinstance(fh,md.formats.PDBTrajectoryFile)):
+        for k in range(chunk.n_frames):
+            model = None if(n_frames==1) else start+k
+            if(lengths is None):
+                fh.write(xyz[k],chunk.topology,modelIndex=model)
+            else:
+                fh.write(xyz[k],chunk.topology,modelIndex=model,unitcell_lengths=lengths[k],unitcell_angles=chunk.unitcell_angles[k])
+    elif(isinstance(fh,(md.formats.XTCTrajectoryFile,md.formats.TRRTrajectoryFile))):
+        box = chunk.unitcell_vectors
+        if(box is not None):
+            box = in_units_of(box,'nanometers',fh.distance_unit)
+        fh.write(xyz,time=chunk.time,step=start+np.arange(chunk.n_frames),box=box)
+    elif(isinstance(fh,md.formats.DCDTrajectoryFile)):
+        fh.write(xyz,cell_lengths=lengths,cell_angles=chunk.unitcell_angles)
+    else:
+        fh.write(xyz)
     
-def ermsd(reference,target,cutoff=2.4,topology=None):
+
+def ermsd(reference,target,cutoff=2.4,topology=None,chunk=None,n_jobs=1):
     
     """
     Calculate ermsd between reference and target structures  
 
     Parameters
     ----------
-    reference : string 
+    reference : string or list of strings
          Filename of reference structure, any format accepted by MDtraj can be used.
+         If a list of filenames or a multi-model file is given, the eRMSD from all references is calculated in a single pass over target.
     target : string 
          Filename of target structure. If a trajectory is provided, a topology file must be specified.
     topology : string, optional
@@ -41,52 +115,146 @@ def ermsd(reference,target,cutoff=2.4,topology=None):
     cutoff :  float, optional
          Cutoff for eRMSD calculation. 
          The default value of 2.4 should work in most cases. This cutoff value roughly correspond to considering pair of bases whose distance is within an ellipsoidal cutoff with axis x=y=2.4*5 = 12 Angstrom and z=2.4*3=7.2 Angstrom. Larger values of cutoff can be useful when analyzing unstructured/flexible molecules.
+    chunk : int, optional
+         Read the trajectory in chunks of *chunk* frames instead of loading it in memory.
+    n_jobs : int, optional
+         Number of processes used to analyze frames in parallel. If n_jobs < 1, all available CPUs are used.
     Returns
     -------
         array :
             eRMSD distance numpy array with dimension *m*,  the number of structures in target.
+            With multiple references, the array has dimension (m,r), where *r* is the number of references.
     
     """
 
-    ref = md.load(reference)
-    warn =  "# Loaded reference %s \n" % reference
-        
-    if(topology==None):
-        traj = md.load(target)
+    if(isinstance(reference,(list,tuple))):
+        ref = [md.load(r) for r in reference]
+        warn =  "# Loaded references %s \n" % " ".join(reference)
     else:
-        traj = md.load(target,top=topology)
+        ref = md.load(reference)
+        warn =  "# Loaded reference %s \n" % reference
+        
+    traj = load(target,topology=topology,chunk=chunk)
         
     warn += "# Loaded target %s \n" % target
     sys.stderr.write(warn)
 
-    return ermsd_traj(ref,traj,cutoff=cutoff)
+    return ermsd_traj(ref,traj,cutoff=cutoff,n_jobs=n_jobs)
+
+def _ermsd_block(coords,cutoff,ref_mat):
+
+    gmats = ff.calc_gmat_sparse(coords,cutoff)
+    return ff.calc_gdist(gmats,ref_mat)
 
-def ermsd_traj(reference,traj,cutoff=2.4):
+def ermsd_traj(reference,traj,cutoff=2.4,n_jobs=1):
     
-    top_traj = traj.topology
+    top_traj, chunks = _chunks(traj)
     # initialize nucleic class
     nn_traj = nucleic.Nucleic(top_traj)
 
-    top_ref = reference.topology
-    # initialize nucleic class
-    nn_ref = nucleic.Nucleic(top_ref)
-
-    assert(len(nn_traj.ok_residues)==len(nn_ref.ok_residues))
+    # G-vectors of all frames of all references
+    multi = isinstance(reference,(list,tuple))
+    if(not multi):
+        multi = (reference.n_frames>1)
+        reference = [reference]
+    ref_mat = []
+    for ref in reference:
+        nn_ref = nucleic.Nucleic(ref.topology)
+        assert(len(nn_traj.ok_residues)==len(nn_ref.ok_residues))
+        coords_ref = ref.xyz[:,nn_ref.indeces_lcs]
+        ref_mat.append(ff.calc_gmat_sparse(coords_ref,cutoff))
+    ref_mat = sp.vstack(ref_mat,format='csr')
     
-    coords_ref = reference.xyz[0,nn_ref.indeces_lcs]
-    ref_mat = ff.calc_gmat(coords_ref,cutoff).reshape(-1)
     #rna_seq = ["%s_%s_%s" % (res.name,res.resSeq,res.chain.index) for res in nn.ok_residues]
-    gmats = []
-    for i in range(traj.n_frames):
-        coords_lcs = traj.xyz[i,nn_traj.indeces_lcs]
-        gmats.append(ff.calc_gmat(coords_lcs,cutoff).reshape(-1))
-    dd = distance.cdist([ref_mat],gmats)/np.sqrt(len(nn_traj.ok_residues))
-    return dd[0]
+    dd = [dist for start,chunk,first,dist in parallel.map_frames(_ermsd_block,chunks,n_jobs=n_jobs,\
+                                                                 select=nn_traj.indeces_lcs,args=(cutoff,ref_mat))]
+    dd = np.concatenate(dd)/np.sqrt(len(nn_traj.ok_residues))
+    if(multi):
+        return dd
+    return dd[:,0]
+
+def ermsd_matrix(target,target2=None,topology=None,topology2=None,cutoff=2.4,max_memory=512,out=None,chunk=None,n_jobs=1):
+
+    """
+    Calculate eRMSD between all pairs of structures.
+
+    Parameters
+    ----------
+    target : string
+         Filename of structure or trajectory, any format accepted by MDtraj can be used.
+    target2 : string, optional
+         Filename of a second structure or trajectory. If specified, the eRMSD between all structures in target and all structures in target2 is calculated.
+         The number of nucleotides must be the same.
+    topology : string, optional
+         Topology filename. Must be specified if target is a trajectory.
+    topology2 : string, optional
+         Topology filename for target2. If not specified, topology is used.
+    cutoff :  float, optional
+         Cutoff for eRMSD calculation.
+         The default value of 2.4 should work in most cases. This cutoff value roughly correspond to considering pair of bases whose distance is within an ellipsoidal cutoff with axis x=y=2.4*5 = 12 Angstrom and z=2.4*3=7.2 Angstrom. Larger values of cutoff can be useful when analyzing unstructured/flexible molecules.
+    max_memory : float, optional
+         Memory (in MB) used for each block of the distance matrix. G-vectors are stored as sparse matrices and are not counted.
+    out : string, optional
+         If specified, the matrix is written block by block to a memory-mapped .npy file with this name (see numpy.lib.format.open_memmap).
+    chunk : int, optional
+         Read the trajectories in chunks of *chunk* frames instead of loading them in memory.
+    n_jobs : int, optional
+         Number of processes used to analyze frames in parallel. If n_jobs < 1, all available CPUs are used.
+    Returns
+    -------
+        array :
+            float32 numpy array (or numpy memmap) with dimension (m1,m2). *m1* and *m2* are the number of structures in target and target2 (m2=m1 if target2 is not specified).
+
+    """
+
+    traj = load(target,topology=topology,chunk=chunk)
+    warn = "# Loaded target %s \n" % target
+    traj2 = None
+    if(target2!=None):
+        if(topology2==None): topology2 = topology
+        traj2 = load(target2,topology=topology2,chunk=chunk)
+        warn += "# Loaded target %s \n" % target2
+    sys.stderr.write(warn)
+
+    return ermsd_matrix_traj(traj,traj2=traj2,cutoff=cutoff,max_memory=max_memory,out=out,n_jobs=n_jobs)
+
+def ermsd_matrix_traj(traj,traj2=None,cutoff=2.4,max_memory=512,out=None,n_jobs=1):
+
+    gvecs1, seq1 = dump_gvec_traj(traj,cutoff=cutoff,sparse=True,n_jobs=n_jobs)
+    if(traj2 is None):
+        gvecs2 = gvecs1
+    else:
+        gvecs2, seq2 = dump_gvec_traj(traj2,cutoff=cutoff,sparse=True,n_jobs=n_jobs)
+        assert(len(seq1)==len(seq2))
+    norm = np.sqrt(len(seq1))
+    n1 = gvecs1.shape[0]
+    n2 = gvecs2.shape[0]
+
+    if(out==None):
+        dmat = np.zeros((n1,n2),dtype=np.float32)
+    else:
+        dmat = np.lib.format.open_memmap(out,mode='w+',dtype=np.float32,shape=(n1,n2))
+
+    # block size: calc_gdist allocates ~4 dense (bsize,bsize) arrays in double precision
+    bsize = max(1,int(np.sqrt(max_memory*2**20/32.)))
+    for i in range(0,n1,bsize):
+        # only upper triangle for symmetric matrix
+        j0 = i if(traj2 is None) else 0
+        for j in range(j0,n2,bsize):
+            block = ff.calc_gdist(gvecs1[i:i+bsize],gvecs2[j:j+bsize])/norm
+            dmat[i:i+bsize,j:j+bsize] = block
+            if(traj2 is None and j!=i):
+                dmat[j:j+bsize,i:i+bsize] = block.T
+    if(traj2 is None):
+        np.fill_diagonal(dmat,0.0)
+    if(out!=None):
+        dmat.flush()
+    return dmat
 
 ############## ERMSD ###############
 
 
-def dump_rvec(filename,topology=None,cutoff=2.4):
+def dump_rvec(filename,topology=None,cutoff=2.4,chunk=None,n_jobs=1):
     """
     Calculate relative position of pair of nucleobases within ellipsoidal cutoff
 
@@ -99,6 +267,10 @@ def dump_rvec(filename,topology=None,cutoff=2.4):
     cutoff :  float, optional
          Cutoff for eRMSD calculation. 
          This cutoff value roughly correspond to considering pair of bases whose distance is within an ellipsoidal cutoff with axis x=y=2.4*5 = 12 Angstrom and z=2.4*3=7.2 Angstrom. Larger values of cutoff can be useful when analyzing unstructured/flexible molecules.
+    chunk : int, optional
+         Read the trajectory in chunks of *chunk* frames instead of loading it in memory.
+    n_jobs : int, optional
+         Number of processes used to analyze frames in parallel. If n_jobs < 1, all available CPUs are used.
     Returns
     -------
     rmat :
@@ -108,29 +280,23 @@ def dump_rvec(filename,topology=None,cutoff=2.4):
 
     """
 
-    if(topology==None):
-        traj = md.load(filename)
-    else:
-        traj = md.load(filename,top=topology)
+    traj = load(filename,topology=topology,chunk=chunk)
 
     warn = "# Loading %s \n" % filename
     sys.stderr.write(warn)
-    return  dump_rvec_traj(traj,cutoff=cutoff)
+    return  dump_rvec_traj(traj,cutoff=cutoff,n_jobs=n_jobs)
 
-def dump_rvec_traj(traj,cutoff=2.4):
+def dump_rvec_traj(traj,cutoff=2.4,n_jobs=1):
         
-    top = traj.topology
+    top, chunks = _chunks(traj)
     nn = nucleic.Nucleic(top)
-    rvecs = []
-    for i in range(traj.n_frames):
-        coords_lcs = traj.xyz[i,nn.indeces_lcs]
-        rvecs.append(ff.calc_rmat(coords_lcs,cutoff))
-        
-    return np.asarray(rvecs), nn.rna_seq
+    rvecs = [rvec for start,chunk,first,rvec in parallel.map_frames(ff.calc_rmat_traj,chunks,n_jobs=n_jobs,\
+                                                                   select=nn.indeces_lcs,args=(cutoff,))]
+    return np.concatenate(rvecs), nn.rna_seq
 
 ###############################################
 
-def dump_gvec(filename,topology=None,cutoff=2.4):
+def dump_gvec(filename,topology=None,cutoff=2.4,sparse=False,chunk=None,n_jobs=1):
     
     """
     Calculate relative position of pair of nucleobases within ellipsoidal cutoff
@@ -144,39 +310,45 @@ def dump_gvec(filename,topology=None,cutoff=2.4):
     cutoff :  float, optional
          Cutoff for eRMSD calculation. 
          This cutoff value roughly correspond to considering pair of bases whose distance is within an ellipsoidal cutoff with axis x=y=2.4*5 = 12 Angstrom and z=2.4*3=7.2 Angstrom. Larger values of cutoff can be useful when analyzing unstructured/flexible molecules.
+    sparse : bool, optional
+         If True, G-vectors are returned as a scipy.sparse.csr_matrix with dimension (m,n*n*4) that only stores pairs within the cutoff. 
+         The sparse matrix can be used in place of the reshaped dense array in cluster.pca and cluster.dbscan.
+    chunk : int, optional
+         Read the trajectory in chunks of *chunk* frames instead of loading it in memory.
+    n_jobs : int, optional
+         Number of processes used to analyze frames in parallel. If n_jobs < 1, all available CPUs are used.
     Returns
     -------
     gmat :
-        Numpy array with dimension (m,n,n,4). *m* is the number of structures in target, *n* is the number of nucleotides. As an example, the position of base 10 in the reference system of base 9 in the fourth frame is given by v = rmat[3,8,9], where v is a 4-dimensional vector
+        Numpy array with dimension (m,n,n,4). *m* is the number of structures in target, *n* is the number of nucleotides. As an example, the position of base 10 in the reference system of base 9 in the fourth frame is given by v = rmat[3,8,9], where v is a 4-dimensional vector.
+        If sparse=True, a sparse matrix equal to gmat.reshape(m,-1).
     seq : 
         List of residue names. Each residue is identified with the string RESNAME_RESNUMBER_CHAININDEX
        
 
     """
     
-    if(topology==None):
-        traj = md.load(filename)
-    else:
-        traj = md.load(filename,top=topology)
+    traj = load(filename,topology=topology,chunk=chunk)
 
     warn = "# Loading %s \n" % filename
     sys.stderr.write(warn)
-    return dump_gvec_traj(traj,cutoff=cutoff)
+    return dump_gvec_traj(traj,cutoff=cutoff,sparse=sparse,n_jobs=n_jobs)
 
-def dump_gvec_traj(traj,cutoff=2.4):
+def dump_gvec_traj(traj,cutoff=2.4,sparse=False,n_jobs=1):
         
-    top = traj.topology
+    top, chunks = _chunks(traj)
     nn = nucleic.Nucleic(top)
-    gvecs = []
-    for i in range(traj.n_frames):
-        coords_lcs = traj.xyz[i,nn.indeces_lcs]
-        gvecs.append(ff.calc_gmat(coords_lcs,cutoff))
-    return np.asarray(gvecs), nn.rna_seq
+    kernel = ff.calc_gmat_sparse if(sparse) else ff.calc_gmat_traj
+    gvecs = [gvec for start,chunk,first,gvec in parallel.map_frames(kernel,chunks,n_jobs=n_jobs,\
+                                                                   select=nn.indeces_lcs,args=(cutoff,))]
+    if(sparse):
+        return sp.vstack(gvecs,format='csr'), nn.rna_seq
+    return np.concatenate(gvecs), nn.rna_seq
 
 #################################################
 
 
-def rmsd(reference,target,topology=None,out=None):
+def rmsd(reference,target,topology=None,out=None,chunk=None):
     
     """
     Calculate rmsd after optimal alignment between reference and target structures. Superposition and RMSD calculations are performed using all heavy atoms. 
@@ -186,12 +358,16 @@ def rmsd(reference,target,topology=None,out=None):
     ----------
     reference : string 
          Filename of reference structure, any format accepted by MDtraj can be used.
-    target : string 
+    target : string or list
          Filename of target structure. If a trajectory is provided, a topology file must be specified.
+         If a list of filenames is given (e.g. decoys), structures with the same topology are superposed together in a single call.
     topology : string, optional
          Topology filename. Must be specified if target is a trajectory.
     out :  string, optional
          If a string is specified, superimposed PDB structures are written to disk with the specified prefix.
+         If target is a list, the structures are written to *out*_000000.pdb, *out*_000001.pdb, etc.
+    chunk : int, optional
+         Read the trajectory in chunks of *chunk* frames instead of loading it in memory.
     Returns
     -------
     array :
@@ -201,76 +377,332 @@ def rmsd(reference,target,topology=None,out=None):
 
     ref = md.load(reference)
     warn =  "# Loaded reference %s \n" % reference
-        
-    if(topology==None):
-        traj = md.load(target)
-    else:
-        traj = md.load(target,top=topology)
+
+    if(isinstance(target,(list,tuple))):
+        return _rmsd_files(ref,target,topology=topology,out=out)
+
+    traj = load(target,topology=topology,chunk=chunk)
     warn += "# Loaded target %s \n" % target
 
     return rmsd_traj(ref,traj,out=out)
 
+def _rmsd_files(reference,targets,topology=None,out=None):
+
+    # targets with the same topology are stacked and superposed together.
+    # Files are read one at a time, and each group is flushed when it reaches _rmsd_files_block frames
+    groups = {}
+    rmsd = [None]*len(targets)
+    for k,target in enumerate(targets):
+        traj = md.load(target) if(topology==None) else md.load(target,top=topology)
+        key = (_topology_signature(traj.topology),traj.unitcell_lengths is None)
+        if(key not in groups):
+            idx_ref, idx_target = _rmsd_atoms(reference.topology,traj.topology)
+            sys.stderr.write("# found %d atoms in common\n" % len(idx_ref))
+            groups[key] = (idx_ref,idx_target,[],[])
+        idx_ref,idx_target,idx,trajs = groups[key]
+        idx.append(k)
+        trajs.append(traj)
+        if(sum([tt.n_frames for tt in trajs])>=_rmsd_files_block):
+            _rmsd_stack(reference,groups[key],rmsd,out)
+    for group in groups.values():
+        _rmsd_stack(reference,group,rmsd,out)
+    return np.concatenate(rmsd)
+
+def _rmsd_stack(reference,group,rmsd,out):
+
+    # RMSD of the structures collected in group, which is then emptied
+    idx_ref,idx_target,idx,trajs = group
+    if(len(trajs)==0): return
+    stack = md.join(trajs,check_topology=False)
+    dd = ff.calc_rmsd_qcp(stack.xyz[:,idx_target],reference.xyz[:1,idx_ref])[:,0]
+    if(out!=None):
+        stack.superpose(reference,atom_indices=idx_target, ref_atom_indices=idx_ref)
+    start = 0
+    for k,traj in zip(idx,trajs):
+        stop = start + traj.n_frames
+        rmsd[k] = dd[start:stop]
+        if(out!=None):
+            stack[start:stop].save("%s_%06d.pdb" % (out,k))
+        start = stop
+    del idx[:], trajs[:]
+
+def _topology_signature(topology):
+
+    # residue and atom names determine the atoms used for the RMSD
+    return tuple([(res.name,res.chain.index,tuple([at.name for at in res.atoms])) for res in topology.residues])
+
+# atoms used for the RMSD for pairs of topology objects (reference,target)
+_rmsd_atoms_cache = {}
+_rmsd_atoms_cache_size = 64
+# number of frames copied and superposed at a time when writing aligned structures
+_superpose_block = 1000
+# number of frames of structures with the same topology superposed in a single call
+_rmsd_files_block = 1000
+
+def _rmsd_atoms(top_ref,top_traj):
+
+    # the cache holds the topologies, so that their ids cannot be reused by other objects
+    key = (id(top_ref),id(top_traj))
+    if(key in _rmsd_atoms_cache):
+        return _rmsd_atoms_cache[key][2:]
 
-def rmsd_traj(reference,traj,out=None):
-    
-    top_traj = traj.topology
     # initialize nucleic class
     nn_traj = nucleic.Nucleic(top_traj)
-
-    top_ref = reference.topology
-    # initialize nucleic class
     nn_ref = nucleic.Nucleic(top_ref)
     assert(len(nn_traj.ok_residues)==len(nn_ref.ok_residues))
 
     # loop over residues and find common heavy atoms
     idx_ref = []
     idx_target = []
-    
     for ii in range(len(nn_ref.ok_residues)):
         
         res1 = nn_ref.ok_residues[ii]
         res2 = nn_traj.ok_residues[ii]
 
-        resname1 = nn_ref.rna_seq_id[ii]
-        resname2 = nn_traj.rna_seq_id[ii]
-        
-        # if the nucleotide is the same, use all atoms
+        # if the nucleotide is the same, use all atoms, else use bb only
         if(res1.name == res2.name):
-            
-            name2 = [at.name for at in res2.atoms if  at.name in definitions.nt_atoms[resname2]]
-            #name1 = [at.name for at in res1.atoms if  at.name in definitions.nb_atoms[res1.name]]
-            #print name2,name1
-            for at in res1.atoms:
-                if at.name in definitions.nt_atoms[resname1]:
-                    if(at.name in name2):
-                        #print at.name
-                        idx_ref.append(at.index)
-                        idx_target.append(((res2.atom(at.name)).index))
-        # else, use bb only
+            names1 = definitions.nt_atoms[nn_ref.rna_seq_id[ii]]
+            names2 = definitions.nt_atoms[nn_traj.rna_seq_id[ii]]
         else:
-            name2 = [at.name for at in res2.atoms if  at.name in definitions.bb_atoms]
-            for at in res1.atoms:
-                if at.name in definitions.bb_atoms:
-                    if(at.name in name2):
-                        idx_ref.append(at.index)
-                        idx_target.append(((res2.atom(at.name)).index))
-            
-    print("# found ",len(idx_ref), "atoms in common")
+            names1 = names2 = definitions.bb_atoms
+
+        name2 = {}
+        for at in res2.atoms:
+            if(at.name in names2): name2.setdefault(at.name,at.index)
+        for at in res1.atoms:
+            if(at.name in names1 and at.name in name2):
+                idx_ref.append(at.index)
+                idx_target.append(name2[at.name])
     
     if(len(idx_ref)<3):
         warn =  "# Only  %d atoms in common. abort.\n" % len(idx_ref)
         sys.stderr.write(warn)
         sys.exit(1)
-        
-    traj.superpose(reference,atom_indices=idx_target, ref_atom_indices=idx_ref)
+
+    # cached arrays are shared by all callers and cannot be modified
+    idx_ref = np.array(idx_ref)
+    idx_target = np.array(idx_target)
+    idx_ref.flags.writeable = False
+    idx_target.flags.writeable = False
+    if(len(_rmsd_atoms_cache)>=_rmsd_atoms_cache_size):
+        _rmsd_atoms_cache.clear()
+    _rmsd_atoms_cache[key] = (top_ref,top_traj,idx_ref,idx_target)
+    return idx_ref, idx_target
+
+def rmsd_traj(reference,traj,out=None):
+    
+    top_traj, chunks = _chunks(traj)
+    idx_ref, idx_target = _rmsd_atoms(reference.topology,top_traj)
+    sys.stderr.write("# found %d atoms in common\n" % len(idx_ref))
+    xyz_ref = reference.xyz[:1,idx_ref]
+
+    # the RMSD is calculated on the fitting atoms only and traj is not modified.
+    # All atoms are superposed only to write the aligned structures, a block of frames at a time
+    fh = None
     if(out!=None):
-        traj.save(out)
-    rmsd = np.sqrt(3*np.mean((traj.xyz[:, idx_target, :] - reference.xyz[0,idx_ref, :])**2, axis=(1,2)))
-    return rmsd
+        fh = md.open(out,'w')
+        n_frames = traj.n_frames if(isinstance(traj,md.Trajectory)) else None
+    rmsd = []
+    for start,chunk in chunks:
+        rmsd.append(ff.calc_rmsd_qcp(chunk.xyz[:,idx_target],xyz_ref)[:,0])
+        if(fh==None): continue
+        for k in range(0,chunk.n_frames,_superpose_block):
+            block = chunk[k:k+_superpose_block]
+            block.superpose(reference,atom_indices=idx_target, ref_atom_indices=idx_ref)
+            _write_frames(fh,block,start+k,n_frames)
+    if(fh!=None):
+        fh.close()
+    return np.concatenate(rmsd)
+
+def rmsd_matrix(target,target2=None,topology=None,topology2=None,max_memory=512,out=None,chunk=None,n_jobs=1):
 
-########################################################
+    """
+    Calculate RMSD after optimal alignment between all pairs of structures. 
+    The same heavy atoms as in rmsd are used. Structures are not modified.
+
+    Parameters
+    ----------
+    target : string
+         Filename of structure or trajectory, any format accepted by MDtraj can be used.
+    target2 : string, optional
+         Filename of a second structure or trajectory. If specified, the RMSD between all structures in target and all structures in target2 is calculated.
+         The number of nucleotides must be the same.
+    topology : string, optional
+         Topology filename. Must be specified if target is a trajectory.
+    topology2 : string, optional
+         Topology filename for target2. If not specified, topology is used.
+    max_memory : float, optional
+         Memory (in MB) used for each block of the distance matrix.
+    out : string, optional
+         If specified, the matrix is written block by block to a memory-mapped .npy file with this name (see numpy.lib.format.open_memmap).
+    chunk : int, optional
+         Read the trajectories in chunks of *chunk* frames instead of loading them in memory.
+    n_jobs : int, optional
+         Number of processes used to calculate blocks in parallel. If n_jobs < 1, all available CPUs are used.
+    Returns
+    -------
+        array :
+            float32 numpy array (or numpy memmap) with dimension (m1,m2), RMSD in nm. *m1* and *m2* are the number of structures in target and target2 (m2=m1 if target2 is not specified).
+
+    """
+
+    traj = load(target,topology=topology,chunk=chunk)
+    warn = "# Loaded target %s \n" % target
+    traj2 = None
+    if(target2!=None):
+        if(topology2==None): topology2 = topology
+        traj2 = load(target2,topology=topology2,chunk=chunk)
+        warn += "# Loaded target %s \n" % target2
+    sys.stderr.write(warn)
+
+    return rmsd_matrix_traj(traj,traj2=traj2,max_memory=max_memory,out=out,n_jobs=n_jobs)
+
+def _fit_coords(chunks,idx):
 
-def backbone_angles(filename,topology=None,residues=None,angles=None):
+    # coordinates of the fitting atoms of all frames
+    return np.concatenate([chunk.xyz[:,idx] for start,chunk in chunks])
+
+def rmsd_matrix_traj(traj,traj2=None,max_memory=512,out=None,n_jobs=1):
+
+    top, chunks = _chunks(traj)
+    if(traj2 is None):
+        idx1, idx = _rmsd_atoms(top,top)
+        xyz = _fit_coords(chunks,idx)
+        n1 = n2 = xyz.shape[0]
+        # offset of the second set of structures in xyz
+        off = 0
+    else:
+        top2, chunks2 = _chunks(traj2)
+        idx2, idx1 = _rmsd_atoms(top2,top)
+        xyz1 = _fit_coords(chunks,idx1)
+        xyz2 = _fit_coords(chunks2,idx2)
+        n1, n2 = xyz1.shape[0], xyz2.shape[0]
+        xyz = np.concatenate([xyz1,xyz2])
+        off = n1
+
+    if(out==None):
+        dmat = np.zeros((n1,n2),dtype=np.float32)
+    else:
+        dmat = np.lib.format.open_memmap(out,mode='w+',dtype=np.float32,shape=(n1,n2))
+
+    # block size: calc_rmsd_qcp allocates ~6 (bsize,bsize,4,4) arrays in double precision
+    bsize = max(1,int(np.sqrt(max_memory*2**20/768.)))
+    tiles = []
+    for i in range(0,n1,bsize):
+        # only upper triangle for symmetric matrix
+        j0 = i if(traj2 is None) else 0
+        for j in range(j0,n2,bsize):
+            tiles.append((i,min(i+bsize,n1),off+j,off+min(j+bsize,n2)))
+
+    for (i0,i1,j0,j1),block in parallel.map_tiles(ff.calc_rmsd_qcp,xyz,tiles,n_jobs=n_jobs):
+        dmat[i0:i1,j0-off:j1-off] = block
+        if(traj2 is None and j0!=i0):
+            dmat[j0:j1,i0:i1] = block.T
+    if(traj2 is None):
+        np.fill_diagonal(dmat,0.0)
+    if(out!=None):
+        dmat.flush()
+    return dmat
+
+def _iter_dihedrals(chunks,idxs):
+
+    # torsion angles for a list of (n,q,4) arrays of atom indeces, chunk by chunk.
+    # quadruplets shared between arrays are calculated once. Missing quadruplets (all zeros) are set to NaN
+    quads = np.concatenate([ii.reshape(-1,4) for ii in idxs])
+    ok = np.where(np.sum(quads,axis=1)!=0)[0]
+    uniq, inv = np.unique(quads[ok],axis=0,return_inverse=True)
+    inv = inv.reshape(-1)
+    for start,chunk in chunks:
+        torsions = np.full((chunk.n_frames,len(quads)),np.nan,dtype=np.float32)
+        if(len(uniq)>0):
+            torsions[:,ok] = md.compute_dihedrals(chunk,uniq,opt=True)[:,inv]
+        out = []
+        first = 0
+        for ii in idxs:
+            last = first + ii.shape[0]*ii.shape[1]
+            out.append(torsions[:,first:last].reshape((chunk.n_frames,ii.shape[0],ii.shape[1])))
+            first = last
+        yield start, chunk, out
+
+def _dihedrals(chunks,idxs):
+
+    # same as _iter_dihedrals, for all frames
+    out = [vals for start,chunk,vals in _iter_dihedrals(chunks,idxs)]
+    return [np.concatenate([vals[k] for vals in out]) for k in range(len(idxs))]
+
+def torsions(filename,topology=None,residues=None,backbone=False,sugar=False,pucker=False,couplings=False,chunk=None):
+
+    """
+    Calculate backbone, sugar and pucker angles and 3J scalar couplings, reading the structure or trajectory only once.
+    All torsion angles are calculated in a single pass, and the same quadruplet of atoms is never calculated twice.
+
+    Parameters
+    ----------
+    filename : string 
+         Filename of structure, any format accepted by MDtraj can be used.
+    topology : string, optional
+         Topology filename. Must be specified if target is a trajectory.
+    residues :  list, optional
+         If a list of residues is specified, only the selected residues will be calculated. Otherwise, the calculation is performed for all residues.
+         The residue naming convention is RESNAME_RESNUMBER_CHAININDEX
+    backbone : bool, optional
+         calculate backbone and glycosidic angles, as in backbone_angles
+    sugar : bool, optional
+         calculate sugar torsion angles, as in sugar_angles
+    pucker : bool, optional
+         calculate pucker phase and amplitude, as in pucker_angles
+    couplings : bool, optional
+         calculate all 3J scalar couplings, as in jcouplings
+    chunk : int, optional
+         Read the trajectory in chunks of *chunk* frames instead of loading it in memory.
+
+    Returns
+    -------
+    dict :
+        Numpy arrays with dimension (m,n,q) for the keys "backbone", "sugar", "pucker" and "couplings" that were requested. 
+    seq : 
+        List of residue names. Each residue is identified with the string RESNAME_RESNUMBER_CHAININDEX
+
+    """
+
+    traj = load(filename,topology=topology,chunk=chunk)
+    warn = "# Loading %s \n" % filename
+    sys.stderr.write(warn)
+    return torsions_traj(traj,residues=residues,backbone=backbone,sugar=sugar,pucker=pucker,couplings=couplings)
+
+def torsions_traj(traj,residues=None,backbone=False,sugar=False,pucker=False,couplings=False):
+
+    assert backbone or sugar or pucker or couplings, "# choose at least one of backbone/sugar/pucker/couplings"
+    top, chunks = _chunks(traj)
+    # initialize nucleic class
+    nn = nucleic.Nucleic(top)
+
+    names = []
+    idxs = []
+    if(backbone):
+        all_idx,rr = nn.get_bb_torsion_idx(residues)
+        names.append("backbone")
+        idxs.append(all_idx)
+    if(sugar or pucker):
+        all_idx,rr = nn.get_sugar_torsion_idx(residues)
+        names.append("sugar")
+        idxs.append(all_idx)
+    if(couplings):
+        all_idx,rr = nn.get_coupling_idx(residues)
+        names.append("couplings")
+        idxs.append(all_idx)
+
+    angles = dict(zip(names,_dihedrals(chunks,idxs)))
+    if(pucker):
+        angles["pucker"] = _pucker(angles["sugar"])
+        if(not sugar):
+            del angles["sugar"]
+    if(couplings):
+        names = [str(el) for el in definitions.couplings_idx.keys()]
+        angles["couplings"] = _karplus(angles["couplings"],names,list(definitions.couplings_idx.values()))
+    return angles, rr
+
+def backbone_angles(filename,topology=None,residues=None,angles=None,chunk=None):
 
     """
     Calculate backbone ([alpha,beta,gamma,delta,espilon,zeta]) and glycosydic (chi) torsion angles.
@@ -287,6 +719,8 @@ def backbone_angles(filename,topology=None,residues=None,angles=None):
     angles : list, optional
          If a list of angles is specified, only the selected angles will be calculated. 
          Otherwise, the calculation is performed for all torsion angles. 
+    chunk : int, optional
+         Read the trajectory in chunks of *chunk* frames instead of loading it in memory.
     Returns
     -------
     array :
@@ -296,17 +730,14 @@ def backbone_angles(filename,topology=None,residues=None,angles=None):
 
     """
     
-    if(topology==None):
-        traj = md.load(filename)
-    else:
-        traj = md.load(filename,top=topology)
+    traj = load(filename,topology=topology,chunk=chunk)
     warn = "# Loading %s \n" % filename
     sys.stderr.write(warn)
     return backbone_angles_traj(traj,residues=residues,angles=angles)
 
 def backbone_angles_traj(traj,residues=None,angles=None):
     
-    top = traj.topology
+    top, chunks = _chunks(traj)
     # initialize nucleic class
     nn = nucleic.Nucleic(top)
     all_idx,rr =  nn.get_bb_torsion_idx(residues)
@@ -326,20 +757,11 @@ def backbone_angles_traj(traj,residues=None,angles=None):
                 sys.exit(1)
    
 
-    idxs = (all_idx[:,idx_angles,:]).reshape(-1,4)
-    missing = np.where(np.sum(idxs,axis=1)==0)
-    
-    torsions = md.compute_dihedrals(traj,idxs,opt=True)
-    
-    # set to NaN where atoms are missing
-    torsions[:,np.where(np.sum(idxs,axis=1)==0)[0]] = np.nan
-    
-    torsions = torsions.reshape((traj.n_frames,all_idx.shape[0],len(idx_angles)))
-    
+    torsions = _dihedrals(chunks,[all_idx[:,idx_angles,:]])[0]
     return torsions, rr
 ########################################################
     
-def sugar_angles(filename,topology=None,residues=None,angles=None):
+def sugar_angles(filename,topology=None,residues=None,angles=None,chunk=None):
     
     """
     Calculate sugar [nu1,nu2,nu3,nu4,nu5] torsion angles.
@@ -356,6 +778,8 @@ def sugar_angles(filename,topology=None,residues=None,angles=None):
     angles : list, optional
          If a list of angles is specified, only the selected angles will be calculated. 
          Otherwise, the calculation is performed for all torsion angles. 
+    chunk : int, optional
+         Read the trajectory in chunks of *chunk* frames instead of loading it in memory.
 
     Returns
     -------
@@ -366,17 +790,14 @@ def sugar_angles(filename,topology=None,residues=None,angles=None):
 
     """
 
-    if(topology==None):
-        traj = md.load(filename)
-    else:
-        traj = md.load(filename,top=topology)
+    traj = load(filename,topology=topology,chunk=chunk)
     warn = "# Loading %s \n" % filename
     sys.stderr.write(warn)
     return sugar_angles_traj(traj,residues=residues,angles=angles)
 
 def sugar_angles_traj(traj,residues=None,angles=None):
     
-    top = traj.topology
+    top, chunks = _chunks(traj)
     # initialize nucleic class
     nn = nucleic.Nucleic(top)
     all_idx,rr =  nn.get_sugar_torsion_idx(residues)
@@ -394,19 +815,12 @@ def sugar_angles_traj(traj,residues=None,angles=None):
                 sys.stderr.write(msg)
                 sys.exit(1)
 
-    idxs = (all_idx[:,idx_angles,:]).reshape(-1,4)
-    missing = np.where(np.sum(idxs,axis=1)==0)
-
-    torsions = md.compute_dihedrals(traj,idxs,opt=True)
-    # set to NaN where atoms are missing
-    torsions[:,missing[0]] = np.nan
-    torsions = torsions.reshape((traj.n_frames,all_idx.shape[0],len(idx_angles)))
-
+    torsions = _dihedrals(chunks,[all_idx[:,idx_angles,:]])[0]
     return torsions, rr
 
 #############################################################
 
-def pucker_angles(filename,topology=None,residues=None):
+def pucker_angles(filename,topology=None,residues=None,chunk=None):
     
     """
     Calculate sugar pucker pseudorotation  torsion angles: phase and amplitude
@@ -420,6 +834,8 @@ def pucker_angles(filename,topology=None,residues=None):
     residues :  list, optional
          If a list of residues is specified, only the selected residues will be calculated. Otherwise, the calculation is performed for all residues.
          The residue naming convention is RESNAME_RESNUMBER_CHAININDEX
+    chunk : int, optional
+         Read the trajectory in chunks of *chunk* frames instead of loading it in memory.
     Returns
     -------
     array :
@@ -429,10 +845,7 @@ def pucker_angles(filename,topology=None,residues=None):
 
     """
 
-    if(topology==None):
-        traj = md.load(filename)
-    else:
-        traj = md.load(filename,top=topology)
+    traj = load(filename,topology=topology,chunk=chunk)
     warn = "# Loading %s \n" % filename
     sys.stderr.write(warn)
     return pucker_angles_traj(traj,residues=residues)
@@ -440,19 +853,24 @@ def pucker_angles(filename,topology=None,residues=None):
 def pucker_angles_traj(traj,residues=None):
 
     torsions,rr = sugar_angles_traj(traj,residues=residues)
+    return _pucker(torsions), rr
+
+def _pucker(torsions):
+
+    # phase and amplitude from the five sugar torsion angles
     x1 = torsions[:,:,4] +  torsions[:,:,1] -  torsions[:,:,3] -   torsions[:,:,0]
     x2 = 3.0776835*torsions[:,:,2]
     phase = np.arctan2(x1,x2)
     phase[np.where(phase<0.0)] += 2.0*np.pi
     tm = torsions[:,:,2]/np.cos(phase)
     angles = np.dstack((phase,tm))
-    return angles, rr
+    return angles
 
 ################################################################
 
 ################################################################
 
-def jcouplings(filename,topology=None,residues=None,couplings=None,raw=False):
+def jcouplings(filename,topology=None,residues=None,couplings=None,raw=False,average=False,weights=None,chunk=None):
     
     """
     Calculate 3J scalar couplings from structure using the Karplus equations.
@@ -472,27 +890,31 @@ def jcouplings(filename,topology=None,residues=None,couplings=None,raw=False):
          Otherwise, the calculation is performed for all of them. 
     raw: bool, optional
          raw values of the angles are returned. 
+    average: bool, optional
+         ensemble averages of the couplings are returned. Together with chunk, the couplings of all frames are never stored in memory.
+    weights: array, optional
+         weight of each frame in the average. By default all frames have the same weight.
+    chunk : int, optional
+         Read the trajectory in chunks of *chunk* frames instead of loading it in memory.
 
     Returns
     -------
     array :
          Scalar couplings in Hz. A Numpy array with dimension (m,n,q) is returned. *m* is the number of structures in target, *n* is the number of residues and *q* is the number of couplings. If raw = True, a (m,n,5) array is returned with the values of the torsion angles used for the calculation.
+         If average = True, a (n,q) array with the averages over all structures is returned.
     seq : 
         List of residue names. Each residue is identified with the string RESNAME_RESNUMBER_CHAININDEX
 
     """
 
-    if(topology==None):
-        traj = md.load(filename)
-    else:
-        traj = md.load(filename,top=topology)
+    traj = load(filename,topology=topology,chunk=chunk)
     warn = "# Loading %s \n" % filename
     sys.stderr.write(warn)
-    return jcouplings_traj(traj,residues=residues,couplings=couplings,raw=raw)
+    return jcouplings_traj(traj,residues=residues,couplings=couplings,raw=raw,average=average,weights=weights)
 
-def jcouplings_traj(traj,residues=None,couplings=None,raw=False):
+def jcouplings_traj(traj,residues=None,couplings=None,raw=False,average=False,weights=None):
     
-    top = traj.topology
+    top, chunks = _chunks(traj)
     # initialize nucleic class
     nn = nucleic.Nucleic(top)
     all_idx,rr =nn.get_coupling_idx(residues)
@@ -511,106 +933,349 @@ def jcouplings_traj(traj,residues=None,couplings=None,raw=False):
                 idx_angles1.append(i)
             else:
                 msg = "# Fatal error. requested coupling \"%s\" not available.\n" % couplings[i]
-                msg += "# Choose from: %s \n" % couplings_idx
+                msg += "# Choose from: %s \n" % list(definitions.couplings_idx.keys())
                 sys.stderr.write(msg)
                 sys.exit(1)
    
-    idxs = (all_idx[:,idx_angles,:]).reshape(-1,4)
-    missing = np.where(np.sum(idxs,axis=1)==0)
-    
-    torsions = md.compute_dihedrals(traj,idxs,opt=True)
-    
-    # set to NaN where atoms are missing
-    torsions[:,np.where(np.sum(idxs,axis=1)==0)[0]] = np.nan
-    
-    torsions = torsions.reshape((traj.n_frames,all_idx.shape[0],len(idx_angles)))
+    if(average):
+        assert not raw, "# raw angles cannot be averaged"
+        # weighted sums are accumulated chunk by chunk
+        jsum = np.zeros((all_idx.shape[0],len(couplings)))
+        wsum = 0.0
+        for start,chunk,(torsions,) in _iter_dihedrals(chunks,[all_idx[:,idx_angles,:]]):
+            if(weights is None):
+                ww = np.ones(torsions.shape[0])
+            else:
+                ww = np.asarray(weights[start:start+torsions.shape[0]],dtype=float)
+                assert len(ww)==torsions.shape[0], "# number of weights is smaller than the number of frames"
+            jsum += np.tensordot(ww,_karplus(torsions,couplings,idx_angles1),axes=(0,0))
+            wsum += np.sum(ww)
+        if(weights is not None):
+            assert len(weights)==start+torsions.shape[0], "# number of weights is larger than the number of frames"
+        return jsum/wsum, rr
+
+    torsions = _dihedrals(chunks,[all_idx[:,idx_angles,:]])[0]
 
-    #jcouplings = np.zeros((torsions.shape[0],torsions.shape[1],len(couplings)))
     # now calculate couplings
     if(raw):
         return torsions,rr
-
-    jcouplings = np.empty((traj.n_frames,all_idx.shape[0],len(couplings)))*np.nan
-
-    for i in range(len(couplings)):
-        # get karplus coefficients
-        
-        coef = definitions.couplings_karplus[couplings[i]]
-        #ii = definitions.couplings_idx[couplings[i]]
-        ii =  idx_angles1[i]
-
-        #print ii, couplings[i],
-        angles = np.copy(torsions[:,:,ii])
-        
-        # add phase
-        if(coef[4] != 0.0):
-            angles += coef[4]
-        cos = np.cos(angles)
-        val = coef[0]*cos*cos + coef[1]*cos
-        # add shift
-        if(coef[2] != 0.0):
-            val += coef[2]
-        # add generalized karplus term
-        if(coef[3] != 0.0):
-            sin = np.sin(angles)
-            val += coef[3]*cos*sin
-        jcouplings[:,:,i] = val
-    
-    return jcouplings,rr
+    return _karplus(torsions,couplings,idx_angles1), rr
+
+def _karplus_coefficients(couplings):
+
+    # (5,q) matrix of Karplus coefficients, one column per coupling
+    return np.array([definitions.couplings_karplus[name] for name in couplings],dtype=float).T
+
+def _karplus(torsions,couplings,idx_angles):
+
+    # scalar couplings from torsion angles, all couplings at once.
+    # idx_angles[i] is the column of torsions used for couplings[i]
+    coef = _karplus_coefficients(couplings)
+    # add phase
+    angles = torsions[:,:,idx_angles] + coef[4]
+    cos = np.cos(angles)
+    # a*cos^2 + b*cos + c
+    jcouplings = coef[0]*cos
+    jcouplings += coef[1]
+    jcouplings *= cos
+    jcouplings += coef[2]
+    # add generalized karplus term
+    if(np.any(coef[3]!=0.0)):
+        np.sin(angles,out=angles)
+        angles *= cos
+        angles *= coef[3]
+        jcouplings += angles
+    return jcouplings
 
 
 ##############################################################
 
-def ss_motif(query,target,topology=None,threshold=0.8,cutoff=2.4,sequence=None,out=None,bulges=0):
+def _load_queries(query):
+
+    # a single query filename or a list of query filenames
+    if(isinstance(query,(list,tuple))):
+        sys.stderr.write("# Loaded queries %s \n" % " ".join(query))
+        return [md.load(q) for q in query]
+    sys.stderr.write("# Loaded query %s \n" % query)
+    return md.load(query)
+
+def _per_query(value,n_queries):
+
+    # option given either once for all queries or as a list with one value per query
+    if(isinstance(value,(list,tuple))):
+        assert len(value)==n_queries, "# FATAL: %d values given for %d queries" % (len(value),n_queries)
+        return list(value)
+    return [value]*n_queries
+
+def _query_out(out,qi,n_queries):
+
+    # prefix of PDB files for hits of query qi
+    if(out==None or n_queries==1):
+        return out
+    return "%s_q%d" % (out,qi)
+
+class _HitWriter:
+
+    # write hits aligned to their query. Hits are collected and superposed
+    # in batches with a single call to calc_kabsch
+    batch_size = 1024
+
+    def __init__(self,queries,nn_traj,topology,multimodel=False):
+
+        self.queries = queries
+        self.nn_traj = nn_traj
+        self.topology = topology
+        self.multimodel = multimodel
+        self.pending = []
+        self.cache = {}
+        # multi-model files, one for each query and set of atoms in the hits
+        self.files = {}
+        self.models = {}
+        self.groups = {}
+
+    def _atoms(self,qi,res_idx):
+
+        # atoms of the hit, topology and backbone atoms in common with the query.
+        # As in atom_slice, atoms are sorted, and query residues are matched
+        # with hit residues in this order
+        key = (qi,tuple(res_idx))
+        if(key in self.cache): return key
+        residues = [self.nn_traj.ok_residues[r1] for r1 in sorted(res_idx)]
+        atoms = np.sort([at.index for res in residues for at in res.atoms])
+        idx_target = []
+        idx_ref = []
+        for res1,res2 in zip(self.queries[qi][1].ok_residues,residues):
+            name2 = {}
+            for at in res2.atoms:
+                if(at.name in definitions.bb_atoms): name2.setdefault(at.name,at.index)
+            for at in res1.atoms:
+                if(at.name in name2):
+                    idx_ref.append(at.index)
+                    idx_target.append(name2[at.name])
+        self.cache[key] = (atoms,self.topology.subset(atoms),np.searchsorted(atoms,idx_target),np.array(idx_ref,dtype=int))
+        return key
+
+    def entry(self,qi,res_idx,chunk,i):
+
+        # coordinates of a hit in frame i of chunk
+        key = self._atoms(qi,res_idx)
+        unitcell = (None,None)
+        if(chunk.unitcell_lengths is not None):
+            unitcell = (chunk.unitcell_lengths[i],chunk.unitcell_angles[i])
+        return qi, key, chunk.xyz[i,self.cache[key][0]], unitcell
+
+    def add(self,pdb_out,entry):
+
+        self.pending.append((pdb_out,)+entry)
+        if(len(self.pending)>=self.batch_size): self.flush()
+
+    def flush(self):
+
+        if(len(self.pending)==0): return
+        n_fit = max([len(self.cache[ee[2]][2]) for ee in self.pending])
+        mobile = np.zeros((len(self.pending),n_fit,3))
+        ref = np.zeros((len(self.pending),n_fit,3))
+        mask = np.zeros((len(self.pending),n_fit),dtype=bool)
+        for j,(pdb_out,qi,key,xyz,unitcell) in enumerate(self.pending):
+            atoms,top,idx_target,idx_ref = self.cache[key]
+            mobile[j,:len(idx_target)] = xyz[idx_target]
+            ref[j,:len(idx_ref)] = self.queries[qi][0].xyz[0,idx_ref]
+            mask[j,:len(idx_target)] = True
+        rot,com_mobile,com_ref = ff.calc_kabsch(mobile,ref,mask)
+
+        for j,(pdb_out,qi,key,xyz,unitcell) in enumerate(self.pending):
+            xyz_fit = (np.dot(xyz-com_mobile[j],rot[j])+com_ref[j]).astype(np.float32)
+            self._write(pdb_out,qi,self.cache[key][1],xyz_fit,unitcell)
+        self.pending = []
+
+    def _write(self,pdb_out,qi,top,xyz,unitcell):
+
+        if(self.multimodel):
+            # hits with different atoms (e.g. different sequences) are written to separate files,
+            # pdb_out.pdb for the first set of atoms found, then pdb_out_1.pdb, pdb_out_2.pdb...
+            key = (qi,_topology_signature(top))
+            if(key not in self.files):
+                groups = self.groups.setdefault(qi,[])
+                name = "%s.pdb" % pdb_out if(len(groups)==0) else "%s_%d.pdb" % (pdb_out,len(groups))
+                groups.append(key)
+                self.files[key] = md.formats.PDBTrajectoryFile(name,'w',force_overwrite=True)
+                self.models[key] = 0
+            fh = self.files[key]
+            model = self.models[key]
+            self.models[key] += 1
+        else:
+            fh = md.formats.PDBTrajectoryFile(pdb_out,'w',force_overwrite=True)
+            model = None
+        lengths = None if(unitcell[0] is None) else in_units_of(unitcell[0],"nanometers",fh.distance_unit)
+        fh.write(in_units_of(xyz,"nanometers",fh.distance_unit),top,modelIndex=model,\
+                 unitcell_lengths=lengths,unitcell_angles=unitcell[1])
+        if(not self.multimodel): fh.close()
+
+    def close(self):
+
+        self.flush()
+        for fh in self.files.values():
+            fh.close()
+        self.files = {}
+
+def _select_hits(hits,key,top_k=None,best_per_frame=False):
+
+    # reduce the hits found in a block of frames. hit[0] is the frame, hit[1] the eRMSD
+    # and key(hit) the query. The order of the selected hits is preserved
+    if(best_per_frame):
+        best = {}
+        for j,hh in enumerate(hits):
+            kk = (hh[0],key(hh))
+            if(kk not in best or hh[1]<hits[best[kk]][1]):
+                best[kk] = j
+        hits = [hits[j] for j in sorted(best.values())]
+    if(top_k!=None):
+        per_query = {}
+        for j,hh in enumerate(hits):
+            per_query.setdefault(key(hh),[]).append(j)
+        keep = []
+        for jj in per_query.values():
+            keep.extend(heapq.nsmallest(top_k,jj,key=lambda j: hits[j][1]))
+        hits = [hits[j] for j in sorted(keep)]
+    return hits
+
+# number of frames analyzed at a time in motif searches
+_motif_block_frames = 64
+
+class _MotifHits:
+
+    # hits of each query: all hits in order of frame, the first max_hits,
+    # or the top_k hits with lowest eRMSD kept in a bounded heap
+    def __init__(self,n_queries,top_k=None,max_hits=None):
+
+        self.top_k = top_k
+        self.max_hits = max_hits
+        self.found = [0]*n_queries
+        self.hits = [[] for q in range(n_queries)]
+
+    def full(self,qi):
+
+        return self.max_hits!=None and self.found[qi]>=self.max_hits
+
+    def done(self):
+
+        return all([self.full(qi) for qi in range(len(self.found))])
+
+    def add(self,qi,hit,extra=None):
+
+        # return True if hit is kept. extra() is stored along with the hit in top_k mode
+        if(self.full(qi)): return False
+        self.found[qi] += 1
+        if(self.top_k==None):
+            self.hits[qi].append(hit)
+            return True
+
+        # the worst hit is on top of the heap. For equal eRMSD, later hits are dropped first
+        entry = (-hit[1],-self.found[qi])
+        heap = self.hits[qi]
+        if(len(heap)==self.top_k):
+            if(entry<heap[0][:2]): return False
+            heapq.heappop(heap)
+        heapq.heappush(heap,entry + (hit,None if(extra==None) else extra()))
+        return True
+
+    def results(self,qi):
+
+        # list of (hit,extra)
+        if(self.top_k==None):
+            return [(hh,None) for hh in self.hits[qi]]
+        return [(ee[2],ee[3]) for ee in sorted(self.hits[qi],key=lambda ee: (-ee[0],-ee[1]))]
+
+def ss_motif(query,target,topology=None,threshold=0.8,cutoff=2.4,sequence=None,out=None,bulges=0,chunk=None,n_jobs=1,\
+             top_k=None,max_hits=None,best_per_frame=False,multimodel=False):
     
     """
     Find single stranded motif similar to *query* in *target*
 
     Parameters
     ----------
-    query : string 
+    query : string or list
          Filename of query structure, any format accepted by MDtraj can be used.
+         If a list of filenames is given, all queries are searched in a single pass over the target.
     target : string 
          Filename of target structure. If a trajectory is provided, a topology file must be specified.
     topology : string, optional
          Topology filename. Must be specified if target is a trajectory.
     threshold : float, optional
          all substructures in target with eRMSD < threshold will be returned. 
-    sequence: string, optional
+    sequence: string or list, optional
          By default, the search is performed in a sequence-independent manner, unless a specific sequence is specified. Abbreviations (R/Y/N) are accepted.
+         With multiple queries, a list with one sequence (or None) per query can be given.
     out: string, optional
          Hits are written to PDB files and aligned to query with the specified prefix. If *out* is not specified, PDB are not written.
+         With multiple queries, the prefix of query number q is *out*_q<q>.
     bulges: int, optional
          Maximum number of allowed bulges, i.e. maximium number of inserted nucleotides. Default value is 0.
     cutoff :  float, optional
          Cutoff for eRMSD calculation. 
          The default value of 2.4 should work in most cases. This cutoff value roughly correspond to considering pair of bases whose distance is within an ellipsoidal cutoff with axis x=y=2.4*5 = 12 Angstrom and z=2.4*3=7.2 Angstrom. Larger values of cutoff can be useful when analyzing unstructured/flexible molecules.
+    chunk : int, optional
+         Read the trajectory in chunks of *chunk* frames instead of loading it in memory.
+    n_jobs : int, optional
+         Number of processes used to analyze frames in parallel. If n_jobs < 1, all available CPUs are used.
+    top_k : int, optional
+         Return only the *top_k* hits with lowest eRMSD for each query, sorted by eRMSD. Memory does not grow with the number of hits.
+    max_hits : int, optional
+         Stop the search as soon as *max_hits* hits are found for each query.
+    best_per_frame : bool, optional
+         Return only the hit with lowest eRMSD in each frame.
+    multimodel : bool, optional
+         Write all aligned hits of a query to the multi-model PDB file *out*.pdb instead of one PDB file per hit.
+         Hits with different atoms (e.g. different sequences) are written to separate files *out*_1.pdb, *out*_2.pdb, ...,
+         so that each file can be loaded as a trajectory.
     
     Returns
     -------
         list :
-            list of results. Each element in the list contain: the frame number, the eRMSD from query and the residues
+            list of results. Each element in the list contain: the frame number, the eRMSD from query and the residues.
+            With multiple queries, a list with the results of each query.
     
     """
 
-    ref = md.load(query)
-    warn =  "# Loaded query %s \n" % query
-        
-    if(topology==None):
-        traj = md.load(target)
-    else:
-        traj = md.load(target,top=topology)
-    warn += "# Loaded target %s \n" % target
-    sys.stderr.write(warn)
+    ref = _load_queries(query)
+    traj = load(target,topology=topology,chunk=chunk)
+    sys.stderr.write("# Loaded target %s \n" % target)
     
-    return ss_motif_traj(ref,traj,threshold=threshold,cutoff=cutoff,sequence=sequence,out=out,bulges=bulges)
+    return ss_motif_traj(ref,traj,threshold=threshold,cutoff=cutoff,sequence=sequence,out=out,bulges=bulges,n_jobs=n_jobs,\
+                         top_k=top_k,max_hits=max_hits,best_per_frame=best_per_frame,multimodel=multimodel)
 
-def ss_motif_traj(ref,traj,threshold=0.8,cutoff=2.4,sequence=None,bulges=0,out=None):
-    
-    top_traj = traj.topology
-    # initialize nucleic class
-    nn_traj = nucleic.Nucleic(top_traj)
+def _ss_motif_block(coords,groups,cutoff,threshold,top_k,best_per_frame):
+
+    # return list of hits [frame index in block, eRMSD, index of group, index of query in group, index of window]
+    hits = []
+    for i in range(coords.shape[0]):
+
+        # G-vectors of all pairs from a single calculation on the whole frame
+        keys,gvecs = ff.calc_gmat_pairs(coords[i],cutoff)
+        for g,(windows,ref_mats,masks) in enumerate(groups):
+            gmats = ff.gather_gmat_windows(keys,gvecs,coords.shape[2],windows)
+
+            # compare all windows with all queries with the same length
+            dd = distance.cdist(ref_mats,gmats)/np.sqrt(windows.shape[1])
+            for q,k in zip(*np.where((dd<threshold) & masks)):
+                hits.append([i,dd[q,k],g,q,k])
+    return _select_hits(hits,lambda hh: (hh[2],hh[3]),top_k=top_k,best_per_frame=best_per_frame)
 
+def ss_motif_traj(ref,traj,threshold=0.8,cutoff=2.4,sequence=None,bulges=0,out=None,n_jobs=1,\
+                  top_k=None,max_hits=None,best_per_frame=False,multimodel=False):
+
+    mode = dict(top_k=top_k,max_hits=max_hits,best_per_frame=best_per_frame,multimodel=multimodel)
+
+    if(isinstance(ref,(list,tuple))):
+        sequences = _per_query(sequence,len(ref))
+        queries = [_ss_motif_query(rr,cutoff=cutoff,sequence=ss) for rr,ss in zip(ref,sequences)]
+        return _ss_motif_search(queries,traj,threshold=threshold,cutoff=cutoff,bulges=bulges,out=out,n_jobs=n_jobs,**mode)
+    query = _ss_motif_query(ref,cutoff=cutoff,sequence=sequence)
+    return _ss_motif_search([query],traj,threshold=threshold,cutoff=cutoff,bulges=bulges,out=out,n_jobs=n_jobs,**mode)[0]
+
+def _ss_motif_query(ref,cutoff=2.4,sequence=None):
+
+    # everything that depends on the query only
     top_ref = ref.topology
     # initialize nucleic class
     nn_ref = nucleic.Nucleic(top_ref)
@@ -623,109 +1288,272 @@ def ss_motif_traj(ref,traj,threshold=0.8,cutoff=2.4,sequence=None,bulges=0,out=N
         
     coords_ref = ref.xyz[0,nn_ref.indeces_lcs]
     ref_mat = ff.calc_gmat(coords_ref,cutoff).reshape(-1)
-    
+    return ref, nn_ref, sequence, ref_mat
+
+def _ss_motif_search(queries,traj,threshold=0.8,cutoff=2.4,bulges=0,out=None,n_jobs=1,\
+                     top_k=None,max_hits=None,best_per_frame=False,multimodel=False):
+
+    top_traj, chunks = _chunks(traj)
+    # initialize nucleic class
+    nn_traj = nucleic.Nucleic(top_traj)
     rna_seq = nn_traj.rna_seq_id
-    res_idxs = definitions.get_idx(rna_seq,sequence,bulges)
-    resname_idxs = [[nn_traj.rna_seq[l] for l in rr]  for rr  in res_idxs]
-    if(len(res_idxs)==0):
-        return []
+    # windows do not cross chains or breaks, found in the first frame
+    start, first = next(chunks)
+    chunks = itertools.chain([(start,first)],chunks)
+    breaks = nn_traj.get_breaks(first.xyz[0])
+
+    # queries with the same length share windows, which are enumerated once
+    # with a sequence-independent pattern. Each query only considers
+    # the windows that match its own sequence
+    groups = []
+    group_queries = []
+    for ll in sorted(set([len(qq[2]) for qq in queries])):
+        qidx = [qi for qi,qq in enumerate(queries) if len(qq[2])==ll]
+        res_idxs = definitions.get_idx(rna_seq,"N"*ll,bulges,breaks=breaks)
+        if(len(res_idxs)==0): continue
+        masks = np.array([definitions.match_windows(rna_seq,queries[qi][2],res_idxs) for qi in qidx])
+        ref_mats = np.array([queries[qi][3] for qi in qidx])
+        groups.append((res_idxs,ref_mats,masks))
+        group_queries.append(qidx)
+
+    if(len(groups)==0):
+        return [[] for qq in queries]
 
     lcs_idx = nn_traj.indeces_lcs
-    results = []
-    count = 1
-    for i in range(traj.n_frames):
-        
-        gmats = [ ff.calc_gmat(traj.xyz[i,lcs_idx[:,j]],cutoff).reshape(-1)  for j in res_idxs]
-            
-        dd = distance.cdist([ref_mat],gmats)/np.sqrt(ll)
-        low = np.where(dd[0]<threshold)
-        for k in low[0]:
-            results.append([i,dd[0,k],resname_idxs[k]])
+    # hits are reduced in each block of frames, unless the search stops early
+    top_k_block = top_k if(max_hits==None) else None
+    found = _MotifHits(len(queries),top_k=top_k,max_hits=max_hits)
+    writer = _HitWriter(queries,nn_traj,top_traj,multimodel=multimodel)
+    # frames are analyzed in small blocks, so that hits are reduced and max_hits is checked
+    # after each block, independently of the chunk size
+    blocks = parallel.map_frames(_ss_motif_block,chunks,n_jobs=n_jobs,select=lcs_idx,block_size=_motif_block_frames,\
+                                 args=(groups,cutoff,threshold,top_k_block,best_per_frame))
+    for start,chunk,first,hits in blocks:
+        for i,dist,g,q,k in hits:
+            i += first
+            qi = group_queries[g][q]
+            res_idx = groups[g][0][k]
+            resname_idxs = [nn_traj.rna_seq[l] for l in res_idx]
+            hit = [start+i,dist,resname_idxs]
+            # in top_k mode the coordinates are kept until the end of the search
+            if(top_k!=None):
+                found.add(qi,hit,None if(out==None) else (lambda: writer.entry(qi,res_idx,chunk,i)))
+                continue
+            if(not found.add(qi,hit)): continue
 
             # Write aligned PDB 
             if(out != None):
-                pdb_out = "%s_%05d_%s_%d.pdb" % (out,count,resname_idxs[k][0],i)
-                # slice trajectory
-                tmp_atoms = []
-                tmp_res =[]
-                for r1 in res_idxs[k]:
-                    tmp_atoms.extend([at.index for at in nn_traj.ok_residues[r1].atoms])
-                    tmp_res.append([at for at in nn_traj.ok_residues[r1].atoms])
-                traj_slice = traj[i].atom_slice(tmp_atoms)
-                
-                # align whatever is in common in the backbone
-                idx_target = []
-                idx_ref = []
-                for res1,res2 in zip(nn_ref.ok_residues,traj_slice.topology.residues):
-                    name2 = [at.name for at in res2.atoms if  at.name in definitions.bb_atoms]
-                    for at in res1.atoms:
-                        if at.name in definitions.bb_atoms:
-                            if(at.name in name2):
-                                idx_ref.append(at.index)
-                                idx_target.append(((res2.atom(at.name)).index))
-                                #idx_target.append(res2[name2.index(at.name)].index)
-                traj_slice.superpose(ref,atom_indices=idx_target, ref_atom_indices=idx_ref)
-                traj_slice.save(pdb_out)
-
-            count += 1
-    
+                pdb_out = "%s_%05d_%s_%d.pdb" % (_query_out(out,qi,len(queries)),found.found[qi],resname_idxs[0],start+i)
+                if(multimodel): pdb_out = _query_out(out,qi,len(queries))
+                writer.add(pdb_out,writer.entry(qi,res_idx,chunk,i))
+        writer.flush()
+        if(found.done()): break
+    blocks.close()
+
+    results = []
+    for qi in range(len(queries)):
+        results.append([hh for hh,entry in found.results(qi)])
+        if(top_k==None or out==None): continue
+        for count,(hh,entry) in enumerate(found.results(qi)):
+            pdb_out = "%s_%05d_%s_%d.pdb" % (_query_out(out,qi,len(queries)),count+1,hh[2][0],hh[0])
+            if(multimodel): pdb_out = _query_out(out,qi,len(queries))
+            writer.add(pdb_out,entry)
+    writer.close()
     return results
 
+def _ss_motif_file(filename,queries,threshold,cutoff,bulges,out,single,mode):
+
+    traj = md.load(filename)
+    if(out!=None):
+        out = "%s_%s" % (out,os.path.basename(filename).split(".")[0])
+    results = _ss_motif_search(queries,traj,threshold=threshold,cutoff=cutoff,bulges=bulges,out=out,**mode)
+    return results[0] if single else results
+
+def ss_motif_scan(query,targets,threshold=0.8,cutoff=2.4,sequence=None,bulges=0,out=None,n_jobs=1,\
+                  top_k=None,max_hits=None,best_per_frame=False,multimodel=False):
+
+    """
+    Find single stranded motif similar to *query* in many structure files. 
+    The query is processed only once, and target files are distributed to a pool of processes.
+
+    Parameters
+    ----------
+    query : string or list
+         Filename of query structure, any format accepted by MDtraj can be used.
+         If a list of filenames is given, all queries are searched in a single pass over each target.
+    targets : list
+         List of filenames of target structures (e.g. PDB or mmCIF).
+    threshold : float, optional
+         all substructures in target with eRMSD < threshold will be returned. 
+    sequence: string or list, optional
+         By default, the search is performed in a sequence-independent manner, unless a specific sequence is specified. Abbreviations (R/Y/N) are accepted.
+    out: string, optional
+         Hits are written to PDB files and aligned to query with prefix *out*_*target*. If *out* is not specified, PDB are not written.
+    bulges: int, optional
+         Maximum number of allowed bulges, i.e. maximium number of inserted nucleotides. Default value is 0.
+    cutoff :  float, optional
+         Cutoff for eRMSD calculation. 
+    n_jobs : int, optional
+         Number of processes used to analyze files in parallel. If n_jobs < 1, all available CPUs are used.
+    top_k : int, optional
+         Return only the *top_k* hits with lowest eRMSD for each query in each file, sorted by eRMSD.
+    max_hits : int, optional
+         Stop the search in a file as soon as *max_hits* hits are found for each query.
+    best_per_frame : bool, optional
+         Return only the hit with lowest eRMSD in each frame.
+    multimodel : bool, optional
+         Write all aligned hits of a query to the multi-model PDB file *out*.pdb instead of one PDB file per hit.
+         Hits with different atoms (e.g. different sequences) are written to separate files *out*_1.pdb, *out*_2.pdb, ...,
+         so that each file can be loaded as a trajectory.
+    
+    Returns
+    -------
+        iterator :
+            iterator over (filename, results, error), in the same order of targets. Results are yielded as soon as a file is analyzed.
+            results is the list returned by ss_motif, error is None or a string describing why the file could not be analyzed.
+    
+    """
+
+    ref = _load_queries(query)
+    single = not isinstance(ref,list)
+    mode = dict(top_k=top_k,max_hits=max_hits,best_per_frame=best_per_frame,multimodel=multimodel)
+    if(single):
+        queries = [_ss_motif_query(ref,cutoff=cutoff,sequence=sequence)]
+    else:
+        sequences = _per_query(sequence,len(ref))
+        queries = [_ss_motif_query(rr,cutoff=cutoff,sequence=ss) for rr,ss in zip(ref,sequences)]
+    return parallel.map_files(_ss_motif_file,targets,n_jobs=n_jobs,args=(queries,threshold,cutoff,bulges,out,single,mode))
+
 ##########################################################################################
 
-def ds_motif(query,target,l1,l2,threshold=0.9,cutoff=2.4,topology=None,sequence=None,bulges=0,out=None):
+def ds_motif(query,target,l1,l2,threshold=0.9,cutoff=2.4,topology=None,sequence=None,bulges=0,out=None,chunk=None,n_jobs=1,\
+             top_k=None,max_hits=None,best_per_frame=False,multimodel=False):
     
     """
     Find single stranded motif similar to *query* in *target*
 
     Parameters
     ----------
-    query : string 
+    query : string or list
          Filename of query structure, any format accepted by MDtraj can be used.
+         If a list of filenames is given, all queries are searched in a single pass over the target.
     target : string 
          Filename of target structure. If a trajectory is provided, a topology file must be specified.
-    l1 : int 
-         Number of nucleotides in the first strand
-    l2 : int 
-         Number of nucleotides in the second strand
+    l1 : int or list
+         Number of nucleotides in the first strand. With multiple queries, a list with one value per query can be given.
+    l2 : int or list
+         Number of nucleotides in the second strand. With multiple queries, a list with one value per query can be given.
     topology : string, optional
          Topology filename. Must be specified if target is a trajectory.
     threshold : float, optional
          all substructures in target with eRMSD < threshold will be returned. 
-    sequence: string, optional
+    sequence: string or list, optional
          By default, the search is performed in a sequence-independent manner, unless a specific sequence is specified. Abbreviations (R/Y/N) are accepted.
+         With multiple queries, a list with one sequence (or None) per query can be given.
     out: string, optional
          Hits are written to PDB files and aligned to query with the specified prefix. If *out* is not specified, PDB are not written.
+         With multiple queries, the prefix of query number q is *out*_q<q>.
     bulges: int, optional
          Maximum number of allowed bulges, i.e. maximium number of inserted nucleotides. Default value is 0.
     cutoff :  float, optional
          Cutoff for eRMSD calculation. 
          The default value of 2.4 should work in most cases. This cutoff value roughly correspond to considering pair of bases whose distance is within an ellipsoidal cutoff with axis x=y=2.4*5 = 12 Angstrom and z=2.4*3=7.2 Angstrom. Larger values of cutoff can be useful when analyzing unstructured/flexible molecules.
     
+    chunk : int, optional
+         Read the trajectory in chunks of *chunk* frames instead of loading it in memory.
+    n_jobs : int, optional
+         Number of processes used to analyze frames in parallel. If n_jobs < 1, all available CPUs are used.
+    top_k : int, optional
+         Return only the *top_k* hits with lowest eRMSD for each query, sorted by eRMSD. Memory does not grow with the number of hits.
+    max_hits : int, optional
+         Stop the search as soon as *max_hits* hits are found for each query.
+    best_per_frame : bool, optional
+         Return only the hit with lowest eRMSD in each frame.
+    multimodel : bool, optional
+         Write all aligned hits of a query to the multi-model PDB file *out*.pdb instead of one PDB file per hit.
+         Hits with different atoms (e.g. different sequences) are written to separate files *out*_1.pdb, *out*_2.pdb, ...,
+         so that each file can be loaded as a trajectory.
+    
     Returns
     -------
         list :
-            list of results. Each element in the list contain: the frame number, the eRMSD from query and the residues
+            list of results. Each element in the list contain: the frame number, the eRMSD from query and the residues.
+            With multiple queries, a list with the results of each query.
     
     """
 
-    ref = md.load(query)
-    warn =  "# Loaded query %s \n" % query        
-    if(topology==None):
-        traj = md.load(target)
-    else:
-        traj = md.load(target,top=topology)
-    warn += "# Loaded target %s \n" % target
-    sys.stderr.write(warn)
-
-    return ds_motif_traj(ref,traj,l1,l2,threshold=threshold,sequence=sequence,bulges=bulges,out=out)
-
-def ds_motif_traj(ref,traj,l1,l2,threshold=0.9,cutoff=2.4,sequence=None,bulges=0,out=None):
-    
-    top_traj = traj.topology
-    # initialize nucleic class
-    nn_traj = nucleic.Nucleic(top_traj)
-
+    ref = _load_queries(query)
+    traj = load(target,topology=topology,chunk=chunk)
+    sys.stderr.write("# Loaded target %s \n" % target)
+
+    return ds_motif_traj(ref,traj,l1,l2,threshold=threshold,cutoff=cutoff,sequence=sequence,bulges=bulges,out=out,n_jobs=n_jobs,\
+                         top_k=top_k,max_hits=max_hits,best_per_frame=best_per_frame,multimodel=multimodel)
+
+def _ds_motif_block(coords,groups,cutoff,threshold,top_k,best_per_frame):
+
+    # return list of hits [frame index in block, eRMSD, residue indeces, index of combination, index of group, index of query in group]
+    hits = []
+    for i in range(coords.shape[0]):
+
+        xyz = coords[i]
+        # G-vectors of all pairs from a single calculation on the whole frame
+        keys,gvecs = ff.calc_gmat_pairs(xyz,cutoff)
+        # center of each nucleotide
+        centers = np.average(xyz,axis=0)
+        for g,(all_idx1,all_idx2,ref_mats,masks1,masks2,dcoms_ref) in enumerate(groups):
+            l1 = len(all_idx1[0])
+            l2 = len(all_idx2[0])
+
+            # calculate eRMSD for strand1 and strand2, for all queries at once
+            gmats1 = ff.gather_gmat_windows(keys,gvecs,xyz.shape[1],all_idx1)
+            dd1 = distance.cdist(ref_mats[1],gmats1)
+            gmats2 = ff.gather_gmat_windows(keys,gvecs,xyz.shape[1],all_idx2)
+            dd2 = distance.cdist(ref_mats[2],gmats2)
+
+            for q in range(len(dcoms_ref)):
+                low1 = np.where((dd1[q]<threshold*np.sqrt(l1)) & masks1[q])[0]
+                low2 = np.where((dd2[q]<threshold*np.sqrt(l2)) & masks2[q])[0]
+                if(len(low1)==0 or len(low2)==0): continue
+
+                # skip distant: pairs of windows with close centers are found with a KD-tree
+                com1 = np.average(centers[all_idx1[low1]],axis=1)
+                com2 = np.average(centers[all_idx2[low2]],axis=1)
+                close = cKDTree(com2).query_ball_point(com1,2.5*dcoms_ref[q],return_sorted=True)
+                n_close = [len(cc) for cc in close]
+                if(sum(n_close)==0): continue
+                idx1 = np.repeat(low1,n_close)
+                idx2 = low2[np.concatenate(close).astype(int)]
+
+                # skip overlapping
+                idxs_combo = np.concatenate((all_idx1[idx1],all_idx2[idx2]),axis=1)
+                sorted_combo = np.sort(idxs_combo,axis=1)
+                idxs_combo = idxs_combo[np.all(sorted_combo[:,1:]!=sorted_combo[:,:-1],axis=1)]
+                if(len(idxs_combo)==0): continue
+
+                # calculate distances
+                gmats_combo = ff.gather_gmat_windows(keys,gvecs,xyz.shape[1],idxs_combo)
+                dd_combo = distance.cdist(ref_mats[0][q:q+1],gmats_combo)
+                low_combo = np.where(dd_combo[0]<threshold*np.sqrt(l1 + l2))
+                for k in low_combo[0]:
+                    hits.append([i,dd_combo[0,k]/np.sqrt(l1 + l2),idxs_combo[k],k,g,q])
+    return _select_hits(hits,lambda hh: (hh[4],hh[5]),top_k=top_k,best_per_frame=best_per_frame)
+
+def ds_motif_traj(ref,traj,l1,l2,threshold=0.9,cutoff=2.4,sequence=None,bulges=0,out=None,n_jobs=1,\
+                  top_k=None,max_hits=None,best_per_frame=False,multimodel=False):
+
+    mode = dict(top_k=top_k,max_hits=max_hits,best_per_frame=best_per_frame,multimodel=multimodel)
+
+    if(isinstance(ref,(list,tuple))):
+        n_queries = len(ref)
+        queries = [_ds_motif_query(rr,ll1,ll2,cutoff=cutoff,sequence=ss) for rr,ll1,ll2,ss in \
+                   zip(ref,_per_query(l1,n_queries),_per_query(l2,n_queries),_per_query(sequence,n_queries))]
+        return _ds_motif_search(queries,traj,threshold=threshold,cutoff=cutoff,bulges=bulges,out=out,n_jobs=n_jobs,**mode)
+    query = _ds_motif_query(ref,l1,l2,cutoff=cutoff,sequence=sequence)
+    return _ds_motif_search([query],traj,threshold=threshold,cutoff=cutoff,bulges=bulges,out=out,n_jobs=n_jobs,**mode)[0]
+
+def _ds_motif_query(ref,l1,l2,cutoff=2.4,sequence=None):
+
+    # everything that depends on the query only
     top_ref = ref.topology
     # initialize nucleic class
     nn_ref = nucleic.Nucleic(top_ref)
@@ -756,98 +1584,163 @@ def ds_motif_traj(ref,traj,l1,l2,threshold=0.9,cutoff=2.4,sequence=None,bulges=0
     ref_com1 = np.average(np.average(coords_ref1,axis=0),axis=0)
     ref_com2 = np.average(np.average(coords_ref2,axis=0),axis=0)
     dcom =  np.sqrt(np.sum((ref_com1-ref_com2)**2))
-    
-    # find indeces of residues according to sequence
-    rna_seq = nn_traj.rna_seq_id
+    return ref, nn_ref, l1, l2, sequence1, sequence2, (ref_mat,ref_mat1,ref_mat2), dcom
 
-    all_idx1 = definitions.get_idx(rna_seq,sequence1,bulges)
-    if(len(all_idx1)==0): return []
-    all_idx2 = definitions.get_idx(rna_seq,sequence2,bulges)
-    if(len(all_idx2)==0): return []
+def _ds_hit_label(resname_idxs,k):
 
+    # label used in the name of PDB files, as in earlier versions.
+    # k is the index of the combination, that can be larger than the number of residues
+    if(k<len(resname_idxs)):
+        return resname_idxs[k][0]
+    return resname_idxs[0][0]
+
+def _ds_motif_search(queries,traj,threshold=0.9,cutoff=2.4,bulges=0,out=None,n_jobs=1,\
+                     top_k=None,max_hits=None,best_per_frame=False,multimodel=False):
+
+    top_traj, chunks = _chunks(traj)
+    # initialize nucleic class
+    nn_traj = nucleic.Nucleic(top_traj)
+    rna_seq = nn_traj.rna_seq_id
+    # windows do not cross chains or breaks, found in the first frame
+    start, first = next(chunks)
+    chunks = itertools.chain([(start,first)],chunks)
+    breaks = nn_traj.get_breaks(first.xyz[0])
+
+    # queries with the same strand lengths share the windows of each strand,
+    # which are enumerated once with a sequence-independent pattern.
+    # Each query only considers the windows that match its own sequence
+    groups = []
+    group_queries = []
+    for l1,l2 in sorted(set([(qq[2],qq[3]) for qq in queries])):
+        qidx = [qi for qi,qq in enumerate(queries) if (qq[2],qq[3])==(l1,l2)]
+        all_idx1 = definitions.get_idx(rna_seq,"N"*l1,bulges,breaks=breaks)
+        all_idx2 = definitions.get_idx(rna_seq,"N"*l2,bulges,breaks=breaks)
+        if(len(all_idx1)==0 or len(all_idx2)==0): continue
+        masks1 = np.array([definitions.match_windows(rna_seq,queries[qi][4],all_idx1) for qi in qidx])
+        masks2 = np.array([definitions.match_windows(rna_seq,queries[qi][5],all_idx2) for qi in qidx])
+        ref_mats = tuple([np.array([queries[qi][6][j] for qi in qidx]) for j in range(3)])
+        dcoms_ref = np.array([queries[qi][7] for qi in qidx])
+        groups.append((all_idx1,all_idx2,ref_mats,masks1,masks2,dcoms_ref))
+        group_queries.append(qidx)
+
+    if(len(groups)==0):
+        return [[] for qq in queries]
 
     lcs_idx = nn_traj.indeces_lcs
-    idxs_combo = []
+    # hits are reduced in each block of frames, unless the search stops early
+    top_k_block = top_k if(max_hits==None) else None
+    found = _MotifHits(len(queries),top_k=top_k,max_hits=max_hits)
+    writer = _HitWriter(queries,nn_traj,top_traj,multimodel=multimodel)
+    # frames are analyzed in small blocks, so that hits are reduced and max_hits is checked
+    # after each block, independently of the chunk size
+    blocks = parallel.map_frames(_ds_motif_block,chunks,n_jobs=n_jobs,select=lcs_idx,block_size=_motif_block_frames,\
+                                 args=(groups,cutoff,threshold,top_k_block,best_per_frame))
+    for start,chunk,first,hits in blocks:
+        for i,dist,idx_combo,k,g,q in hits:
+            i += first
+            qi = group_queries[g][q]
+            resname_idxs = [nn_traj.rna_seq[l] for l  in idx_combo]
+            hit = [start+i,dist,resname_idxs]
+            # in top_k mode the coordinates are kept until the end of the search
+            if(top_k!=None):
+                found.add(qi,hit,None if(out==None) else (lambda: (writer.entry(qi,idx_combo,chunk,i),k)))
+                continue
+            if(not found.add(qi,hit)): continue
+
+            # Write aligned PDB 
+            if(out != None):
+                pdb_out = "%s_%05d_%s_%d.pdb" % (_query_out(out,qi,len(queries)),found.found[qi],_ds_hit_label(resname_idxs,k),start+i)
+                if(multimodel): pdb_out = _query_out(out,qi,len(queries))
+                writer.add(pdb_out,writer.entry(qi,idx_combo,chunk,i))
+        writer.flush()
+        if(found.done()): break
+    blocks.close()
+
     results = []
-    count = 1
-    for i in range(traj.n_frames):
+    for qi in range(len(queries)):
+        results.append([hh for hh,extra in found.results(qi)])
+        if(top_k==None or out==None): continue
+        for count,(hh,(entry,k)) in enumerate(found.results(qi)):
+            pdb_out = "%s_%05d_%s_%d.pdb" % (_query_out(out,qi,len(queries)),count+1,_ds_hit_label(hh[2],k),hh[0])
+            if(multimodel): pdb_out = _query_out(out,qi,len(queries))
+            writer.add(pdb_out,entry)
+    writer.close()
+    return results
 
-        # calculate eRMSD for strand1 
-        gmats1 = [ff.calc_gmat(traj.xyz[i,lcs_idx[:,j]],cutoff).reshape(-1) for j in all_idx1]
-        dd1 = distance.cdist([ref_mat1],gmats1)
-        low1 = np.where(dd1[0]<threshold*np.sqrt(l1))
-        
-        # calculate eRMSD for strand2 
-        gmats2 = [ff.calc_gmat(traj.xyz[i,lcs_idx[:,j]],cutoff).reshape(-1) for j in all_idx2]
-        dd2 = distance.cdist([ref_mat2],gmats2)
-        low2 = np.where(dd2[0]<threshold*np.sqrt(l2))
 
-        # do combination
-        combo_list = list(itertools.product(low1[0],low2[0]))
-        
-        gmats_combo = []
-        
-        for cc in combo_list:
-            llc = len(set(all_idx1[cc[0]] + all_idx2[cc[1]]))
-            # skip overlapping
-            if(llc != l1 + l2): continue
-            
-            # skip distant
-            com1 = np.average(np.average(traj.xyz[i,lcs_idx[:,all_idx1[cc[0]]]],axis=0),axis=0)
-            com2 = np.average(np.average(traj.xyz[i,lcs_idx[:,all_idx2[cc[1]]]],axis=0),axis=0)
-            dcoms = np.sqrt(np.sum((com1-com2)**2))
-            if(dcoms > 2.5*dcom): continue
+def _ds_motif_file(filename,queries,threshold,cutoff,bulges,out,single,mode):
 
-            idx_combo = all_idx1[cc[0]] + all_idx2[cc[1]]
-            idxs_combo.append(idx_combo)
-            gmats_combo.append(ff.calc_gmat(traj.xyz[i,lcs_idx[:,idx_combo]],cutoff).reshape(-1))
+    traj = md.load(filename)
+    if(out!=None):
+        out = "%s_%s" % (out,os.path.basename(filename).split(".")[0])
+    results = _ds_motif_search(queries,traj,threshold=threshold,cutoff=cutoff,bulges=bulges,out=out,**mode)
+    return results[0] if single else results
 
-        # calculate distances
-        dd_combo = distance.cdist([ref_mat],gmats_combo)
-        low_combo = np.where(dd_combo[0]<threshold*np.sqrt(l1 + l2))
+def ds_motif_scan(query,targets,l1,l2,threshold=0.9,cutoff=2.4,sequence=None,bulges=0,out=None,n_jobs=1,\
+                  top_k=None,max_hits=None,best_per_frame=False,multimodel=False):
 
-        for k in low_combo[0]:
-            
-            #print idxs_combo[k]
-            resname_idxs = [nn_traj.rna_seq[l] for l  in idxs_combo[k]]
-            
-            results.append([i,dd_combo[0,k]/np.sqrt(l1 + l2),resname_idxs])
+    """
+    Find double stranded motif similar to *query* in many structure files. 
+    The query is processed only once, and target files are distributed to a pool of processes.
 
-            #print results[-1]
-            # Write aligned PDB 
-            if(out != None):
-                pdb_out = "%s_%05d_%s_%d.pdb" % (out,count,resname_idxs[k][0],i)
-                # slice trajectory
-                tmp_atoms = []
-                tmp_res =[]
-                for r1 in idxs_combo[k]:
-                    tmp_atoms.extend([at.index for at in nn_traj.ok_residues[r1].atoms])
-                    tmp_res.append([at for at in nn_traj.ok_residues[r1].atoms])
-                traj_slice = traj[i].atom_slice(tmp_atoms)
-                
-                # align whatever is in common in the backbone
-                idx_target = []
-                idx_ref = []
-                for res1,res2 in zip(nn_ref.ok_residues,traj_slice.topology.residues):
-                    name2 = [at.name for at in res2.atoms if  at.name in definitions.bb_atoms]
-                    for at in res1.atoms:
-                        if at.name in definitions.bb_atoms:
-                            if(at.name in name2):
-                                idx_ref.append(at.index)
-                                idx_target.append(((res2.atom(at.name)).index))
-                                #idx_target.append(res2[name2.index(at.name)].index)
-                traj_slice.superpose(ref,atom_indices=idx_target, ref_atom_indices=idx_ref)
-                traj_slice.save(pdb_out)
-
-            count += 1
-    return results
+    Parameters
+    ----------
+    query : string or list
+         Filename of query structure, any format accepted by MDtraj can be used.
+         If a list of filenames is given, all queries are searched in a single pass over each target.
+    targets : list
+         List of filenames of target structures (e.g. PDB or mmCIF).
+    l1 : int or list
+         Number of nucleotides in the first strand
+    l2 : int or list
+         Number of nucleotides in the second strand
+    threshold : float, optional
+         all substructures in target with eRMSD < threshold will be returned. 
+    sequence: string or list, optional
+         By default, the search is performed in a sequence-independent manner, unless a specific sequence is specified. Abbreviations (R/Y/N) are accepted.
+    out: string, optional
+         Hits are written to PDB files and aligned to query with prefix *out*_*target*. If *out* is not specified, PDB are not written.
+    bulges: int, optional
+         Maximum number of allowed bulges, i.e. maximium number of inserted nucleotides. Default value is 0.
+    cutoff :  float, optional
+         Cutoff for eRMSD calculation. 
+    n_jobs : int, optional
+         Number of processes used to analyze files in parallel. If n_jobs < 1, all available CPUs are used.
+    top_k : int, optional
+         Return only the *top_k* hits with lowest eRMSD for each query in each file, sorted by eRMSD.
+    max_hits : int, optional
+         Stop the search in a file as soon as *max_hits* hits are found for each query.
+    best_per_frame : bool, optional
+         Return only the hit with lowest eRMSD in each frame.
+    multimodel : bool, optional
+         Write all aligned hits of a query to the multi-model PDB file *out*.pdb instead of one PDB file per hit.
+         Hits with different atoms (e.g. different sequences) are written to separate files *out*_1.pdb, *out*_2.pdb, ...,
+         so that each file can be loaded as a trajectory.
+    
+    Returns
+    -------
+        iterator :
+            iterator over (filename, results, error), in the same order of targets. Results are yielded as soon as a file is analyzed.
+            results is the list returned by ds_motif, error is None or a string describing why the file could not be analyzed.
+    
+    """
 
+    ref = _load_queries(query)
+    single = not isinstance(ref,list)
+    mode = dict(top_k=top_k,max_hits=max_hits,best_per_frame=best_per_frame,multimodel=multimodel)
+    if(single):
+        queries = [_ds_motif_query(ref,l1,l2,cutoff=cutoff,sequence=sequence)]
+    else:
+        n_queries = len(ref)
+        queries = [_ds_motif_query(rr,ll1,ll2,cutoff=cutoff,sequence=ss) for rr,ll1,ll2,ss in \
+                   zip(ref,_per_query(l1,n_queries),_per_query(l2,n_queries),_per_query(sequence,n_queries))]
+    return parallel.map_files(_ds_motif_file,targets,n_jobs=n_jobs,args=(queries,threshold,cutoff,bulges,out,single,mode))
 
 ######################################################################################
 
 
 
-def annotate(filename,topology=None):
+def annotate(filename,topology=None,chunk=None,n_jobs=1):
     
     """
     Find base-pair and base-stacking 
@@ -858,6 +1751,10 @@ def annotate(filename,topology=None):
          Filename of structure, any format accepted by MDtraj can be used.
     topology : string, optional
          Topology filename. Must be specified if target is a trajectory.
+    chunk : int, optional
+         Read the trajectory in chunks of *chunk* frames instead of loading it in memory.
+    n_jobs : int, optional
+         Number of processes used to analyze frames in parallel. If n_jobs < 1, all available CPUs are used.
     Returns
     -------
     stackings : list
@@ -868,166 +1765,126 @@ def annotate(filename,topology=None):
 
     """
     
-    if(topology==None):
-        traj = md.load(filename)
-    else:
-        traj = md.load(filename,top=topology)
+    traj = load(filename,topology=topology,chunk=chunk)
 
     warn = "# Loading %s \n" % filename
     sys.stderr.write(warn)
     
-    return annotate_traj(traj)
+    return annotate_traj(traj,n_jobs=n_jobs)
 
 
-def annotate_traj(traj):
+def _hbond_count(xyz_block,frames,pairs,nn):
 
-    # this is the binning for annotation
-    bins = [0,1.84,3.84,2.*np.pi]
-    bins_label = ["W","H","S"]
-    
-    top = traj.topology
-    # initialize nucleic class
-    nn = nucleic.Nucleic(top)
-    
-    #max_r  = np.max(definitions.f_factors)*1.58
-    #condensed_idx =  np.triu_indices(len(nn.ok_residues), 1)
+    # number of donor-acceptor distances below 3.3 AA, with a single gather over the block
+    idx,mask = nn.get_hbond_idx(pairs)
+    xyz = xyz_block[frames[:,np.newaxis,np.newaxis],idx]
+    dist_sq = np.sum((xyz[:,:,1]-xyz[:,:,0])**2,axis=2)
+    return np.sum((dist_sq<0.1089) & mask,axis=1)
+
+def _annotate_block(xyz_block,nn):
 
+    # work on blocks of frames, so that the dense intermediate arrays stay small
+    ll = len(nn.ok_residues)
+    block = max(1,ff.block_size//(ll*ll))
     stackings = []
     pairings = []
-    
-    for i in range(traj.n_frames):
+    for k in range(0,xyz_block.shape[0],block):
+        st,pa = _annotate_frames(xyz_block[k:k+block],nn)
+        stackings.extend(st)
+        pairings.extend(pa)
+    return stackings, pairings
 
-        # calculate LCS
-        coords = traj.xyz[i,nn.indeces_lcs]
+def _annotate_frames(xyz_block,nn):
 
-        # find bases in close contact (within ellipsoid w radius 1.7)
-        pairs,vectors,angles = ff.calc_mat_annotation(coords)
-        if(len(pairs)==0):
+    # this is the binning for annotation
+    bins = [0,1.84,3.84,2.*np.pi]
+    bins_label = np.array(["W","H","S"])
+
+    # find bases in close contact (within ellipsoid w radius 1.7) in all frames
+    frames,pairs,vectors,angles = ff.calc_mat_annotation_traj(xyz_block[:,nn.indeces_lcs])
+
+    # calculate rho
+    rho_12 = vectors[:,0,0]**2 + vectors[:,0,1]**2
+    rho_21 = vectors[:,1,0]**2 + vectors[:,1,1]**2
+
+    # calculate z squared
+    z_12 = vectors[:,0,2]**2
+    z_21 = vectors[:,1,2]**2
+
+    # stacked bases: z_ij AND z_ji > 2 AA, rho_ij OR rho_ji < 2.5 AA,
+    # angle between normal planes < 40 deg
+    stackz = (z_12>0.04) & (z_21>0.04)
+    stacked = stackz & ((rho_12<0.0625) | (rho_21<0.0625)) & (np.abs(angles)>0.766)
+    stacked_annotation = np.zeros((len(pairs),2),dtype="U1")
+    stacked_annotation[:] = ">"
+    # revert where z_ij is negative
+    stacked_annotation[vectors[:,0,2]<0,0] = "<"
+    stacked_annotation[vectors[:,1,2]>0,1] = "<"
+
+    # paired bases (z_ij < 2 AA OR z_ji < 2 AA)
+    paired = ~stackz
+    paired_annotation = np.zeros((len(pairs),3),dtype="U1")
+    paired_annotation[:] = "X"
+
+    # candidates with angle smaller than 60 deg and at least one hydrogen bond
+    cand = np.where(paired & (np.abs(angles)>=0.5))[0]
+    n_hbonds = np.zeros(len(pairs),dtype=int)
+    n_hbonds[cand] = _hbond_count(xyz_block,frames[cand],pairs[cand],nn)
+    cand = cand[n_hbonds[cand]>0]
+
+    # calculate edge angle. subtract 0.16 as Watson edge is not zero
+    # and shift to 0-2pi range. find edge: 0 Watson, 1:Hoogsteen, 2sugar
+    for k in range(2):
+        edge_angles = np.arctan2(vectors[cand,k,1],vectors[cand,k,0]) - definitions.theta1
+        edge_angles[np.where(edge_angles<0.0)] += 2.*np.pi
+        paired_annotation[cand,k] = bins_label[np.digitize(edge_angles,bins)-1]
+
+    # cis/trans from the glycosidic dihedral. if atoms are missing, do not calculate cis/trans
+    glyco = np.array([[-1 if el is None else el for el in gg] for gg in nn.indeces_glyco],dtype=int).reshape(-1,2)
+    gidxs = np.stack((glyco[pairs[cand,0],1],glyco[pairs[cand,0],0],glyco[pairs[cand,1],0],glyco[pairs[cand,1],1]),axis=1)
+    missing = np.any(gidxs<0,axis=1)
+    paired_annotation[cand[missing],2] = "x"
+    ok = cand[~missing]
+    gxyz = xyz_block[frames[ok][:,np.newaxis],gidxs[~missing]]
+    angle_glyco = ff.dihedral(gxyz[:,0],gxyz[:,1],gxyz[:,2],gxyz[:,3])
+    paired_annotation[ok,2] = np.where(np.abs(angle_glyco)>0.5*np.pi,"t","c")
+
+    # if is WWc, check for Watson-crick and GU
+    seq = np.array(nn.rna_seq_id)
+    ll = np.array(["".join(sorted(el)) for el in zip(seq[pairs[:,0]],seq[pairs[:,1]])],dtype=str)
+    wwc = (paired_annotation[:,0]=="W") & (paired_annotation[:,1]=="W") & (paired_annotation[:,2]=="c") & \
+          (z_12<0.04) & (z_21<0.04)
+    paired_annotation[wwc & (((ll=="AU") & (n_hbonds>1)) | ((ll=="CG") & (n_hbonds>2))),:] = ["W","C","c"]
+    paired_annotation[wwc & (ll=="GU") & (n_hbonds>1),:] = ["G","U","c"]
+
+    # split per frame
+    stackings = []
+    pairings = []
+    bounds = np.searchsorted(frames,np.arange(xyz_block.shape[0]+1))
+    for i in range(xyz_block.shape[0]):
+        if(bounds[i]==bounds[i+1]):
             stackings.append([[],[]])
             pairings.append([[],[]])
             continue
-        
-        # calculate rho
-        rho_12 = vectors[:,0,0]**2 + vectors[:,0,1]**2
-        rho_21 = vectors[:,1,0]**2 + vectors[:,1,1]**2
-
-        # calculate z squared 
-        z_12 = vectors[:,0,2]**2
-        z_21 = vectors[:,1,2]**2
-        # find stacked bases 
-
-        # z_ij  AND z_ji > 2 AA
-        stackz_12 = np.where(z_12>0.04)
-        stackz_21 = np.where(z_21>0.04)
-        
-        # rho_ij OR rho_ji < 2.5 AA
-        rhoz_12 =  np.where(rho_12<0.0625)
-        rhoz_21 =  np.where(rho_21<0.0625)
-        union_rho = np.union1d(rhoz_12[0],rhoz_21[0])
-
-        # angle between normal planes < 40 deg
-        anglez = np.where(np.abs(angles) >0.766)
-
-        # intersect all criteria
-        inter_zeta = np.intersect1d(stackz_12,stackz_21)
-        inter_stack = np.intersect1d(union_rho,inter_zeta)
-        stacked = np.intersect1d(inter_stack,anglez)
-
-        # now I have found all stackings.
-        #stacked_pairs = [[nn.rna_seq[pairs[k,0]],nn.rna_seq[pairs[k,1]]] for k in stacked]
-        stacked_pairs = [[pairs[k,0],pairs[k,1]] for k in stacked]
-        stacked_annotation = np.chararray((len(stacked_pairs),2), unicode='True')
-        stacked_annotation[:] = ">"
-        
-        # revert where z_ij is negative
-        rev1 = np.where(vectors[stacked,0,2]<0)
-        stacked_annotation[rev1[0],0] = "<"
-
-        rev2 = np.where(vectors[stacked,1,2]>0)
-        stacked_annotation[rev2[0],1] = "<"
-
-        stacked_annotation = ["".join(el) for el in stacked_annotation]
-        ######################################################
-
-        # find paired bases  (z_ij < 2 AA AND z_j1 < 2 AA)
-        #paired = [j for j in range(len(pairs)) if((j not in stackz_12[0]) and (j not in stackz_21[0]))]
-        paired = [j for j in range(len(pairs)) if((j not in stackz_12[0]) or (j not in stackz_21[0]))]
-        #paired_pairs = [[nn.rna_seq[pairs[k,0]],nn.rna_seq[pairs[k,1]]] for k in paired]
-        paired_pairs = [[pairs[k,0],pairs[k,1]] for k in paired]
-        
-        # calculate edge angle. subtract 0.16 as Watson edge is not zero
-        edge_angles_1 = np.arctan2(vectors[paired,0,1],vectors[paired,0,0]) - definitions.theta1
-        edge_angles_2 = np.arctan2(vectors[paired,1,1],vectors[paired,1,0]) - definitions.theta1
+        sel = np.arange(bounds[i],bounds[i+1])
+        st = sel[stacked[sel]]
+        pa = sel[paired[sel]]
+        stackings.append([[[pairs[k,0],pairs[k,1]] for k in st],["".join(el) for el in stacked_annotation[st]]])
+        pairings.append([[[pairs[k,0],pairs[k,1]] for k in pa],["".join(el) for el in paired_annotation[pa]]])
 
-        # shift to 0-2pi range
-        edge_angles_1[np.where(edge_angles_1<0.0)] += 2.*np.pi
-        edge_angles_2[np.where(edge_angles_2<0.0)] += 2.*np.pi
-
-        # find edge: 0 Watson, 1:Hoogsteen, 2sugar
-        edge_1 = np.digitize(edge_angles_1,bins)-1
-        edge_2 = np.digitize(edge_angles_2,bins)-1
-
-        
-        paired_annotation = np.chararray((len(paired_pairs),3), unicode=True)
-        paired_annotation[:] = "X"
-        
-        # now explicit loop, a bit messy. sorry, Guido.
-        for j in range(len(paired_pairs)):
+    return stackings, pairings
 
-            # if angle is larger than 60 deg, skip
-            if(np.abs(angles[paired[j]]) < 0.5 ): continue
+def annotate_traj(traj,n_jobs=1):
 
-            index1 = paired_pairs[j][0]
-            index2 = paired_pairs[j][1]
-            
-            # find donor and acceptor in first base
-            r1_donor = nn.donors[index1]
-            r1_acceptor = nn.acceptors[index1]
-            # find donor and acceptor in second base
-            r2_donor = nn.donors[index2]
-            r2_acceptor = nn.acceptors[index2]
-            combo_list = list(itertools.product(r1_donor,r2_acceptor)) + list(itertools.product(r1_acceptor,r2_donor))
-            
-            # distances between donor and acceptors
-            delta = np.diff(traj.xyz[i,combo_list],axis=1)
-            dist_sq = np.sum(delta**2,axis=2)
-            # number or distances less than 3.3 AA is n_hbonds
-            n_hbonds = (dist_sq<0.1089).sum()
-            # if no hydrogen bonds, skip 
-            if(n_hbonds==0): continue
-
-            # find edge
-            paired_annotation[j][0] = bins_label[edge_1[j]]
-            paired_annotation[j][1] = bins_label[edge_2[j]]
-
-            gidxs = [nn.indeces_glyco[index1][1],nn.indeces_glyco[index1][0],nn.indeces_glyco[index2][0],nn.indeces_glyco[index2][1]]
-
-            # if atoms in glyco are missing, do not calculate cis/trans
-            if(None in gidxs):
-                paired_annotation[j][2] = "x"
-            else:
-                angle_glyco = ff.dihedral(traj.xyz[i,gidxs[0]],traj.xyz[i,gidxs[1]],traj.xyz[i,gidxs[2]],traj.xyz[i,gidxs[3]])
-                if(np.abs(angle_glyco) > 0.5*np.pi):
-                    paired_annotation[j][2] = "t"
-                else:
-                    paired_annotation[j][2] = "c"
-                
-            # if is WWc, check for Watson-crick and GU
-            if("".join(paired_annotation[j]) == "WWc"):
-                r1 =  nn.rna_seq_id[index1]
-                r2 =  nn.rna_seq_id[index2]
-                ll = "".join(sorted([r1,r2]))
-                if((z_12[paired[j]] < 0.04) and (z_21[paired[j]]<0.04)):
-                    if(((ll=="AU" and n_hbonds > 1) or ( ll == "CG" and n_hbonds > 2))):
-                        paired_annotation[j] = ["W","C","c"]
-                    if(ll=="GU" and n_hbonds > 1):
-                        paired_annotation[j] = ["G","U","c"]
-                    
-        paired_annotation = ["".join(el) for el in paired_annotation]
+    top, chunks = _chunks(traj)
+    # initialize nucleic class
+    nn = nucleic.Nucleic(top)
 
-        
-        stackings.append([stacked_pairs,stacked_annotation])
-        pairings.append([paired_pairs,paired_annotation])
+    stackings = []
+    pairings = []
+    for start,chunk,first,(st,pa) in parallel.map_frames(_annotate_block,chunks,n_jobs=n_jobs,args=(nn,)):
+        stackings.extend(st)
+        pairings.extend(pa)
 
     return stackings, pairings, nn.rna_seq
 
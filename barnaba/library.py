@@ -0,0 +1,261 @@
+#   This is baRNAba, a tool for analysis of nucleic acid 3d structure
+#   Copyright (C) 2017 Sandro Bottaro (sandro.bottaro@bio.ku.dk)
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License V3 as published by
+#   the Free Software Foundation,
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Library of precomputed single stranded motif windows """
+
+from __future__ import absolute_import, division, print_function
+
+# Make sure that range returns an iterator also in python2 (using future module)
+from builtins import range
+
+import sys
+import itertools
+import numpy as np
+import mdtraj as md
+from sklearn.neighbors import BallTree
+from . import definitions
+from . import nucleic
+from . import functions
+from . import parallel
+from . import calc_mats as ff
+
+def _gmat_windows_traj(coords,cutoff,windows):
+
+    # flattened G-vectors of all windows in m frames, with shape (m*w,l*l*4).
+    # Bases of all frames are numbered one after the other, so that pairs are gathered in a single call
+    nf,ll = coords.shape[0],coords.shape[2]
+    dotp,m_idx = ff.calc_3dmat_traj(coords,cutoff)
+    keys = (m_idx[:,0]*ll + m_idx[:,1])*(nf*ll) + m_idx[:,0]*ll + m_idx[:,2]
+    offset = np.arange(nf)[:,np.newaxis,np.newaxis]*ll
+    return ff.gather_gmat_windows(keys,ff.calc_gvec(dotp,cutoff),nf*ll,(windows[np.newaxis]+offset).reshape(-1,windows.shape[1]))
+
+def _featurize(filename,topology,length,bulges,cutoff,chunk):
+
+    # G-vectors, frame and residue indeces of all windows in all frames of filename, and sequence of filename
+    top, chunks = functions._chunks(functions.load(filename,topology=topology,chunk=chunk))
+    nn = nucleic.Nucleic(top)
+    # windows do not cross chains or breaks, found in the first frame
+    start, first = next(chunks)
+    chunks = itertools.chain([(start,first)],chunks)
+    windows = definitions.get_idx(nn.rna_seq_id,"N"*length,bulges,breaks=nn.get_breaks(first.xyz[0]))
+    windows = np.array(windows,dtype=int).reshape(-1,length)
+    if(len(windows)==0):
+        return np.zeros((0,length*length*4),dtype=np.float32), np.zeros(0,dtype=int), windows, \
+            nn.rna_seq, nn.rna_seq_id
+
+    # frames are featurized in blocks of bounded size
+    ll = len(nn.ok_residues)
+    block = max(1,ff.block_size//(ll*ll))
+    gvecs = []
+    n_frames = 0
+    for start,chunk_traj in chunks:
+        for k in range(0,chunk_traj.n_frames,block):
+            coords = chunk_traj.xyz[k:k+block][:,nn.indeces_lcs]
+            gvecs.append(_gmat_windows_traj(coords,cutoff,windows).astype(np.float32))
+        n_frames = start + chunk_traj.n_frames
+    frames = np.repeat(np.arange(n_frames),len(windows))
+    return np.concatenate(gvecs), frames, np.tile(windows,(n_frames,1)), nn.rna_seq, nn.rna_seq_id
+
+
+class MotifLibrary:
+
+    """
+    Library of G-vectors of all single stranded windows with *length* nucleotides in a collection of structures.
+    Searching a query in the library gives the same hits as ss_motif on each structure, but windows are featurized only once
+    and hits below threshold are found with a ball tree.
+
+    Parameters
+    ----------
+    length : int
+        number of nucleotides in each window
+    bulges : int, optional
+        maximum number of inserted nucleotides in a window. Default value is 0.
+    cutoff : float, optional
+        cutoff for eRMSD calculation. Default value is 2.4.
+    """
+
+    def __init__(self,length,bulges=0,cutoff=2.4):
+
+        self.length = length
+        self.bulges = bulges
+        self.cutoff = cutoff
+        self.targets = []
+        self.gvecs = np.zeros((0,length*length*4),dtype=np.float32)
+        self.target_idx = np.zeros(0,dtype=int)
+        self.frames = np.zeros(0,dtype=int)
+        self.windows = np.zeros((0,length),dtype=int)
+        # residue names and sequence of each target
+        self.rna_seq = []
+        self.rna_seq_id = []
+        self.tree = None
+
+    def add(self,targets,topology=None,chunk=None,n_jobs=1):
+
+        """
+        Add all windows of target structures to the library.
+
+        Parameters
+        ----------
+        targets : list
+            list of filenames, any format accepted by MDtraj can be used.
+        topology : string, optional
+            Topology filename. Must be specified if targets are trajectories.
+        chunk : int, optional
+            Read trajectories in chunks of *chunk* frames instead of loading them in memory.
+        n_jobs : int, optional
+            Number of processes used to analyze files in parallel. If n_jobs < 1, all available CPUs are used.
+
+        Returns
+        -------
+        list :
+            list of (filename,error) for the files that could not be analyzed
+        """
+
+        gvecs = [self.gvecs]
+        target_idx = [self.target_idx]
+        frames = [self.frames]
+        windows = [self.windows]
+        failed = []
+        for filename,feat,error in parallel.map_files(_featurize,targets,n_jobs=n_jobs,\
+                                                      args=(topology,self.length,self.bulges,self.cutoff,chunk)):
+            if(error!=None):
+                sys.stderr.write("# not able to analyze %s: %s \n" % (filename,error))
+                failed.append((filename,error))
+                continue
+            gvecs.append(feat[0])
+            target_idx.append(np.zeros(len(feat[1]),dtype=int)+len(self.targets))
+            frames.append(feat[1])
+            windows.append(feat[2])
+            self.rna_seq.append(list(feat[3]))
+            self.rna_seq_id.append(list(feat[4]))
+            self.targets.append(filename)
+
+        self.gvecs = np.concatenate(gvecs)
+        self.target_idx = np.concatenate(target_idx)
+        self.frames = np.concatenate(frames)
+        self.windows = np.concatenate(windows)
+        self.tree = None
+        sys.stderr.write("# %d windows in library \n" % len(self.gvecs))
+        return failed
+
+    def build(self):
+
+        """ Build ball tree. This is done automatically at the first search. """
+
+        self.tree = BallTree(self.gvecs)
+
+    def save(self,filename):
+
+        """
+        Save library to a numpy .npz file. The ball tree is rebuilt when the library is loaded.
+        """
+
+        # residue names of all targets are stored one after the other
+        seq_start = np.cumsum([0]+[len(seq) for seq in self.rna_seq])
+        np.savez(filename,length=self.length,bulges=self.bulges,cutoff=self.cutoff,\
+                 targets=np.array(self.targets,dtype=str),gvecs=self.gvecs,target_idx=self.target_idx,\
+                 frames=self.frames,windows=self.windows,seq_start=seq_start,\
+                 rna_seq=np.array(sum(self.rna_seq,[]),dtype=str),rna_seq_id=np.array(sum(self.rna_seq_id,[]),dtype=str))
+
+    def search(self,query,threshold=0.8,sequence=None):
+
+        """
+        Find windows similar to *query*
+
+        Parameters
+        ----------
+        query : string
+            Filename of query structure, any format accepted by MDtraj can be used.
+            The number of nucleotides must be equal to the window length.
+        threshold : float, optional
+            all windows with eRMSD < threshold will be returned.
+        sequence: string, optional
+            By default, the search is performed in a sequence-independent manner, unless a specific sequence is specified. Abbreviations (R/Y/N) are accepted.
+
+        Returns
+        -------
+        list :
+            list of results. Each element in the list contain: the target filename, the frame number, the eRMSD from query and the residues
+        """
+
+        ref = md.load(query)
+        nn_ref = nucleic.Nucleic(ref.topology)
+        assert len(nn_ref.ok_residues)==self.length, "# Query has %d nucleotides, library windows have %d" % (len(nn_ref.ok_residues),self.length)
+        ref_mat = ff.calc_gmat(ref.xyz[0,nn_ref.indeces_lcs],self.cutoff).reshape(1,-1)
+
+        if(len(self.gvecs)==0):
+            return []
+        if(self.tree==None):
+            self.build()
+
+        norm = np.sqrt(self.length)
+        idx,dist = self.tree.query_radius(ref_mat,threshold*norm,return_distance=True)
+        idx = idx[0]
+        dist = dist[0]/norm
+
+        # strict inequality as in ss_motif
+        keep = (dist<threshold)
+        if(sequence!=None):
+            assert(len(sequence)==self.length)
+            # windows are matched as in ss_motif, one target at a time
+            tt = self.target_idx[idx]
+            for t in np.unique(tt):
+                sel = (tt==t)
+                keep[sel] &= definitions.match_windows(self.rna_seq_id[t],sequence,self.windows[idx[sel]])
+
+        # return hits in the same order of the library
+        order = np.argsort(idx[keep],kind='stable')
+        idx = idx[keep][order]
+        dist = dist[keep][order]
+        return [[self.targets[self.target_idx[i]],int(self.frames[i]),float(d),self.residues(i)] for i,d in zip(idx,dist)]
+
+    def residues(self,i):
+
+        """ Residue names of window i """
+
+        seq = self.rna_seq[self.target_idx[i]]
+        return [seq[l] for l in self.windows[i]]
+
+    def sequence(self,i):
+
+        """ Sequence of window i """
+
+        seq = self.rna_seq_id[self.target_idx[i]]
+        return "".join([seq[l] for l in self.windows[i]])
+
+
+def load_library(filename):
+
+    """
+    Load a motif library saved with MotifLibrary.save
+
+    Parameters
+    ----------
+    filename : string
+        .npz filename
+
+    Returns
+    -------
+    library : MotifLibrary
+    """
+
+    data = np.load(filename)
+    lib = MotifLibrary(int(data["length"]),bulges=int(data["bulges"]),cutoff=float(data["cutoff"]))
+    lib.targets = list(data["targets"])
+    lib.gvecs = data["gvecs"]
+    lib.target_idx = data["target_idx"]
+    lib.frames = data["frames"]
+    lib.windows = data["windows"]
+    seq_start = data["seq_start"]
+    lib.rna_seq = [[str(el) for el in data["rna_seq"][seq_start[k]:seq_start[k+1]]] for k in range(len(lib.targets))]
+    lib.rna_seq_id = [[str(el) for el in data["rna_seq_id"][seq_start[k]:seq_start[k+1]]] for k in range(len(lib.targets))]
+    return lib
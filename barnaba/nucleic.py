@@ -16,6 +16,15 @@ import numpy as np
 import sys
 from . import definitions
 
+def _padded(lists):
+
+    # (n,k) array of indeces padded with -1 and mask of valid entries
+    width = max([len(el) for el in lists]+[0])
+    idx = np.zeros((len(lists),width),dtype=int)-1
+    for i,el in enumerate(lists):
+        idx[i,:len(el)] = el
+    return idx, idx>=0
+
 class Nucleic:
 
     def __init__(self,topology,modified=True):
@@ -80,8 +89,13 @@ class Nucleic:
             
         self.indeces_lcs = np.asarray(indeces_lcs).T
 
+        # donor and acceptor atoms of all residues, padded with -1.
+        # used to calculate hydrogen bonds of many pairs at once
+        self.donors_idx, self.donors_mask = _padded(self.donors)
+        self.acceptors_idx, self.acceptors_mask = _padded(self.acceptors)
+
         if(len(self.ok_residues)<1):
-            warn = "# Only %d  found in structure. Exiting \n" % len(ok_residues) 
+            warn = "# Only %d  found in structure. Exiting \n" % len(self.ok_residues) 
             sys.stderr.write(warn)
             sys.exit(1)
         #else:
@@ -296,4 +310,67 @@ class Nucleic:
                     
         return idxs, rr
 
+    def get_breaks(self,xyz=None,max_dist=0.25):
+
+        """
+        Find breaks in the chain, i.e. consecutive nucleotides that are not connected.
 
+        Parameters
+        ----------
+        xyz : (n_atoms,3) numpy array, optional
+            coordinates of one frame. If given, nucleotides are connected if the O3'-P distance is below *max_dist*.
+            Otherwise, or if O3' or P are missing, nucleotides are connected if their residue numbers are consecutive.
+        max_dist : float, optional
+            maximum O3'-P distance in nm. Default value is 0.25.
+
+        Returns
+        -------
+        breaks : (n) numpy array
+            True at position i if nucleotide i+1 does not follow nucleotide i in the same chain. The last element is True.
+        """
+
+        ll = len(self.ok_residues)
+        breaks = np.ones(ll,dtype=bool)
+        for i in range(ll-1):
+            res1 = self.ok_residues[i]
+            res2 = self.ok_residues[i+1]
+            if(res1.chain.index != res2.chain.index): continue
+            ats1 = [at.name for at in res1.atoms]
+            ats2 = [at.name for at in res2.atoms]
+            if(xyz is not None and "O3'" in ats1 and "P" in ats2):
+                dist = np.sqrt(np.sum((xyz[res2.atom("P").index]-xyz[res1.atom("O3'").index])**2))
+                breaks[i] = dist>max_dist
+            else:
+                breaks[i] = (res2.resSeq-res1.resSeq) not in [0,1]
+        return breaks
+
+    def get_hbond_idx(self,pairs):
+
+        """
+        Donor-acceptor atom pairs for a set of base pairs.
+
+        Parameters
+        ----------
+        pairs : (p,2) array
+            indeces of the residues (as in ok_residues)
+
+        Returns
+        -------
+        idx : (p,k,2) numpy array
+            atom indeces of all donor-acceptor combinations: donors of the first residue with acceptors of the
+            second, followed by acceptors of the first residue with donors of the second. Padded with -1.
+        mask : (p,k) numpy array
+            True where both atoms are present
+        """
+
+        pairs = np.asarray(pairs,dtype=int).reshape(-1,2)
+        nd = self.donors_idx.shape[1]
+        na = self.acceptors_idx.shape[1]
+        p = len(pairs)
+        d1 = self.donors_idx[pairs[:,0]][:,:,np.newaxis]
+        a2 = self.acceptors_idx[pairs[:,1]][:,np.newaxis,:]
+        a1 = self.acceptors_idx[pairs[:,0]][:,:,np.newaxis]
+        d2 = self.donors_idx[pairs[:,1]][:,np.newaxis,:]
+        idx = np.concatenate((np.stack(np.broadcast_arrays(d1,a2),axis=3).reshape(p,nd*na,2),\
+                              np.stack(np.broadcast_arrays(a1,d2),axis=3).reshape(p,na*nd,2)),axis=1)
+        return idx, np.all(idx>=0,axis=2)
@@ -0,0 +1,302 @@
+#   This is baRNAba, a tool for analysis of nucleic acid 3d structure
+#   Copyright (C) 2017 Sandro Bottaro (sandro.bottaro@bio.ku.dk)
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License V3 as published by
+#   the Free Software Foundation,
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Parallel execution of per-frame and per-file analyses """
+
+from __future__ import absolute_import, division, print_function
+
+# Make sure that range returns an iterator also in python2 (using future module)
+from builtins import range
+
+import multiprocessing as mp
+import numpy as np
+
+# number of blocks per process. More blocks give better load balance
+blocks_per_job = 4
+
+# set in each worker process by _init
+_coords = None
+_kernel = None
+_args = None
+
+def _init(buf,shape,kernel,args):
+
+    global _coords, _kernel, _args
+    _coords = np.frombuffer(buf,dtype=np.float32).reshape(shape)
+    _kernel = kernel
+    _args = args
+
+def _run(block):
+
+    start,stop = block
+    return _kernel(_coords[start:stop],*_args)
+
+def get_n_jobs(n_jobs):
+
+    """
+    Number of processes. If n_jobs < 1 or None, all available CPUs are used.
+    """
+
+    if(n_jobs==None or n_jobs<1):
+        return mp.cpu_count()
+    return n_jobs
+
+def get_blocks(n_frames,n_jobs):
+
+    """
+    Split n_frames into consecutive blocks, list of (start,stop)
+    """
+
+    n_blocks = max(1,min(n_frames,blocks_per_job*n_jobs))
+    bounds = np.linspace(0,n_frames,n_blocks+1).astype(int)
+    return [(bounds[k],bounds[k+1]) for k in range(n_blocks)]
+
+class FramePool:
+
+    """
+    Pool of processes that applies kernel(coords[start:stop],*args) to blocks of frames.
+    Coordinates are copied to a shared-memory buffer, so that they are not pickled for each task.
+    kernel and args are sent to each process only once.
+
+    Parameters
+    ----------
+    kernel : function
+        module-level function that takes a (b,...) float32 array of coordinates as first argument.
+    shape : tuple
+        maximum shape of the coordinates array, i.e. (n_frames,...)
+    n_jobs : int
+        number of processes
+    args : tuple
+        additional arguments to kernel
+    """
+
+    def __init__(self,kernel,shape,n_jobs,args=()):
+
+        self.shape = shape
+        self.n_jobs = n_jobs
+        self.buf = mp.RawArray('f',int(np.prod(shape)))
+        self.coords = np.frombuffer(self.buf,dtype=np.float32).reshape(shape)
+        self.pool = mp.Pool(n_jobs,initializer=_init,initargs=(self.buf,shape,kernel,args))
+
+    def map(self,coords):
+
+        """
+        Apply kernel to blocks of coords. Return list of (start,result) ordered by frame.
+        """
+
+        n_frames = coords.shape[0]
+        assert(n_frames<=self.shape[0])
+        self.coords[:n_frames] = coords
+        blocks = get_blocks(n_frames,self.n_jobs)
+        results = self.pool.map(_run,blocks)
+        return [(bb[0],rr) for bb,rr in zip(blocks,results)]
+
+    def imap(self,coords,block_size):
+
+        """
+        Apply kernel to blocks of block_size frames. Yield (start,result) ordered by frame, as soon as each block is done.
+        """
+
+        n_frames = coords.shape[0]
+        assert(n_frames<=self.shape[0])
+        self.coords[:n_frames] = coords
+        blocks = [(i0,min(i0+block_size,n_frames)) for i0 in range(0,n_frames,block_size)]
+        for bb,rr in zip(blocks,self.pool.imap(_run,blocks)):
+            yield bb[0], rr
+
+    def close(self):
+
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+
+        """
+        Stop the processes without waiting for pending blocks
+        """
+
+        self.pool.terminate()
+        self.pool.join()
+
+
+def map_frames(kernel,chunks,n_jobs=1,select=None,args=(),block_size=None):
+
+    """
+    Apply kernel to all frames of a trajectory, possibly in parallel.
+
+    Parameters
+    ----------
+    kernel : function
+        module-level function that takes a (b,...) array of coordinates as first argument, plus args.
+    chunks : iterator
+        iterator over (index of first frame, trajectory chunk)
+    n_jobs : int, optional
+        number of processes. The default (1) runs in the current process. If n_jobs < 1, all available CPUs are used.
+    select : array, optional
+        atom indeces. Kernel receives chunk.xyz[:,select]. By default all atoms are used.
+    args : tuple, optional
+        additional arguments to kernel
+    block_size : int, optional
+        If specified, kernel is applied to blocks of at most block_size frames, and results are yielded
+        as soon as each block is done. The caller can then stop early, without analyzing the remaining frames.
+        By default each chunk is split in a few large blocks.
+
+    Yields
+    -------
+    start : int
+        index of the first frame of chunk in the trajectory
+    chunk :
+        MDtraj trajectory chunk
+    first : int
+        index of the first frame of the block in chunk
+    result :
+        kernel output for the block of frames
+    """
+
+    n_jobs = get_n_jobs(n_jobs)
+    pool = None
+    try:
+        for start,chunk in chunks:
+            xyz = chunk.xyz if(select is None) else chunk.xyz[:,select]
+            if(n_jobs==1 or chunk.n_frames==1):
+                if(block_size==None):
+                    yield start, chunk, 0, kernel(xyz,*args)
+                    continue
+                for first in range(0,chunk.n_frames,block_size):
+                    yield start, chunk, first, kernel(xyz[first:first+block_size],*args)
+                continue
+            # the buffer is sized on the first chunk, which is the largest one
+            if(pool==None or xyz.shape[0]>pool.shape[0]):
+                if(pool!=None): pool.close()
+                pool = FramePool(kernel,xyz.shape,n_jobs,args)
+            results = pool.map(xyz) if(block_size==None) else pool.imap(xyz,block_size)
+            for first,result in results:
+                yield start, chunk, first, result
+    except GeneratorExit:
+        # the caller stopped early: do not wait for the pending blocks
+        if(pool!=None): pool.terminate()
+        pool = None
+        raise
+    finally:
+        if(pool!=None): pool.close()
+
+
+def _run_tile(tile):
+
+    i0,i1,j0,j1 = tile
+    return _kernel(_coords[i0:i1],_coords[j0:j1],*_args)
+
+def map_tiles(kernel,coords,tiles,n_jobs=1,args=()):
+
+    """
+    Apply kernel to tiles of a matrix of pairwise quantities, possibly in parallel.
+    Coordinates are copied to a shared-memory buffer only once.
+
+    Parameters
+    ----------
+    kernel : function
+        module-level function that takes two (b,...) float32 arrays of coordinates as first arguments, plus args.
+    coords : array
+        (n_frames,...) array of coordinates
+    tiles : list
+        list of (i0,i1,j0,j1). kernel receives coords[i0:i1] and coords[j0:j1]
+    n_jobs : int, optional
+        number of processes. The default (1) runs in the current process. If n_jobs < 1, all available CPUs are used.
+    args : tuple, optional
+        additional arguments to kernel
+
+    Yields
+    -------
+    tile : tuple
+        (i0,i1,j0,j1)
+    result :
+        kernel output for the tile
+    """
+
+    n_jobs = get_n_jobs(n_jobs)
+    if(n_jobs==1 or len(tiles)==1):
+        for tile in tiles:
+            i0,i1,j0,j1 = tile
+            yield tile, kernel(coords[i0:i1],coords[j0:j1],*args)
+        return
+
+    buf = mp.RawArray('f',int(np.prod(coords.shape)))
+    np.frombuffer(buf,dtype=np.float32).reshape(coords.shape)[:] = coords
+    pool = mp.Pool(n_jobs,initializer=_init,initargs=(buf,coords.shape,kernel,args))
+    try:
+        for tile,result in zip(tiles,pool.imap(_run_tile,tiles)):
+            yield tile, result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# set in each worker process by _init_files
+_file_func = None
+_file_args = None
+
+def _init_files(func,args):
+
+    global _file_func, _file_args
+    _file_func = func
+    _file_args = args
+
+def _run_file(filename):
+
+    # errors are returned, so that a single file does not stop the scan
+    try:
+        return filename, _file_func(filename,*_file_args), None
+    except (Exception,SystemExit) as e:
+        return filename, None, "%s %s" % (type(e).__name__,e)
+
+def map_files(func,filenames,n_jobs=1,args=()):
+
+    """
+    Apply func(filename,*args) to many files, possibly in parallel.
+    args are sent to each process only once.
+
+    Parameters
+    ----------
+    func : function
+        module-level function that takes a filename as first argument, plus args.
+    filenames : list
+        list of filenames
+    n_jobs : int, optional
+        number of processes. The default (1) runs in the current process. If n_jobs < 1, all available CPUs are used.
+    args : tuple, optional
+        additional arguments to func
+
+    Yields
+    -------
+    filename : string
+    result :
+        output of func, None if an error occurred
+    error : string
+        None, or description of the error raised while processing filename
+    """
+
+    n_jobs = get_n_jobs(n_jobs)
+    if(n_jobs==1):
+        _init_files(func,args)
+        for filename in filenames:
+            yield _run_file(filename)
+        return
+
+    pool = mp.Pool(n_jobs,initializer=_init_files,initargs=(func,args))
+    try:
+        # results are returned in the same order of filenames as soon as they are available
+        for result in pool.imap(_run_file,filenames):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
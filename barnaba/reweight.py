@@ -0,0 +1,245 @@
+#   This is baRNAba, a tool for analysis of nucleic acid 3d structure
+#   Copyright (C) 2017 Sandro Bottaro (sandro.bottaro@bio.ku.dk)
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License V3 as published by
+#   the Free Software Foundation,
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Maximum entropy reweighting of trajectories against experimental averages """
+
+from __future__ import absolute_import, division, print_function
+
+# Make sure that range returns an iterator also in python2 (using future module)
+from builtins import range
+
+import os
+import sys
+import shutil
+import numpy as np
+import mdtraj as md
+from scipy.optimize import minimize
+from . import definitions
+from . import nucleic
+from . import functions
+
+def calc_observables(filename,topology=None,residues=None,couplings=None,pairs=None,power=6,dtype=np.float32,out=None,chunk=None):
+
+    """
+    Calculate the observables of all frames, to be used for reweighting.
+
+    Parameters
+    ----------
+    filename : string
+         Filename of structure or trajectory, any format accepted by MDtraj can be used.
+    topology : string, optional
+         Topology filename. Must be specified if filename is a trajectory.
+    residues :  list, optional
+         Residues for which scalar couplings are calculated. The residue naming convention is RESNAME_RESNUMBER_CHAININDEX.
+         By default all residues are used.
+    couplings : list, optional
+         Scalar couplings, as in jcouplings. By default all couplings are calculated.
+         Couplings that cannot be calculated because of missing atoms are not included.
+    pairs : array, optional
+         (p,2) atom indeces. For each pair, the NOE-like observable r^(-power) is calculated, where r is the distance in nm.
+    power : float, optional
+         exponent of NOE-like observables. Default is 6.
+    dtype : numpy dtype, optional
+         type of the observables matrix. Default is float32.
+    out : string, optional
+         If specified, the matrix is written chunk by chunk to a .npy file with this name, which is returned memory-mapped.
+    chunk : int, optional
+         Read the trajectory in chunks of *chunk* frames instead of loading it in memory.
+
+    Returns
+    -------
+    array :
+        observables, numpy array (or memmap) with dimension (m,k). *m* is the number of frames and *k* the number of observables.
+    labels :
+        List of observable names: RESIDUE-COUPLING for couplings and NOE-ATOM1-ATOM2 for pairs.
+    """
+
+    traj = functions.load(filename,topology=topology,chunk=chunk)
+    warn = "# Loading %s \n" % filename
+    sys.stderr.write(warn)
+    return calc_observables_traj(traj,residues=residues,couplings=couplings,pairs=pairs,power=power,dtype=dtype,out=out)
+
+def calc_observables_traj(traj,residues=None,couplings=None,pairs=None,power=6,dtype=np.float32,out=None):
+
+    top, chunks = functions._chunks(traj)
+    # initialize nucleic class
+    nn = nucleic.Nucleic(top)
+    all_idx,rr = nn.get_coupling_idx(residues)
+    if(couplings==None):
+        couplings = [str(el) for el in definitions.couplings_idx.keys()]
+    for name in couplings:
+        assert name in definitions.couplings_idx, "# coupling %s not available. Choose from: %s" % (name,list(definitions.couplings_idx.keys()))
+    idx_angles = [definitions.couplings_idx[name] for name in couplings]
+
+    # couplings are calculated only if all four atoms are present
+    present = (np.sum(all_idx[:,idx_angles,:],axis=2)!=0)
+    keep = np.where(present.reshape(-1))[0]
+    labels = ["%s-%s" % (rr[i],name) for i in range(len(rr)) for name in couplings]
+    labels = [labels[i] for i in keep]
+    if(pairs is not None):
+        pairs = np.asarray(pairs,dtype=int).reshape(-1,2)
+        atoms = list(top.atoms)
+        labels += ["NOE-%s-%s" % (atoms[i],atoms[j]) for i,j in pairs]
+
+    fh = None
+    blocks = []
+    if(out!=None):
+        fh = open(out + ".tmp",'wb')
+    n_frames = 0
+    for start,chunk,(torsions,) in functions._iter_dihedrals(chunks,[all_idx]):
+        block = [functions._karplus(torsions,couplings,idx_angles).reshape(torsions.shape[0],-1)[:,keep]]
+        if(pairs is not None):
+            block.append(md.compute_distances(chunk,pairs)**(-power))
+        block = np.concatenate(block,axis=1).astype(dtype)
+        n_frames += block.shape[0]
+        if(fh!=None):
+            block.tofile(fh)
+        else:
+            blocks.append(block)
+
+    if(fh==None):
+        return np.concatenate(blocks), labels
+
+    # write the .npy header, now that the number of frames is known
+    fh.close()
+    obs = np.lib.format.open_memmap(out,mode='w+',dtype=dtype,shape=(n_frames,len(labels)))
+    offset = obs.offset
+    del obs
+    with open(out,'r+b') as fout, open(out + ".tmp",'rb') as fin:
+        fout.seek(offset)
+        shutil.copyfileobj(fin,fout)
+    os.remove(out + ".tmp")
+    return np.load(out,mmap_mode='r'), labels
+
+def _blocks(obs,chunk):
+
+    # iterate over (start,float64 block of rows)
+    m = obs.shape[0]
+    if(chunk==None):
+        chunk = m
+    for start in range(0,m,chunk):
+        yield start, np.asarray(obs[start:start+chunk],dtype=float)
+
+def average(obs,weights=None,chunk=None):
+
+    """
+    Weighted average of observables.
+
+    Parameters
+    ----------
+    obs : array
+        (m,k) observables, e.g. as returned by calc_observables. Can be a memory-mapped array.
+    weights : array, optional
+        weight of each frame. By default all frames have the same weight.
+    chunk : int, optional
+        number of rows processed at a time. By default all rows are processed at once.
+
+    Returns
+    -------
+    array :
+        (k,) averages
+    """
+
+    if(weights is None):
+        weights = np.ones(obs.shape[0])
+    weights = np.asarray(weights,dtype=float)
+    assert(len(weights)==obs.shape[0])
+    avg = np.zeros(obs.shape[1])
+    for start,block in _blocks(obs,chunk):
+        avg += np.dot(weights[start:start+block.shape[0]],block)
+    return avg/np.sum(weights)
+
+def _log_partition(lambdas,obs,log_w0,chunk):
+
+    # log Z and average of observables with weights w0*exp(-lambda*obs).
+    # streaming log-sum-exp over blocks of rows
+    lmax = -np.inf
+    zsum = 0.0
+    ssum = np.zeros(obs.shape[1])
+    for start,block in _blocks(obs,chunk):
+        logw = log_w0[start:start+block.shape[0]] - np.dot(block,lambdas)
+        bmax = np.max(logw)
+        if(bmax>lmax):
+            scale = np.exp(lmax-bmax)
+            zsum *= scale
+            ssum *= scale
+            lmax = bmax
+        ww = np.exp(logw-lmax)
+        zsum += np.sum(ww)
+        ssum += np.dot(ww,block)
+    return lmax+np.log(zsum), ssum/zsum
+
+def maxent(obs,exp,sigma,theta=1.0,weights=None,chunk=None,tol=1.0e-10,max_iter=10000):
+
+    """
+    Maximum entropy reweighting with Gaussian errors (Bayesian/MaxEnt).
+    The weights w_i = w0_i exp(-lambda*obs_i)/Z are found by minimizing
+    log Z(lambda) + lambda*exp + theta/2 sum (sigma*lambda)^2 with L-BFGS.
+    Function and gradient are calculated together with one pass over obs, a block of rows at a time.
+
+    Parameters
+    ----------
+    obs : array
+        (m,k) observables, e.g. as returned by calc_observables. Can be a float32 or memory-mapped array.
+    exp : array
+        (k,) experimental averages
+    sigma : array or float
+        (k,) experimental plus forward-model errors
+    theta : float, optional
+        confidence in the prior ensemble. Larger values give weights closer to the prior. Default is 1.
+    weights : array, optional
+        prior weight of each frame. By default all frames have the same weight.
+    chunk : int, optional
+        number of rows processed at a time. By default all rows are processed at once.
+    tol : float, optional
+        tolerance of the minimization
+    max_iter : int, optional
+        maximum number of iterations
+
+    Returns
+    -------
+    weights : array
+        (m,) normalized weights. They can be used as sample_weight in cluster.pca and cluster.dbscan
+        (multiply by m to preserve the meaning of min_samples in dbscan).
+    lambdas : array
+        (k,) Lagrange multipliers
+    """
+
+    m, k = obs.shape
+    exp = np.asarray(exp,dtype=float)
+    sigma2 = np.broadcast_to(np.asarray(sigma,dtype=float)**2,(k,))
+    assert(exp.shape==(k,))
+    if(weights is None):
+        log_w0 = np.zeros(m)
+    else:
+        weights = np.asarray(weights,dtype=float)
+        assert(len(weights)==m)
+        with np.errstate(divide='ignore'):
+            log_w0 = np.log(weights/np.sum(weights))
+
+    def func(lambdas):
+        log_z, avg = _log_partition(lambdas,obs,log_w0,chunk)
+        gamma = log_z + np.dot(lambdas,exp) + 0.5*theta*np.sum(sigma2*lambdas**2)
+        grad = exp - avg + theta*sigma2*lambdas
+        return gamma, grad
+
+    res = minimize(func,np.zeros(k),jac=True,method="L-BFGS-B",options={"maxiter":max_iter,"gtol":tol,"ftol":tol})
+    if(not res.success):
+        sys.stderr.write("# Warning: minimization did not converge: %s \n" % res.message)
+    lambdas = res.x
+
+    # final weights
+    log_z, avg = _log_partition(lambdas,obs,log_w0,chunk)
+    new_weights = np.empty(m)
+    for start,block in _blocks(obs,chunk):
+        new_weights[start:start+block.shape[0]] = np.exp(log_w0[start:start+block.shape[0]] - np.dot(block,lambdas) - log_z)
+    return new_weights, lambdas
@@ -0,0 +1,269 @@
+#   This is baRNAba, a tool for analysis of nucleic acid 3d structure
+#   Copyright (C) 2017 Sandro Bottaro (sandro.bottaro@bio.ku.dk)
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License V3 as published by
+#   the Free Software Foundation,
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Streaming statistics of torsion angles and sugar puckers """
+
+from __future__ import absolute_import, division, print_function
+
+# Make sure that range returns an iterator also in python2 (using future module)
+from builtins import range
+
+import sys
+import numpy as np
+from . import definitions
+from . import nucleic
+from . import functions
+
+def _frame_weights(weights,n_frames):
+
+    if(weights is None):
+        return np.ones(n_frames)
+    weights = np.asarray(weights,dtype=float)
+    assert(len(weights)==n_frames)
+    return weights
+
+class CircularStats:
+
+    """
+    Weighted circular mean, concentration and histogram of angles, updated chunk by chunk.
+    Memory usage is proportional to the number of angles times the number of bins, and does not depend on the number of frames.
+    NaN values (e.g. missing atoms) are ignored.
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of the angles in each frame, e.g. (n,7) for the backbone angles of n residues
+    bins : int, optional
+        number of histogram bins between -pi and pi. Default value is 36.
+    """
+
+    def __init__(self,shape,bins=36):
+
+        self.shape = tuple(shape)
+        self.bins = bins
+        self.edges = np.linspace(-np.pi,np.pi,bins+1)
+        self.n_frames = 0
+        self.weight = np.zeros(self.shape)
+        self.sum_cos = np.zeros(self.shape)
+        self.sum_sin = np.zeros(self.shape)
+        self.hist = np.zeros(self.shape+(bins,))
+
+    def update(self,angles,weights=None):
+
+        """
+        Add frames to the statistics.
+
+        Parameters
+        ----------
+        angles : array
+            angles in radians, with dimension (m,)+shape
+        weights : array, optional
+            weights of the m frames. By default all frames have the same weight.
+        """
+
+        angles = np.asarray(angles,dtype=float)
+        assert(angles.shape[1:]==self.shape)
+        m = angles.shape[0]
+        ok = ~np.isnan(angles)
+        ww = _frame_weights(weights,m).reshape((m,)+(1,)*len(self.shape))*ok
+        angles = np.where(ok,angles,0.0)
+
+        self.n_frames += m
+        self.weight += np.sum(ww,axis=0)
+        self.sum_cos += np.sum(ww*np.cos(angles),axis=0)
+        self.sum_sin += np.sum(ww*np.sin(angles),axis=0)
+
+        # all histograms are updated with a single bincount
+        bin_idx = np.floor((np.mod(angles+np.pi,2.0*np.pi))*self.bins/(2.0*np.pi)).astype(int)
+        bin_idx[bin_idx==self.bins] = self.bins-1
+        n_angles = int(np.prod(self.shape))
+        flat = np.arange(n_angles)[np.newaxis,:]*self.bins + bin_idx.reshape(m,n_angles)
+        self.hist += np.bincount(flat.reshape(-1),weights=ww.reshape(-1),minlength=n_angles*self.bins).reshape(self.hist.shape)
+
+    def mean(self):
+
+        """ Circular mean in radians, between -pi and pi. NaN if no data are available. """
+
+        mean = np.arctan2(self.sum_sin,self.sum_cos)
+        mean[self.weight==0.0] = np.nan
+        return mean
+
+    def resultant_length(self):
+
+        """ Mean resultant length, between 0 (uniform) and 1 (all angles equal). NaN if no data are available. """
+
+        with np.errstate(divide='ignore',invalid='ignore'):
+            return np.sqrt(self.sum_cos**2+self.sum_sin**2)/self.weight
+
+    def std(self):
+
+        """ Circular standard deviation in radians, sqrt(-2 log R) """
+
+        rr = self.resultant_length()
+        with np.errstate(divide='ignore'):
+            return np.sqrt(-2.0*np.log(rr))
+
+    def concentration(self):
+
+        """
+        Concentration parameter kappa of a von Mises distribution, estimated from the mean resultant length
+        (approximation in Fisher, Statistical analysis of circular data, 1993).
+        """
+
+        rr = self.resultant_length()
+        kappa = np.full(rr.shape,np.nan)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            low = rr<0.53
+            kappa[low] = 2.0*rr[low] + rr[low]**3 + 5.0*rr[low]**5/6.0
+            mid = (rr>=0.53) & (rr<0.85)
+            kappa[mid] = -0.4 + 1.39*rr[mid] + 0.43/(1.0-rr[mid])
+            high = rr>=0.85
+            kappa[high] = 1.0/(rr[high]**3 - 4.0*rr[high]**2 + 3.0*rr[high])
+        return kappa
+
+    def histogram(self,density=False):
+
+        """
+        Weighted histogram of the angles, with dimension shape+(bins,). Bin edges are in self.edges.
+        If density is True, the histogram is normalized to a probability density.
+        """
+
+        if(not density):
+            return np.copy(self.hist)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            return self.hist/(self.weight[...,np.newaxis]*(2.0*np.pi/self.bins))
+
+
+class PuckerPopulations:
+
+    """
+    Weighted populations of sugar pucker states, updated chunk by chunk.
+    Frames where the pseudorotation phase is NaN are ignored.
+
+    Parameters
+    ----------
+    n : int
+        number of residues
+    states : dict, optional
+        phase range [start,end) in radians of each state. The range can wrap around 2pi (start > end).
+        Default is definitions.pucker_states (C3'-endo and C2'-endo).
+    """
+
+    def __init__(self,n,states=None):
+
+        if(states==None):
+            states = definitions.pucker_states
+        self.names = list(states.keys())
+        self.ranges = [states[name] for name in self.names]
+        self.n_frames = 0
+        self.weight = np.zeros(n)
+        self.counts = np.zeros((n,len(self.names)))
+
+    def update(self,pucker,weights=None):
+
+        """
+        Add frames to the populations.
+
+        Parameters
+        ----------
+        pucker : array
+            phase and amplitude as returned by pucker_angles, with dimension (m,n,2)
+        weights : array, optional
+            weights of the m frames. By default all frames have the same weight.
+        """
+
+        phase = np.asarray(pucker)[:,:,0]
+        m = phase.shape[0]
+        ok = ~np.isnan(phase)
+        ww = _frame_weights(weights,m)[:,np.newaxis]*ok
+        phase = np.mod(np.where(ok,phase,0.0),2.0*np.pi)
+
+        self.n_frames += m
+        self.weight += np.sum(ww,axis=0)
+        for k,(start,end) in enumerate(self.ranges):
+            start = np.mod(start,2.0*np.pi)
+            end = np.mod(end,2.0*np.pi) if(end!=2.0*np.pi) else end
+            if(start<=end):
+                inside = (phase>=start) & (phase<end)
+            else:
+                inside = (phase>=start) | (phase<end)
+            self.counts[:,k] += np.sum(ww*inside,axis=0)
+
+    def populations(self):
+
+        """ Populations of each state, with dimension (n,number of states). The order of the states is in self.names """
+
+        with np.errstate(divide='ignore',invalid='ignore'):
+            return self.counts/self.weight[:,np.newaxis]
+
+
+def torsion_stats(filename,topology=None,residues=None,weights=None,bins=36,states=None,chunk=1000):
+
+    """
+    Statistics of backbone angles and populations of sugar puckers, reading the trajectory in chunks.
+    The full time series of the angles is never stored in memory.
+
+    Parameters
+    ----------
+    filename : string
+         Filename of structure or trajectory, any format accepted by MDtraj can be used.
+    topology : string, optional
+         Topology filename. Must be specified if filename is a trajectory.
+    residues :  list, optional
+         If a list of residues is specified, only the selected residues will be calculated. Otherwise, the calculation is performed for all residues.
+         The residue naming convention is RESNAME_RESNUMBER_CHAININDEX
+    weights : array, optional
+         weight of each frame, e.g. from reweighting. By default all frames have the same weight.
+    bins : int, optional
+         number of histogram bins. Default value is 36.
+    states : dict, optional
+         pucker states, see PuckerPopulations
+    chunk : int, optional
+         number of frames read at a time. Default value is 1000.
+
+    Returns
+    -------
+    backbone : CircularStats
+        statistics of the backbone angles, with shape (n,7)
+    pucker : PuckerPopulations
+        populations of the pucker states
+    seq :
+        List of residue names. Each residue is identified with the string RESNAME_RESNUMBER_CHAININDEX
+    """
+
+    traj = functions.load(filename,topology=topology,chunk=chunk)
+    warn = "# Loading %s \n" % filename
+    sys.stderr.write(warn)
+    return torsion_stats_traj(traj,residues=residues,weights=weights,bins=bins,states=states)
+
+def torsion_stats_traj(traj,residues=None,weights=None,bins=36,states=None):
+
+    top, chunks = functions._chunks(traj)
+    # initialize nucleic class
+    nn = nucleic.Nucleic(top)
+    bb_idx,rr = nn.get_bb_torsion_idx(residues)
+    sugar_idx,rr = nn.get_sugar_torsion_idx(residues)
+
+    backbone = CircularStats(bb_idx.shape[:2],bins=bins)
+    pucker = PuckerPopulations(len(rr),states=states)
+    n_frames = 0
+    for start,chunk,(bb_angles,sugar_angles) in functions._iter_dihedrals(chunks,[bb_idx,sugar_idx]):
+        ww = None
+        if(weights is not None):
+            ww = np.asarray(weights[start:start+bb_angles.shape[0]],dtype=float)
+            assert len(ww)==bb_angles.shape[0], "# number of weights is smaller than the number of frames"
+        backbone.update(bb_angles,ww)
+        pucker.update(functions._pucker(sugar_angles),ww)
+        n_frames = start+bb_angles.shape[0]
+    if(weights is not None):
+        assert len(weights)==n_frames, "# number of weights is larger than the number of frames"
+    return backbone, pucker, rr
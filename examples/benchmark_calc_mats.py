@@ -0,0 +1,97 @@
+from __future__ import absolute_import, division, print_function
+# Microbenchmark for the per-pair projection in calc_mats.calc_3dmat
+# and for the search of close pairs (distance matrix vs KD-tree).
+# Run from the root directory:
+#
+# > python examples/benchmark_calc_mats.py
+#
+# The large structure is built by replicating 1y26 on a grid,
+# so that it contains roughly as many nucleotides as a ribosome.
+
+import os
+import sys
+import time
+import numpy as np
+import mdtraj as md
+from scipy.spatial import distance
+
+import barnaba.nucleic as nucleic
+import barnaba.calc_mats as ff
+import barnaba.definitions as definitions
+
+cwd = os.getcwd()
+fname = "%s/test/data/1y26.pdb" % cwd
+
+
+def calc_3dmat_loop(coords,cutoff):
+    # reference implementation with one np.dot per pair
+    lcs,origo= ff.calc_lcs(coords)
+    max_r  = np.max(definitions.f_factors)*cutoff
+    dmat = distance.squareform(distance.pdist(origo))
+    m_idx = np.array(np.where((dmat<max_r) & (dmat>0.01))).T
+    diff = origo[m_idx[:,1]]-origo[m_idx[:,0]]
+    dotp = np.array([np.dot(diff[i],lcs[j]) for i,j in zip(range(len(diff)),m_idx[:,0])])
+    return dotp,m_idx
+
+
+def replicate(coords,ncopies,shift=8.0):
+    # place copies of the molecule on a cubic grid
+    side = int(np.ceil(ncopies**(1./3.)))
+    copies = []
+    for k in range(ncopies):
+        offset = shift*np.array([k % side,(k//side) % side,k//(side*side)])
+        copies.append(coords + offset[np.newaxis,np.newaxis,:])
+    return np.concatenate(copies,axis=1)
+
+
+def timeit(func,coords,cutoff,nrep):
+    t0 = time.time()
+    for i in range(nrep):
+        func(coords,cutoff)
+    return (time.time()-t0)/nrep
+
+
+def bench(label,coords,cutoff=2.4,nrep=5):
+    dotp1,m_idx1 = calc_3dmat_loop(coords,cutoff)
+    dotp2,m_idx2 = ff.calc_3dmat(coords,cutoff)
+    assert np.array_equal(m_idx1,m_idx2)
+    assert np.allclose(dotp1,dotp2,atol=1.0e-5)
+
+    t_loop = timeit(calc_3dmat_loop,coords,cutoff,nrep)
+    t_vec = timeit(ff.calc_3dmat,coords,cutoff,nrep)
+    print("%-10s %6d nt %8d pairs   loop: %8.4f s/frame   batched: %8.4f s/frame   speedup: %6.1fx" \
+          % (label,coords.shape[1],len(m_idx1),t_loop,t_vec,t_loop/t_vec))
+
+
+def bench_pairs(coords,sizes,cutoff=2.4,nrep=3):
+    max_r  = np.max(definitions.f_factors)*cutoff
+    kdtree_size = ff.kdtree_size
+    for ncopies in sizes:
+        lcs,origo = ff.calc_lcs(replicate(coords,ncopies))
+        ff.kdtree_size = origo.shape[0]+1
+        t0 = time.time()
+        for i in range(nrep):
+            m_idx1 = ff.calc_pairs(origo,max_r,0.01)
+        t1 = time.time()
+        ff.kdtree_size = 0
+        for i in range(nrep):
+            m_idx2 = ff.calc_pairs(origo,max_r,0.01)
+        t2 = time.time()
+        assert np.array_equal(m_idx1,m_idx2)
+        print("%-10s %6d nt %8d pairs  dense: %8.4f s/frame    kdtree: %8.4f s/frame" \
+              % ("pairs",origo.shape[0],len(m_idx1),(t1-t0)/nrep,(t2-t1)/nrep))
+    ff.kdtree_size = kdtree_size
+
+
+if __name__ == "__main__":
+
+    pdb = md.load(fname)
+    nn = nucleic.Nucleic(pdb.topology)
+    coords = pdb.xyz[0,nn.indeces_lcs]
+
+    ncopies = 3000//coords.shape[1]+1
+    if(len(sys.argv)>1):
+        ncopies = int(sys.argv[1])
+    bench("1y26",coords,nrep=20)
+    bench("large",replicate(coords,ncopies),nrep=2)
+    bench_pairs(coords,[2,8,32,128])
@@ -2,6 +2,7 @@ from __future__ import absolute_import, division, print_function
 import barnaba as bb
 import barnaba.definitions as dd
 import os
+import numpy as np
 from comp_mine import comp
 
 cwd = os.getcwd()
@@ -95,6 +96,37 @@ def test_angles_4():
     fh.write(stri)
     fh.close()
     comp("%s/angles_04.test.dat" % refdir)
+
+
+def test_angles_chunk():
+    
+    resi = ["RG_69_0","RU_37_0"]
+    angles = ["gamma","alpha"]
+    
+    angles_b,rr = bb.backbone_angles(fname1,topology=fname,residues=resi,angles=angles,chunk=10)
+    stri = ""
+    for p in range(angles_b.shape[0]):
+        for k in range(angles_b.shape[2]):
+            stri += " %10.4f %10.4f " % (angles_b[p,0,k],angles_b[p,1,k])
+        stri += "\n"
         
+    fh = open("%s/angles_04.test.dat" % outdir,'w')
+    fh.write(stri)
+    fh.close()
+    comp("%s/angles_04.test.dat" % refdir)
+        
+
+
 
+def test_torsions():
 
+    # all angles from a single read give the same values as separate calls
+    angles,rr = bb.torsions(fname1,topology=fname,backbone=True,pucker=True,couplings=True,chunk=30)
+    assert(sorted(angles.keys())==["backbone","couplings","pucker"])
+    angles_b,rr_b = bb.backbone_angles(fname1,topology=fname)
+    angles_p,rr_p = bb.pucker_angles(fname1,topology=fname)
+    angles_j,rr_j = bb.jcouplings(fname1,topology=fname)
+    assert(rr==rr_b)
+    assert(np.array_equal(angles["backbone"],angles_b,equal_nan=True))
+    assert(np.array_equal(angles["pucker"],angles_p,equal_nan=True))
+    assert(np.array_equal(angles["couplings"],angles_j,equal_nan=True))
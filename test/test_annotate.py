@@ -92,3 +92,37 @@ def test_annotate_2():
     
 
 
+def test_annotate_chunk():
+
+    # frames annotated in blocks give the same result as the whole trajectory
+    import barnaba.calc_mats as ff
+    stackings, pairings, res = bb.annotate(fname1,topology=fname)
+    stackings_c, pairings_c, res_c = bb.annotate(fname1,topology=fname,chunk=7)
+    # frames of a chunk are split in blocks of 3 frames
+    block_size = ff.block_size
+    ff.block_size = 3*71*71
+    try:
+        stackings_b, pairings_b, res_b = bb.annotate(fname1,topology=fname)
+    finally:
+        ff.block_size = block_size
+    assert(res==res_c==res_b)
+    for a,b in [(stackings,stackings_c),(pairings,pairings_c),(stackings,stackings_b),(pairings,pairings_b)]:
+        assert(len(a)==len(b))
+        for fa,fb in zip(a,b):
+            assert([list(p) for p in fa[0]]==[list(p) for p in fb[0]])
+            assert(list(fa[1])==list(fb[1]))
+
+def test_hbond_idx():
+
+    # padded donor-acceptor tables contain the same atom pairs as the per-residue lists
+    import itertools
+    import mdtraj as md
+    from barnaba import nucleic
+    nn = nucleic.Nucleic(md.load(fname).topology)
+    pairs = [[0,1],[2,5],[3,3]]
+    idx, mask = nn.get_hbond_idx(pairs)
+    assert(idx.shape[:2]==mask.shape)
+    for (i,j),ii,mm in zip(pairs,idx,mask):
+        ll = list(itertools.product(nn.donors[i],nn.acceptors[j])) + list(itertools.product(nn.acceptors[i],nn.donors[j]))
+        assert(sorted([tuple(el) for el in ii[mm]])==sorted(ll))
+
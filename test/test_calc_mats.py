@@ -0,0 +1,66 @@
+from __future__ import absolute_import, division, print_function
+import os
+import numpy as np
+import mdtraj as md
+from scipy.spatial import distance
+import barnaba.nucleic as nucleic
+import barnaba.calc_mats as ff
+import barnaba.definitions as definitions
+
+cwd = os.getcwd()
+fname = "%s/test/data/1y26.pdb" % cwd
+
+
+def calc_3dmat_loop(coords,cutoff):
+    # reference implementation with one np.dot per pair
+    lcs,origo= ff.calc_lcs(coords)
+    max_r  = np.max(definitions.f_factors)*cutoff
+    dmat = distance.squareform(distance.pdist(origo))
+    m_idx = np.array(np.where((dmat<max_r) & (dmat>0.01))).T
+    diff = origo[m_idx[:,1]]-origo[m_idx[:,0]]
+    dotp = np.array([np.dot(diff[i],lcs[j]) for i,j in zip(range(len(diff)),m_idx[:,0])])
+    return dotp,m_idx
+
+
+def replicate(coords,ncopies,shift=8.0):
+    # place copies of the molecule on a cubic grid
+    side = int(np.ceil(ncopies**(1./3.)))
+    copies = []
+    for k in range(ncopies):
+        offset = shift*np.array([k % side,(k//side) % side,k//(side*side)])
+        copies.append(coords + offset[np.newaxis,np.newaxis,:])
+    return np.concatenate(copies,axis=1)
+
+
+def get_coords():
+    pdb = md.load(fname)
+    nn = nucleic.Nucleic(pdb.topology)
+    return pdb.xyz[0,nn.indeces_lcs]
+
+
+def test_calc_3dmat():
+
+    coords = get_coords()
+    # small structure and a structure large enough to use the KD-tree
+    for cc in [coords,replicate(coords,8)]:
+        dotp1,m_idx1 = calc_3dmat_loop(cc,2.4)
+        dotp2,m_idx2 = ff.calc_3dmat(cc,2.4)
+        assert np.array_equal(m_idx1,m_idx2)
+        assert np.allclose(dotp1,dotp2,atol=1.0e-5)
+
+
+def test_calc_pairs():
+
+    # distance matrix and KD-tree give the same pairs, in the same order
+    lcs,origo = ff.calc_lcs(replicate(get_coords(),8))
+    max_r  = np.max(definitions.f_factors)*2.4
+    kdtree_size = ff.kdtree_size
+    try:
+        ff.kdtree_size = origo.shape[0]+1
+        m_idx1 = ff.calc_pairs(origo,max_r,0.01)
+        ff.kdtree_size = 0
+        m_idx2 = ff.calc_pairs(origo,max_r,0.01)
+    finally:
+        ff.kdtree_size = kdtree_size
+    assert len(m_idx1)>0
+    assert np.array_equal(m_idx1,m_idx2)
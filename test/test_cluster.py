@@ -59,3 +59,17 @@ def test_cluster():
     #plt.close()
 
 
+
+def test_pca_sparse():
+
+    # PCA on sparse G-vectors must match the dense calculation
+    t = md.load("%s/test/data/samples.xtc" % cwd, top="%s/test/data/sample1.pdb" % cwd)
+    t = t.atom_slice(t.topology.select("resid 0 to 19"))
+    gvec,seq = bb.dump_gvec_traj(t)
+    gvec = gvec.reshape(gvec.shape[0],-1)
+    gvec_sp,seq = bb.dump_gvec_traj(t,sparse=True)
+    
+    v,w = cc.pca(gvec,nevecs=3)
+    v_sp,w_sp = cc.pca(gvec_sp,nevecs=3)
+    assert np.allclose(v,v_sp)
+    assert np.allclose(np.abs(w),np.abs(w_sp))
@@ -2,6 +2,7 @@ from __future__ import absolute_import, division, print_function
 import barnaba as bb
 import os
 import filecmp
+import numpy as np
 from comp_mine import comp
 
 cwd = os.getcwd()
@@ -42,3 +43,13 @@ def test_couplings_2():
     fh.write(stri)
     fh.close()
     comp("%s/couplings_02.test.dat" % refdir)
+
+def test_couplings_average():
+
+    # weighted averages accumulated in chunks
+    couplings,rr = bb.jcouplings(traj,topology=top)
+    weights = np.linspace(1.0,2.0,couplings.shape[0])
+    average,rr1 = bb.jcouplings(traj,topology=top,average=True,weights=weights,chunk=17)
+    assert(rr==rr1)
+    assert(average.shape==couplings.shape[1:])
+    assert(np.allclose(average,np.average(couplings,axis=0,weights=weights),equal_nan=True))
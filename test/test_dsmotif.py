@@ -2,6 +2,12 @@ from __future__ import absolute_import, division, print_function
 import barnaba as bb
 import os
 import glob
+import itertools
+import numpy as np
+import mdtraj as md
+import barnaba.definitions as definitions
+import barnaba.calc_mats as ff
+from barnaba import nucleic
 from comp_mine import comp
 
 cwd = os.getcwd()
@@ -31,3 +37,66 @@ def test_ssmotif():
     for f in of:
         comp(f)
 
+
+def test_dsmotif_combinations():
+
+    # hits are made of distinct nucleotides and eRMSD is below threshold
+    fname2 = "%s/test/data/1y26.pdb" % cwd
+    dist = bb.ds_motif(fname,fname2,l1=8,l2=7,bulges=1,threshold=2.0)
+    assert len(dist)>0
+    for el in dist:
+        assert len(set(el[2]))==15
+        assert el[1]<2.0
+    assert bb.ds_motif(fname,fname2,l1=8,l2=7,bulges=1,threshold=2.0,n_jobs=2)==dist
+    assert bb.ds_motif(fname,fname2,l1=8,l2=7,bulges=1,threshold=2.0,max_hits=3)==dist[:3]
+
+def ds_motif_reference(query,target,l1,l2,threshold,bulges,cutoff=2.4):
+
+    # exhaustive enumeration of all pairs of strands, as in the original implementation
+    ref = md.load(query)
+    nn_ref = nucleic.Nucleic(ref.topology)
+    coords_ref = ref.xyz[0,nn_ref.indeces_lcs]
+    ref_mat = ff.calc_gmat(coords_ref,cutoff).reshape(-1)
+    ref_mat1 = ff.calc_gmat(coords_ref[:,:l1],cutoff).reshape(-1)
+    ref_mat2 = ff.calc_gmat(coords_ref[:,l1:],cutoff).reshape(-1)
+    com1 = np.average(np.average(coords_ref[:,:l1],axis=0),axis=0)
+    com2 = np.average(np.average(coords_ref[:,l1:],axis=0),axis=0)
+    dcom_ref = np.sqrt(np.sum((com1-com2)**2))
+
+    traj = md.load(target)
+    nn = nucleic.Nucleic(traj.topology)
+    breaks = nn.get_breaks(traj.xyz[0])
+    all_idx1 = definitions.get_idx(nn.rna_seq_id,"N"*l1,bulges,breaks=breaks)
+    all_idx2 = definitions.get_idx(nn.rna_seq_id,"N"*l2,bulges,breaks=breaks)
+    hits = []
+    for i in range(traj.n_frames):
+        xyz = traj.xyz[i,nn.indeces_lcs]
+        dd1 = np.sqrt(np.sum((ff.calc_gmat_windows(xyz,cutoff,all_idx1)-ref_mat1)**2,axis=1)/l1)
+        dd2 = np.sqrt(np.sum((ff.calc_gmat_windows(xyz,cutoff,all_idx2)-ref_mat2)**2,axis=1)/l2)
+        low1 = np.where(dd1<threshold)[0]
+        low2 = np.where(dd2<threshold)[0]
+        centers = np.average(xyz,axis=0)
+        pairs = np.array(list(itertools.product(low1,low2)),dtype=int).reshape(-1,2)
+        idx_combo = np.concatenate((all_idx1[pairs[:,0]],all_idx2[pairs[:,1]]),axis=1)
+        distinct = np.array([len(set(cc))==l1+l2 for cc in idx_combo],dtype=bool)
+        com1 = np.average(centers[all_idx1[pairs[:,0]]],axis=1)
+        com2 = np.average(centers[all_idx2[pairs[:,1]]],axis=1)
+        close = np.sqrt(np.sum((com1-com2)**2,axis=1))<=2.5*dcom_ref
+        idx_combo = idx_combo[distinct & close]
+        if(len(idx_combo)==0): continue
+        dd = np.sqrt(np.sum((ff.calc_gmat_windows(xyz,cutoff,idx_combo)-ref_mat)**2,axis=1)/(l1+l2))
+        for k in np.where(dd<threshold)[0]:
+            hits.append([i,dd[k],[nn.rna_seq[l] for l in idx_combo[k]]])
+    return hits
+
+def test_dsmotif_reference():
+
+    # same hits, in the same order, as the exhaustive enumeration
+    fname2 = "%s/test/data/1y26.pdb" % cwd
+    for bulges,threshold in [(0,2.0),(1,1.6)]:
+        dist = bb.ds_motif(fname,fname2,l1=8,l2=7,bulges=bulges,threshold=threshold)
+        ref = ds_motif_reference(fname,fname2,8,7,threshold,bulges)
+        assert len(dist)==len(ref)>0
+        for el1,el2 in zip(dist,ref):
+            assert el1[0]==el2[0] and el1[2]==el2[2]
+            assert abs(el1[1]-el2[1])<1.0e-5
@@ -40,3 +40,66 @@ def test_dump():
     
 
     
+
+def test_dump_traj():
+
+    # batched G-vectors must match the frame-by-frame calculation
+    import numpy as np
+    import mdtraj as md
+    import barnaba.nucleic as nucleic
+    import barnaba.calc_mats as ff
+
+    fname1 = "%s/test/data/samples.xtc" % cwd
+    traj = md.load(fname1,top=fname)
+    gvecs,resi = bb.dump_gvec_traj(traj)
+    rvecs,resi = bb.dump_rvec_traj(traj,cutoff=1.7)
+
+    nn = nucleic.Nucleic(traj.topology)
+    for i in range(traj.n_frames):
+        coords = traj.xyz[i,nn.indeces_lcs]
+        assert np.allclose(gvecs[i],ff.calc_gmat(coords,2.4),atol=1.0e-5)
+        assert np.allclose(rvecs[i],ff.calc_rmat(coords,1.7),atol=1.0e-5)
+
+def test_dump_kdtree():
+
+    # KD-tree pruning must give the same G-vectors as the full distance matrix
+    import numpy as np
+    import barnaba.calc_mats as ff
+
+    gvecs,resi = bb.dump_gvec(fname)
+    kdtree_size = ff.kdtree_size
+    ff.kdtree_size = 0
+    try:
+        gvecs_kd,resi = bb.dump_gvec(fname)
+    finally:
+        ff.kdtree_size = kdtree_size
+    assert np.allclose(gvecs,gvecs_kd)
+
+def test_dump_sparse():
+
+    # sparse G-vectors and eRMSD must match the dense calculation
+    import numpy as np
+    import barnaba.calc_mats as ff
+
+    fname1 = "%s/test/data/samples.xtc" % cwd
+    gvecs,resi = bb.dump_gvec(fname1,topology=fname)
+    gvecs_sp,resi = bb.dump_gvec(fname1,topology=fname,sparse=True)
+    gvecs = gvecs.reshape(gvecs.shape[0],-1)
+    assert np.allclose(gvecs_sp.toarray(),gvecs)
+    assert np.allclose(ff.calc_gdist(gvecs_sp[0],gvecs_sp),ff.calc_gdist(gvecs[0:1],gvecs),atol=1.0e-5)
+
+def test_dump_windows():
+
+    # G-vectors gathered from the whole structure must match calc_gmat on each window
+    import numpy as np
+    import mdtraj as md
+    import barnaba.calc_mats as ff
+    import barnaba.nucleic as nucleic
+    import barnaba.definitions as definitions
+
+    pdb = md.load(fname)
+    nn = nucleic.Nucleic(pdb.topology)
+    coords = pdb.xyz[0,nn.indeces_lcs]
+    windows = np.array(definitions.get_idx(nn.rna_seq_id,"NNNNN",bulges=1))
+    gmats = np.array([ff.calc_gmat(coords[:,w],2.4).reshape(-1) for w in windows])
+    assert np.allclose(ff.calc_gmat_windows(coords,2.4,windows),gmats)
@@ -77,5 +77,60 @@ def test_ermsd_4():
     return 0
 
 
+def test_ermsd_chunk():
+    
+    # read trajectory in chunks
+    fname = "%s/test/data/sample1.pdb" % cwd
+    fname1 = "%s/test/data/samples.xtc" % cwd
+    
+    dist = bb.ermsd(fname,fname1,topology=fname,chunk=7)
+    stri = "".join([ "%14e \n" % (dd) for dd in dist])
+    fh = open("%s/ermsd_04.test.dat" % outdir,'w')
+    fh.write(stri)
+    fh.close()
+
+    comp("%s/ermsd_04.test.dat" % refdir)
+    return 0
+
+
+
+def test_ermsd_multi():
+
+    # several references in a single pass
+    fname = "%s/test/data/sample1.pdb" % cwd
+    fname1 = "%s/test/data/samples.xtc" % cwd
+    fname2 = "%s/test/data/sample2.pdb" % cwd
+
+    dist = bb.ermsd([fname2,fname],fname1,topology=fname)
+    assert dist.shape==(101,2)
+    stri = "".join([ "%14e \n" % (dd) for dd in dist[:,1]])
+    fh = open("%s/ermsd_04.test.dat" % outdir,'w')
+    fh.write(stri)
+    fh.close()
+
+    comp("%s/ermsd_04.test.dat" % refdir)
+    return 0
+
+
+def test_ermsd_matrix():
+
+    # all-vs-all eRMSD in small blocks
+    fname = "%s/test/data/sample1.pdb" % cwd
+    fname1 = "%s/test/data/samples.xtc" % cwd
+
+    dmat = bb.ermsd_matrix(fname1,topology=fname,max_memory=0.01,out="%s/ermsd_matrix.npy" % outdir)
+    assert (dmat-dmat.T).max()==0.0
+
+    # trajectory vs structure
+    dmat2 = bb.ermsd_matrix(fname1,fname,topology=fname)
+    stri = "".join([ "%14e \n" % (dd) for dd in dmat2[:,0]])
+    fh = open("%s/ermsd_04.test.dat" % outdir,'w')
+    fh.write(stri)
+    fh.close()
+
+    comp("%s/ermsd_04.test.dat" % refdir)
+    assert ((dmat2[:,0]-dmat[0])**2).max()<1.E-10
+    return 0
+
 
 test_ermsd_1()
@@ -0,0 +1,85 @@
+from __future__ import absolute_import, division, print_function
+import barnaba as bb
+from barnaba import library
+import os
+
+cwd = os.getcwd()
+outdir = "%s/test/tmp" % cwd
+refdir = "%s/test/reference/" % cwd
+os.system("mkdir -p %s" % (outdir))
+fname = "%s/test/data/GNRA.pdb" % cwd
+
+def test_library():
+
+    # 430d with cytosines renamed as DNA nucleotides
+    dna = "%s/430d_dna.pdb" % outdir
+    fh = open(dna,'w')
+    for line in open("%s/test/data/430d.pdb" % cwd):
+        if((line.startswith("ATOM") or line.startswith("HETATM")) and line[17:20]=="  C"):
+            line = "%s DC%s" % (line[:17],line[20:])
+        fh.write(line)
+    fh.close()
+
+    targets = ["%s/test/data/%s.pdb" % (cwd,ff) for ff in ["1y26","430d","sample1"]] + [dna,"%s/test/data/missing.pdb" % cwd]
+    lib = library.MotifLibrary(6,bulges=1)
+    failed = lib.add(targets,n_jobs=2)
+    assert [ff[0] for ff in failed]==targets[4:]
+    
+    lib.save("%s/library.npz" % outdir)
+    lib = library.load_library("%s/library.npz" % outdir)
+
+    # same hits as ss_motif on each target
+    for seq in [None,"GNRNNN","YGNRNN"]:
+        hits = lib.search(fname,threshold=1.0,sequence=seq)
+        ref = []
+        for target in targets[:4]:
+            dist = bb.ss_motif(fname,target,threshold=1.0,bulges=1,sequence=seq)
+            ref.extend([[target,el[0],el[1],el[2]] for el in dist])
+        assert len(hits)==len(ref)
+        for el1,el2 in zip(hits,ref):
+            assert el1[0]==el2[0] and el1[1]==el2[1] and el1[3]==el2[3]
+            assert (el1[2]-el2[2])**2<1.E-10
+    # DNA nucleotides match their RNA counterparts
+    assert any([el[0]==dna and "DC" in el[3][0] for el in hits])
+
+def test_library_negative_resseq():
+
+    # residue labels with negative residue numbers are returned unchanged.
+    # residues are renumbered in the PDB file, as mdtraj does not write negative residue numbers
+    target = "%s/430d_negative.pdb" % outdir
+    fh = open(target,'w')
+    for line in open("%s/test/data/430d.pdb" % cwd):
+        if(line.startswith("ATOM") or line.startswith("HETATM")):
+            line = "%s%4d%s" % (line[:22],int(line[22:26])-200,line[26:])
+        fh.write(line)
+    fh.close()
+
+    lib = library.MotifLibrary(6,bulges=1)
+    lib.add([target])
+    lib.save("%s/library_negative.npz" % outdir)
+    lib = library.load_library("%s/library_negative.npz" % outdir)
+    hits = lib.search(fname,threshold=1.0)
+    ref = bb.ss_motif(fname,target,threshold=1.0,bulges=1)
+    assert len(hits)==len(ref)>0
+    assert any(["_-" in rr for el in hits for rr in el[3]])
+    for el1,el2 in zip(hits,ref):
+        assert el1[3]==el2[2]
+
+def test_library_chunk():
+
+    # trajectories read in chunks give the same library
+    import barnaba.calc_mats as ff
+    fname1 = "%s/test/data/samples.xtc" % cwd
+    top = "%s/test/data/sample1.pdb" % cwd
+    lib = library.MotifLibrary(4)
+    lib.add([fname1],topology=top)
+    lib_c = library.MotifLibrary(4)
+    # frames of a chunk are featurized in blocks of 3 frames
+    block_size = ff.block_size
+    ff.block_size = 3*70*70
+    try:
+        lib_c.add([fname1],topology=top,chunk=7)
+    finally:
+        ff.block_size = block_size
+    assert (lib.gvecs==lib_c.gvecs).all()
+    assert (lib.frames==lib_c.frames).all() and (lib.windows==lib_c.windows).all()
@@ -0,0 +1,38 @@
+from __future__ import absolute_import, division, print_function
+import barnaba as bb
+import os
+import numpy as np
+from comp_mine import comp
+
+cwd = os.getcwd()
+outdir = "%s/test/tmp" % cwd
+refdir = "%s/test/reference/" % cwd
+os.system("mkdir -p %s" % (outdir))
+
+fname = "%s/test/data/sample1.pdb" % cwd
+fname1 = "%s/test/data/samples.xtc" % cwd
+
+def test_parallel_ermsd():
+
+    dist = bb.ermsd(fname,fname1,topology=fname,n_jobs=2,chunk=40)
+    stri = "".join([ "%14e \n" % (dd) for dd in dist])
+    fh = open("%s/ermsd_04.test.dat" % outdir,'w')
+    fh.write(stri)
+    fh.close()
+
+    comp("%s/ermsd_04.test.dat" % refdir)
+
+def test_parallel_annotate():
+
+    stackings, pairings, res = bb.annotate(fname1,topology=fname)
+    stackings2, pairings2, res2 = bb.annotate(fname1,topology=fname,n_jobs=2)
+    assert stackings==stackings2
+    assert pairings==pairings2
+
+def test_parallel_ssmotif():
+
+    query = "%s/test/data/GNRA.pdb" % cwd
+    dist = bb.ss_motif(query,fname1,topology=fname,threshold=1.2)
+    dist2 = bb.ss_motif(query,fname1,topology=fname,threshold=1.2,n_jobs=3)
+    assert len(dist)>0
+    assert dist==dist2
@@ -0,0 +1,43 @@
+from __future__ import absolute_import, division, print_function
+import barnaba as bb
+import barnaba.reweight as reweight
+import barnaba.cluster as cc
+import numpy as np
+import os
+
+cwd = os.getcwd()
+outdir = "%s/test/tmp" % cwd
+os.system("mkdir -p %s" % (outdir))
+
+fname = "%s/test/data/sample1.pdb" % cwd
+fname1 = "%s/test/data/samples.xtc" % cwd
+
+def test_observables():
+
+    # observables written chunk by chunk to a memory-mapped file
+    obs,labels = reweight.calc_observables(fname1,topology=fname,pairs=[[0,50]],chunk=13,out="%s/observables.npy" % outdir)
+    obs1,labels1 = reweight.calc_observables(fname1,topology=fname,pairs=[[0,50]])
+    assert(labels==labels1)
+    assert(obs.shape==(101,len(labels)))
+    assert(np.array_equal(obs,obs1))
+
+    couplings,rr = bb.jcouplings(fname1,topology=fname)
+    couplings = couplings.reshape(couplings.shape[0],-1)
+    assert(np.allclose(obs[:,:-1],couplings[:,~np.isnan(couplings[0])],atol=1.0e-5))
+
+def test_maxent():
+
+    obs,labels = reweight.calc_observables(fname1,topology=fname,couplings=["H1H2","H3P"],residues=["RG_2_0","RC_3_0"])
+    exp = reweight.average(obs) + 0.5*np.std(obs,axis=0)
+    sigma = 0.5
+    weights,lambdas = reweight.maxent(obs,exp,sigma)
+    weights1,lambdas1 = reweight.maxent(obs,exp,sigma,chunk=10)
+    assert(np.allclose(weights,weights1))
+    assert(np.allclose(np.sum(weights),1.0))
+
+    # at the minimum, averages are shifted from experiments by theta*sigma^2*lambda
+    assert(np.allclose(reweight.average(obs,weights),exp+sigma**2*lambdas,atol=1.0e-5))
+
+    # weights can be used in pca
+    v,w = cc.pca(obs,nevecs=2,sample_weight=weights)
+    assert(w.shape==(obs.shape[0],2))
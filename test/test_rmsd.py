@@ -1,6 +1,8 @@
 from __future__ import absolute_import, division, print_function
 import barnaba as bb
 import os
+import numpy as np
+import mdtraj as md
 from comp_mine import comp
 
 cwd = os.getcwd()
@@ -52,3 +54,69 @@ def test_rmsd_3():
     comp("%s/rmsd_03.test.dat" % refdir)
 
 
+
+def test_rmsd_files():
+
+    # a list of decoys gives the same result as one call per decoy
+    fname = "%s/test/data/4v7t-pdb-bundle3_G521_00006.align.pdb" % cwd
+    decoys = ["%s/test/data/centroid_%s.pdb" % (cwd,k) for k in ["01","06","10","01"]] + [fname]
+
+    dist = bb.rmsd(fname,decoys,out='%s/aligned_files' % outdir)
+    assert(len(dist)==len(decoys))
+    for i,decoy in enumerate(decoys):
+        dd = bb.rmsd(fname,decoy)
+        assert(np.allclose(dist[i],dd[0],atol=1.0e-5))
+        assert(os.path.isfile('%s/aligned_files_%06d.pdb' % (outdir,i)))
+    assert(dist[-1]<1.0e-5)
+
+    # groups are superposed two structures at a time
+    import barnaba.functions as functions
+    block = functions._rmsd_files_block
+    functions._rmsd_files_block = 2
+    try:
+        dist_b = bb.rmsd(fname,decoys)
+    finally:
+        functions._rmsd_files_block = block
+    assert(np.allclose(dist,dist_b,atol=1.0e-6))
+
+    # cached atom indeces cannot be modified by the callers
+    ref = md.load(fname)
+    idx_ref, idx_target = functions._rmsd_atoms(ref.topology,ref.topology)
+    assert(not idx_ref.flags.writeable and not idx_target.flags.writeable)
+    assert(functions._rmsd_atoms(ref.topology,ref.topology)[0] is idx_ref)
+
+def test_rmsd_matrix():
+
+    # all-vs-all RMSD in small blocks
+    fname = "%s/test/data/sample1.pdb" % cwd
+    fname1 = "%s/test/data/samples.xtc" % cwd
+
+    dmat = bb.rmsd_matrix(fname1,topology=fname,max_memory=0.05,out="%s/rmsd_matrix.npy" % outdir,n_jobs=2)
+    assert (dmat-dmat.T).max()==0.0
+
+    # trajectory vs structure
+    dmat2 = bb.rmsd_matrix(fname1,fname,topology=fname,chunk=10)
+    dist = bb.rmsd(fname,fname1,topology=fname)
+    assert(np.allclose(dmat2[:,0],dist,atol=1.0e-5))
+
+    # first frame as reference
+    traj = md.load(fname1,top=fname)
+    dist = bb.rmsd_traj(traj[0],traj)
+    dist[0] = 0.0
+    assert(np.allclose(dmat[:,0],dist,atol=1.0e-4))
+
+def test_rmsd_traj_copy():
+
+    # the trajectory is not modified, also when aligned structures are written
+    fname = "%s/test/data/sample1.pdb" % cwd
+    fname1 = "%s/test/data/samples.xtc" % cwd
+
+    ref = md.load(fname)
+    traj = md.load(fname1,top=fname)
+    xyz = traj.xyz.copy()
+    dist = bb.rmsd_traj(ref,traj)
+    dist1 = bb.rmsd_traj(ref,traj,out='%s/aligned_4.xtc' % outdir)
+    assert(np.array_equal(xyz,traj.xyz))
+    assert(np.allclose(dist,dist1))
+    aligned = md.load('%s/aligned_4.xtc' % outdir,top=fname)
+    assert(np.allclose(aligned.time,traj.time))
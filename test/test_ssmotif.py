@@ -1,8 +1,12 @@
 from __future__ import absolute_import, division, print_function
 import barnaba as bb
+import barnaba.definitions as definitions
 import os
 from comp_mine import comp
 import glob
+import re
+import itertools
+import numpy as np
 
 cwd = os.getcwd()
 outdir = "%s/test/tmp" % cwd
@@ -31,3 +35,133 @@ def test_ssmotif():
     for f in of:
         comp(f)
         
+
+def test_ssmotif_scan():
+
+    # scan many files, one of them missing
+    targets = ["%s/test/data/%s.pdb" % (cwd,ff) for ff in ["430d","missing","1y26","sample1"]]
+    scan = list(bb.ss_motif_scan(fname,targets,threshold=1.0,n_jobs=2))
+    assert [el[0] for el in scan]==targets
+    assert scan[1][1]==None and scan[1][2]!=None
+    for target,dist,error in scan:
+        if(error!=None): continue
+        assert dist==bb.ss_motif(fname,target,threshold=1.0)
+
+def test_ssmotif_multi():
+
+    # several queries in one pass give the same hits as separate searches
+    queries = ["%s/test/data/%s.pdb" % (cwd,ff) for ff in ["GNRA","GNRA","UUCG"]]
+    seqs = [None,"NGNRAN",None]
+    target = "%s/test/data/1y26.pdb" % cwd
+    dist = bb.ss_motif(queries,target,threshold=1.5,bulges=1,sequence=seqs)
+    assert len(dist)==3
+    for qq,ss,dd in zip(queries,seqs,dist):
+        assert dd==bb.ss_motif(qq,target,threshold=1.5,bulges=1,sequence=ss)
+
+def test_ssmotif_topk():
+
+    # bounded modes give the same hits as post-processing the full list
+    query = "%s/test/data/GNRA.pdb" % cwd
+    top = "%s/test/data/sample1.pdb" % cwd
+    trj = "%s/test/data/samples.xtc" % cwd
+    dist = bb.ss_motif(query,trj,topology=top,threshold=1.2)
+    assert bb.ss_motif(query,trj,topology=top,threshold=1.2,top_k=5,n_jobs=2)==sorted(dist,key=lambda el: el[1])[:5]
+    assert bb.ss_motif(query,trj,topology=top,threshold=1.2,max_hits=4,chunk=7)==dist[:4]
+    best = bb.ss_motif(query,trj,topology=top,threshold=1.2,best_per_frame=True)
+    assert [el[0] for el in best]==sorted(set([el[0] for el in dist]))
+    for el in best:
+        assert el[1]==min([dd[1] for dd in dist if dd[0]==el[0]])
+
+def test_ssmotif_max_hits():
+
+    # with the trajectory in memory, the search stops after the first blocks of frames
+    from barnaba import functions
+    query = "%s/test/data/GNRA.pdb" % cwd
+    top = "%s/test/data/sample1.pdb" % cwd
+    trj = "%s/test/data/samples.xtc" % cwd
+    dist = bb.ss_motif(query,trj,topology=top,threshold=2.0)
+    kernel = functions._ss_motif_block
+    frames = []
+    def counting_kernel(coords,*args):
+        frames.append(coords.shape[0])
+        return kernel(coords,*args)
+    functions._ss_motif_block = counting_kernel
+    try:
+        assert bb.ss_motif(query,trj,topology=top,threshold=2.0,max_hits=3)==dist[:3]
+    finally:
+        functions._ss_motif_block = kernel
+    assert sum(frames)<=functions._motif_block_frames<101
+    assert bb.ss_motif(query,trj,topology=top,threshold=2.0,max_hits=3,n_jobs=2)==dist[:3]
+
+def test_get_idx():
+
+    # same windows, in the same order, as a plain enumeration with regular expressions
+    np.random.seed(1)
+    seq = list(np.random.choice(list("ACGU"),40))
+    pattern = definitions.get_pattern("GNRA")
+    expected = []
+    for b in range(3):
+        for ins in itertools.combinations(range(1,4+b-1),b):
+            offsets = [i for i in range(4+b) if i not in ins]
+            for start in range(len(seq)-3-b):
+                ww = [start+i for i in offsets]
+                if(re.match(pattern,"".join([seq[i] for i in ww]))!=None):
+                    expected.append(ww)
+    assert definitions.get_idx(seq,"GNRA",bulges=2).tolist()==expected
+
+    # DNA nucleotides are accepted, windows do not cross chains
+    seq = ["dG","A","A","A","G","C","G","A"]
+    assert definitions.get_idx(seq,"GNRA").tolist()==[[0,1,2,3],[4,5,6,7]]
+    assert definitions.get_idx(seq,"GNRA",chains=[0,0,0,0,0,1,1,1]).tolist()==[[0,1,2,3]]
+
+def test_ssmotif_breaks():
+
+    # windows do not span a gap inside a chain
+    import mdtraj as md
+    from barnaba import nucleic
+    traj = md.load("%s/test/data/1y26.pdb" % cwd)
+    # remove residue 20 from the chain
+    atoms = [at.index for at in traj.topology.atoms if at.residue.index!=20]
+    gapped = "%s/1y26_gap.pdb" % outdir
+    traj.atom_slice(atoms).save(gapped)
+
+    breaks_ref = nucleic.Nucleic(traj.topology).get_breaks(traj.xyz[0])
+    nn = nucleic.Nucleic(md.load(gapped).topology)
+    breaks = nn.get_breaks(md.load(gapped).xyz[0])
+    assert np.where(breaks)[0].tolist()==[19]+[k-1 for k in np.where(breaks_ref)[0]]
+    assert np.array_equal(nn.get_breaks(),breaks)
+    windows = definitions.get_idx(nn.rna_seq_id,"NNNN",bulges=1,breaks=breaks)
+    assert len(windows)>0
+    assert not np.any((windows[:,0]<=19) & (windows[:,-1]>=20))
+
+    query = "%s/test/data/GNRA.pdb" % cwd
+    for el in bb.ss_motif(query,gapped,threshold=2.0,bulges=1):
+        ii = [nn.rna_seq.index(rr) for rr in el[2]]
+        assert not (ii[0]<=19 and ii[-1]>=20)
+
+def test_ssmotif_multimodel():
+
+    # aligned hits in multi-model files, one for each set of atoms,
+    # same coordinates as one file per hit
+    import mdtraj as md
+    target = "%s/test/data/1y26.pdb" % cwd
+    dist = bb.ss_motif(fname,target,threshold=1.3,bulges=1,out='%s/ssmm' % outdir)
+    dist2 = bb.ss_motif(fname,target,threshold=1.3,bulges=1,out='%s/ssmm' % outdir,multimodel=True)
+    assert dist==dist2
+    files = ['%s/ssmm.pdb' % outdir]
+    while(os.path.isfile('%s/ssmm_%d.pdb' % (outdir,len(files)))):
+        files.append('%s/ssmm_%d.pdb' % (outdir,len(files)))
+    assert len(files)>1
+    models = []
+    for ff in files:
+        mm = open(ff).read().split("ENDMDL")[:-1]
+        assert md.load(ff).n_frames==len(mm)
+        models.append([[line for line in el.split("\n") if line.startswith("ATOM")] for el in mm])
+    assert sum([len(mm) for mm in models])==len(dist)
+
+    # each hit is the next model of one of the files
+    for count,el in enumerate(dist):
+        pdb = open('%s/ssmm_%05d_%s_0.pdb' % (outdir,count+1,el[2][0])).read()
+        atoms = [line for line in pdb.split("\n") if line.startswith("ATOM")]
+        assert atoms in [mm[0] for mm in models if len(mm)>0]
+        models = [mm[1:] if(len(mm)>0 and mm[0]==atoms) else mm for mm in models]
@@ -0,0 +1,53 @@
+from __future__ import absolute_import, division, print_function
+import barnaba as bb
+import barnaba.stats as stats
+import numpy as np
+import os
+
+cwd = os.getcwd()
+fname = "%s/test/data/sample1.pdb" % cwd
+fname1 = "%s/test/data/samples.xtc" % cwd
+
+def test_torsion_stats():
+
+    # statistics accumulated in chunks are the same as on the full time series
+    angles,rr = bb.backbone_angles(fname1,topology=fname)
+    pucker,rr = bb.pucker_angles(fname1,topology=fname)
+    weights = np.linspace(0.5,1.5,angles.shape[0])
+
+    backbone,populations,rr1 = stats.torsion_stats(fname1,topology=fname,weights=weights,chunk=17)
+    assert(rr==rr1)
+    ww = weights[:,np.newaxis,np.newaxis]*(~np.isnan(angles))
+    mean = np.arctan2(np.nansum(ww*np.sin(angles),axis=0),np.nansum(ww*np.cos(angles),axis=0))
+    ok = ~np.isnan(backbone.mean())
+    assert(np.allclose(mean[ok],backbone.mean()[ok],atol=1.0e-6))
+    assert(np.allclose(np.sum(backbone.hist,axis=2),np.sum(ww,axis=0)))
+
+    phase = np.degrees(pucker[:,:,0])
+    c3endo = np.sum(weights[:,np.newaxis]*((phase>=0.0) & (phase<36.0)),axis=0)/np.sum(weights)
+    assert(np.allclose(populations.populations()[:,0],c3endo))
+
+def test_torsion_stats_weights():
+
+    # one weight per frame is required
+    n_frames = bb.backbone_angles(fname1,topology=fname)[0].shape[0]
+    for n in [n_frames-1,n_frames+1]:
+        try:
+            stats.torsion_stats(fname1,topology=fname,weights=np.ones(n),chunk=17)
+        except AssertionError as e:
+            assert("number of weights" in str(e))
+        else:
+            assert(False)
+
+def test_circular_stats():
+
+    # von Mises samples
+    rand = np.random.RandomState(1)
+    angles = rand.vonmises(1.0,4.0,size=(5000,2,1))
+    cs = stats.CircularStats((2,1),bins=18)
+    for i in range(0,5000,1000):
+        cs.update(angles[i:i+1000])
+    assert(np.allclose(cs.mean(),1.0,atol=0.05))
+    assert(np.allclose(cs.concentration(),4.0,atol=0.4))
+    hist = cs.histogram(density=True)
+    assert(np.allclose(np.sum(hist,axis=2)*2.0*np.pi/18,1.0))